@@ -0,0 +1,148 @@
+'''Contains ArchiveWriter class to stream backed up files into rolling tar volumes
+
+Each file is compressed on its own by the calling copy worker, so compression runs in parallel
+across workers, and then appended to the current tar volume. A new volume is started once the
+current one reaches the configured size. Files are read and compressed in chunks, spooling the
+compressed data in memory for small files and on disk for large ones, so no file is ever
+loaded whole into memory. Files which are already compressed (images, videos, archives) are
+stored as is. Each member is written out of the volume's buffer once appended, and sync() makes
+the volume durable, so members the manifest and run journal record as archived survive a
+crash. Compressed members get the suffix of their compression format, e.g.
+'user/files/notes.txt.zst', and can be restored with tar followed by zstd/lz4/gunzip.
+
+zstd is used if the zstandard package is installed, then lz4 if the lz4 package is installed,
+otherwise gzip from the standard library.
+'''
+
+import os
+import tarfile
+import tempfile
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CHUNK_SIZE = 1024 * 1024
+# compressed members up to this size are kept in memory until appended to a volume
+SPOOL_SIZE = 8 * 1024 * 1024
+# extensions of formats which are already compressed
+INCOMPRESSIBLE_TYPES = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'mp4', 'mkv', 'mov', 'avi',
+                        'webm', 'mp3', 'm4a', 'ogg', 'opus', 'flac', 'zip', 'gz', 'tgz', 'bz2',
+                        'xz', 'zst', 'lz4', '7z', 'rar', 'docx', 'xlsx', 'pptx', 'odt', 'ods',
+                        'odp', 'epub'}
+
+class Lz4Compressor:
+    '''Adapts lz4.frame.LZ4FrameCompressor to the compress()/flush() interface of zlib'''
+    def __init__(self):
+        '''Creates lz4 frame compressor'''
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.started = False
+
+    def compress(self, data):
+        '''Returns compressed data for given chunk, beginning the frame on first call'''
+        out = b''
+        if not self.started:
+            out = self.compressor.begin()
+            self.started = True
+
+        return out + self.compressor.compress(data)
+
+    def flush(self):
+        '''Returns remaining compressed data and ends the frame'''
+        return self.compress(b'') + self.compressor.flush()
+
+def compressionFormat():
+    '''Returns (suffix, compressor factory) of best available compression format'''
+    if zstandard is not None:
+        return '.zst', lambda: zstandard.ZstdCompressor(level=3).compressobj()
+
+    if lz4 is not None:
+        return '.lz4', Lz4Compressor
+
+    return '.gz', lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+class ArchiveWriter:
+    '''Writes files into rolling tar volumes inside given directory'''
+    def __init__(self, directory, prefix, volumeSize):
+        '''Creates writer for volumes named '<prefix>.<n>.tar' of at most about volumeSize bytes'''
+        self.directory = directory
+        self.prefix = prefix
+        self.volumeSize = volumeSize
+        self.suffix, self.newCompressor = compressionFormat()
+        self.lock = threading.Lock()
+        self.volumes = []
+        self.tar = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def isCompressible(self, name):
+        '''Returns False if file with given name is already compressed'''
+        return name.split('.')[-1].lower() not in INCOMPRESSIBLE_TYPES
+
+    def add(self, src, arcname, stat):
+        '''Compresses src if worthwhile and appends it to the current volume as arcname
+
+        Returns number of bytes appended to the volume
+        '''
+        spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE, dir=self.directory)
+        try:
+            compressor = self.newCompressor() if self.isCompressible(src) else None
+            with open(src, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                    spool.write(compressor.compress(chunk) if compressor else chunk)
+
+            if compressor is not None:
+                spool.write(compressor.flush())
+                arcname += self.suffix
+
+            info = tarfile.TarInfo(arcname)
+            info.size = spool.tell()
+            info.mtime = stat.st_mtime
+            info.mode = stat.st_mode & 0o7777
+            info.uid = stat.st_uid
+            info.gid = stat.st_gid
+            spool.seek(0)
+
+            with self.lock:
+                if self.tar is None or self.tar.fileobj.tell() >= self.volumeSize:
+                    self.nextVolume()
+
+                self.tar.addfile(info, spool)
+                # a killed run must not lose members already reported as appended
+                self.tar.fileobj.flush()
+
+            return info.size
+        finally:
+            spool.close()
+
+    def nextVolume(self):
+        '''Closes current volume and opens the next one, caller must hold self.lock'''
+        if self.tar is not None:
+            self.tar.close()
+
+        path = os.path.join(self.directory, '{}.{}.tar'.format(self.prefix, len(self.volumes)))
+        self.tar = tarfile.open(path, 'w', format=tarfile.PAX_FORMAT)
+        self.volumes.append(path)
+
+    def sync(self):
+        '''Writes members appended to the current volume to disk'''
+        with self.lock:
+            if self.tar is not None:
+                self.tar.fileobj.flush()
+                os.fsync(self.tar.fileobj.fileno())
+
+    def close(self):
+        '''Closes current volume, returns paths of all volumes written'''
+        with self.lock:
+            if self.tar is not None:
+                self.tar.close()
+                self.tar = None
+
+        return self.volumes
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+'''Contains benchmark harness to measure NextcloudBackup scan and copy performance
+
+Builds a reproducible synthetic Nextcloud-like data tree in a temporary directory (many tiny
+preview files, a few huge files, deeply nested directories and .part uploads), then times
+a full scan, a full backup to a local destination directory and an incremental run with no
+changes. Results are printed as JSON so they can be compared between versions.
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from nextcloudBackup import NextcloudBackup
+
+class BenchmarkBackup(NextcloudBackup):
+    '''NextcloudBackup backing up a local directory without mounting a partition'''
+    def checkDataExists(self):
+        '''Skips partition check, data and backup directories are local'''
+
+    def mountBackupPartition(self):
+        '''Probes copy backend without mounting anything'''
+        if not self.args.dry_run:
+            self.copyBackend = self.probeCopyBackend()
+
+    def tearDown(self):
+        '''Closes journal, manifest and log files without unmounting or spinning down any drive'''
+        if self.journal is not None:
+            self.journal.close()
+
+        if self.manifest is not None:
+            self.manifest.close()
+
+        self.log.write((self.cutoff or datetime.datetime.now()).strftime('%c') + '\n')
+        for log in [self.log, self.error, self.erroredFiles]:
+            log.close()
+
+def writeFile(path, size, rng, block):
+    '''Writes file of given size, using random data for small files and repeated block otherwise'''
+    with open(path, 'wb') as fp:
+        if size <= len(block):
+            fp.write(rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b'')
+        else:
+            for offset in range(0, size, len(block)):
+                fp.write(block[:size - offset])
+
+def generateTree(root, args):
+    '''Creates synthetic data tree in root, returns (number of files, total bytes) to back up'''
+    rng = random.Random(args.seed)
+    block = rng.getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, 'little')
+    files = size = 0
+
+    def add(path, fileSize):
+        '''Creates file and counts it'''
+        nonlocal files, size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writeFile(path, fileSize, rng, block)
+        files += 1
+        size += fileSize
+
+    # previews and thumbnails, 100 per directory
+    for n in range(args.tiny_files):
+        add(os.path.join(root, 'appdata_bench', 'preview', str(n // 10000), str(n // 100 % 100),
+                         '{}-{}.png'.format(n, rng.choice([32, 64, 256, 1024]))),
+            rng.randint(100, 16 * 1024))
+
+    for n in range(args.huge_files):
+        add(os.path.join(root, 'user{}'.format(n), 'files', 'disk{}.img'.format(n)),
+            args.huge_size * 1024 * 1024)
+
+    path = os.path.join(root, 'user0', 'files')
+    for n in range(args.depth):
+        path = os.path.join(path, 'level{}'.format(n))
+        add(os.path.join(path, 'notes.txt'), rng.randint(100, 4096))
+
+    # partial uploads are ignored by the backup
+    for n in range(args.part_files):
+        path = os.path.join(root, 'user0', 'uploads', 'upload{}.part'.format(n))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writeFile(path, rng.randint(100, 64 * 1024), rng, block)
+
+    return files, size
+
+def result(seconds, files, size=None):
+    '''Returns dict of timing results'''
+    out = {'seconds': round(seconds, 4), 'files': files,
+           'files_per_sec': round(files / seconds, 1) if seconds else None}
+    if size is not None:
+        out['bytes'] = size
+        out['mb_per_sec'] = round(size / seconds / 1e6, 2) if seconds else None
+
+    return out
+
+def runBackup(workdir, data, backup, args, scanOnly=False):
+    '''Runs one backup of data into backup, returns (elapsed seconds, files, copy backend)
+
+    If scanOnly is True, data is only scanned and nothing is backed up
+    '''
+    BenchmarkBackup._instance = None
+    BenchmarkBackup.NEXTCLOUD_BACKUP_LOG = os.path.join(workdir, 'backups.log')
+    BenchmarkBackup.NEXTCLOUD_BACKUP_ERROR_LOG = os.path.join(workdir, 'error.log')
+    BenchmarkBackup.NEXTCLOUD_ERRORED_FILES_LOG = os.path.join(workdir, 'errored_files.log')
+    BenchmarkBackup.NEXTCLOUD_BACKUP_MANIFEST = os.path.join(workdir, 'manifest.db')
+    BenchmarkBackup.NEXTCLOUD_ARCHIVE_MANIFEST = os.path.join(workdir, 'archive_manifest.db')
+    BenchmarkBackup.NEXTCLOUD_BACKUP_JOURNAL = os.path.join(workdir, 'journal.log')
+    # filters and state of the host's own backups must not affect the results
+    BenchmarkBackup.NEXTCLOUD_BACKUP_METRICS = os.path.join(workdir, 'metrics.json')
+    BenchmarkBackup.NEXTCLOUD_BACKUP_DIRTY = os.path.join(workdir, 'dirty.db')
+    BenchmarkBackup.NEXTCLOUD_BACKUP_SCRUB = os.path.join(workdir, 'scrub.json')
+    BenchmarkBackup.NEXTCLOUD_BACKUP_FILTERS = os.path.join(workdir, 'filters')
+    BenchmarkBackup.NEXTCLOUD_DATA = data
+    BenchmarkBackup.NEXTCLOUD_DATA_BACKUP = backup
+
+    backupArgs = argparse.Namespace(verbose=False, dry_run=False, jobs=args.jobs, output=args.output)
+    with BenchmarkBackup(backupArgs) as obj:
+        scanned = 0
+        start = time.perf_counter()
+        if scanOnly:
+            for _, entries, _ in obj.scanData():
+                for entry in entries:
+                    entry.stat()
+                    scanned += 1
+        else:
+            obj.main()
+
+        return time.perf_counter() - start, scanned, obj.copyBackend
+
+def benchmark(args):
+    '''Runs all benchmarks and returns results as dict'''
+    workdir = tempfile.mkdtemp(dir=args.tmp)
+    try:
+        data = os.path.join(workdir, 'data', '')
+        backup = os.path.join(workdir, 'backup', '')
+        os.makedirs(data)
+        os.makedirs(backup)
+
+        start = time.perf_counter()
+        files, size = generateTree(data, args)
+        results = {'generate': result(time.perf_counter() - start, files, size)}
+
+        # full scan of the tree without copying anything
+        seconds, scanned, _ = runBackup(workdir, data, backup, args, scanOnly=True)
+        results['scan'] = result(seconds, scanned)
+
+        seconds, _, backend = runBackup(workdir, data, backup, args)
+        results['full_backup'] = result(seconds, files, size)
+        seconds, _, _ = runBackup(workdir, data, backup, args)
+        results['incremental_no_change'] = result(seconds, scanned)
+
+        return {
+            'label': args.label,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {x: getattr(args, x) for x in ['tiny_files', 'huge_files', 'huge_size',
+                                                          'depth', 'part_files', 'seed', 'jobs',
+                                                          'output']},
+            'copy_backend': backend or 'copy2',
+            'results': results
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+def main():
+    '''Sets up argument parser to parse command line arguments and runs benchmarks'''
+    parser = argparse.ArgumentParser(description='benchmark NextcloudBackup on a synthetic data tree')
+    parser.add_argument('--tiny-files', default=100000, type=int, metavar='N', help='number of preview sized files')
+    parser.add_argument('--huge-files', default=2, type=int, metavar='N', help='number of huge files')
+    parser.add_argument('--huge-size', default=1024, type=int, metavar='MB', help='size of each huge file in MiB')
+    parser.add_argument('--depth', default=64, type=int, metavar='N', help='depth of nested directories')
+    parser.add_argument('--part-files', default=100, type=int, metavar='N', help='number of ignored .part files')
+    parser.add_argument('--seed', default=0, type=int, help='random seed used to generate the tree')
+    parser.add_argument('--jobs', default=1, type=int, metavar='N', help='number of files to copy concurrently')
+    parser.add_argument('--output', default='mirror', choices=NextcloudBackup.OUTPUT_MODES, help='backup output mode')
+    parser.add_argument('--tmp', default=None, help='directory to create the synthetic tree in')
+    parser.add_argument('--label', default='', help='label stored with results, e.g. version being measured')
+    args = parser.parse_args()
+
+    json.dump(benchmark(args), sys.stdout, indent=2)
+    print()
+
+if __name__ == '__main__':
+    main()
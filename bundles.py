@@ -0,0 +1,175 @@
+'''Contains BundleStore class to pack small files into append-only bundles in the backup
+
+Copying a tiny file (previews, thumbnails) as a file of its own costs a directory lookup, a
+create, a write and metadata updates on the backup disk, far more than the data itself, and
+spreads millions of inodes across the disk. Instead, files below a size threshold are appended
+to numbered bundle files under NEXTCLOUD_DATA_BACKUP/.bundles, and an SQLite index next to them
+records the bundle, offset, size, modification time and mode of each file. A bundle is closed
+once it reaches BUNDLE_SIZE. Bundles are never rewritten: a changed file is appended again and
+its index entry replaced, so restoring a single file takes one index lookup and one read at a
+known offset. Index writes are batched like the manifest's, and the directories holding packed
+files are kept in memory so removing a file that was never packed doesn't touch the index.
+'''
+
+import collections
+import os
+import sqlite3
+import threading
+
+# location and metadata of a packed file
+Entry = collections.namedtuple('Entry', ['bundle', 'offset', 'size', 'mtime_ns', 'mode'])
+
+class BundleStore:
+    '''Append-only bundles of small files with an SQLite index'''
+    BUNDLE_DIR = '.bundles'
+    BUNDLE_SIZE = 256 * 1024 * 1024
+    INDEX_NAME = 'index.db'
+    BATCH_SIZE = 1000
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS entries ('
+              'dir TEXT NOT NULL, '
+              'name TEXT NOT NULL, '
+              'bundle INTEGER NOT NULL, '
+              'offset INTEGER NOT NULL, '
+              'size INTEGER NOT NULL, '
+              'mtime_ns INTEGER NOT NULL, '
+              'mode INTEGER NOT NULL, '
+              'PRIMARY KEY (dir, name)) WITHOUT ROWID')
+    # sorts after any path component, used as upper bound of directory subtrees
+    MAX_CHAR = '\U0010ffff'
+
+    def __init__(self, root):
+        '''Opens (or creates) bundle store inside given backup root'''
+        self.root = os.path.join(root, self.BUNDLE_DIR)
+        os.makedirs(self.root, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.root, self.INDEX_NAME), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(self.SCHEMA)
+        self.db.commit()
+        self.lock = threading.Lock()
+
+        # pending writes are batched to avoid one transaction per file
+        self.pending = []
+        self.pendingRemovals = []
+        self.dirs = {x[0] for x in self.db.execute('SELECT DISTINCT dir FROM entries')}
+
+        # keep appending to the newest bundle
+        numbers = [int(x.split('.')[0]) for x in os.listdir(self.root) if x.endswith('.bundle')]
+        self.number = max(numbers, default=1)
+        self.fd = os.open(self.bundlePath(self.number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.offset = os.fstat(self.fd).st_size
+
+    def bundlePath(self, number):
+        '''Returns path of bundle with given number'''
+        return os.path.join(self.root, '{:06d}.bundle'.format(number))
+
+    def add(self, directory, name, data, stat):
+        '''Appends data of file name in directory to current bundle and indexes it with stat'''
+        with self.lock:
+            if self.offset and self.offset + len(data) > self.BUNDLE_SIZE:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.number += 1
+                self.fd = os.open(self.bundlePath(self.number),
+                                  os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self.offset = 0
+
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+
+            # data is in the page cache before the index points at it
+            self.pending.append((directory, name, self.number, self.offset, len(data),
+                                 stat.st_mtime_ns, stat.st_mode & 0o7777))
+            self.dirs.add(directory)
+            self.offset += len(data)
+            if len(self.pending) >= self.BATCH_SIZE:
+                self._flush()
+
+    def lookup(self, directory, name):
+        '''Returns Entry of packed file name in directory, or None'''
+        with self.lock:
+            self._flush()
+            row = self.db.execute('SELECT bundle, offset, size, mtime_ns, mode FROM entries '
+                                  'WHERE dir = ? AND name = ?', (directory, name)).fetchone()
+
+        return Entry(*row) if row else None
+
+    def entries(self, directory=''):
+        '''Returns list of (directory, name, Entry) of files packed in directory and its
+        subdirectories
+        '''
+        with self.lock:
+            self._flush()
+            rows = self.db.execute('SELECT * FROM entries WHERE ? = \'\' OR dir = ? OR '
+                                   '(dir > ? AND dir < ?) ORDER BY dir, name',
+                                   (directory, directory, directory + '/',
+                                    directory + '/' + self.MAX_CHAR)).fetchall()
+
+        return [(x[0], x[1], Entry(*x[2:])) for x in rows]
+
+    def read(self, entry):
+        '''Returns contents of packed file described by entry'''
+        fd = os.open(self.bundlePath(entry.bundle), os.O_RDONLY)
+        try:
+            data = os.pread(fd, entry.size, entry.offset)
+        finally:
+            os.close(fd)
+
+        if len(data) != entry.size:
+            raise OSError('bundle {} is truncated'.format(entry.bundle))
+
+        return data
+
+    def extract(self, entry, dst):
+        '''Writes packed file described by entry to dst with its mode and modification time'''
+        with open(dst, 'wb') as fp:
+            fp.write(self.read(entry))
+
+        os.chmod(dst, entry.mode)
+        os.utime(dst, ns=(entry.mtime_ns, entry.mtime_ns))
+
+    def remove(self, directory, name):
+        '''Queues file name in directory to be removed from index if its directory holds
+        packed files
+        '''
+        with self.lock:
+            if directory not in self.dirs:
+                return
+
+            self.pendingRemovals.append((directory, name))
+            if len(self.pendingRemovals) >= self.BATCH_SIZE:
+                self._flush()
+
+    def removeTree(self, directory):
+        '''Removes every file of directory and its subdirectories from index'''
+        with self.lock:
+            self._flush()
+            self.db.execute('DELETE FROM entries WHERE dir = ? OR (dir > ? AND dir < ?)',
+                            (directory, directory + '/', directory + '/' + self.MAX_CHAR))
+            self.db.commit()
+
+    def flush(self):
+        '''Writes all queued index entries'''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        '''Writes queued index entries, caller must hold self.lock'''
+        if not self.pending and not self.pendingRemovals:
+            return
+
+        self.db.executemany('DELETE FROM entries WHERE dir = ? AND name = ?', self.pendingRemovals)
+        self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            self.pending)
+        self.db.commit()
+        self.pending = []
+        self.pendingRemovals = []
+
+    def close(self):
+        '''Writes queued index entries, syncs current bundle to disk and closes it and the index'''
+        with self.lock:
+            self._flush()
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.db.close()
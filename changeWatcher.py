@@ -0,0 +1,255 @@
+'''Contains Inotify and ChangeWatcher classes used by the change tracking daemon
+
+ChangeWatcher watches every directory under NEXTCLOUD_DATA through inotify and records
+directories in which files were written, created, moved or deleted in a DirtySet, which a
+backup run using --changes watch lists instead of walking the whole tree. inotify is called
+through ctypes, so no extra package is needed.
+
+To keep memory bounded when watching millions of directories, each watch is stored as a
+(parent watch descriptor, name) pair instead of a full path, and changed directories are
+buffered as watch descriptors, then resolved to paths and written to the dirty set in batches.
+Renaming a directory only updates its own entry. If the kernel event queue overflows, or a
+directory can't be watched (e.g. fs.inotify.max_user_watches was reached), a full scan is
+requested since changes may have been missed.
+'''
+
+import ctypes
+import errno
+import os
+import select
+import struct
+import time
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# events recorded for every watched directory
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+class Inotify:
+    '''Minimal ctypes wrapper around an inotify instance'''
+    def __init__(self):
+        '''Creates non-blocking inotify instance, raises OSError if inotify is unavailable'''
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this system')
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.raiseErrno()
+
+    def raiseErrno(self, path=None):
+        '''Raises OSError for errno of last failed call'''
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+    def fileno(self):
+        '''Returns inotify file descriptor'''
+        return self.fd
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        '''Watches directory at path, returns watch descriptor (the existing one if already watched)'''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            self.raiseErrno(path)
+
+        return wd
+
+    def removeWatch(self, wd):
+        '''Stops watching watch descriptor, an IN_IGNORED event follows'''
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        '''Returns list of pending (watch descriptor, mask, cookie, name) events'''
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        '''Closes inotify instance, removing all watches'''
+        os.close(self.fd)
+
+class ChangeWatcher:
+    '''Records changed directories under root in a DirtySet'''
+    # number of buffered changed directories and seconds after which they are written
+    FLUSH_BATCH = 10000
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, root, dirtySet, ignoredTypes=(), verbose=False):
+        '''Watches root, recording changes in dirtySet and ignoring files of ignoredTypes'''
+        self.root = root
+        self.dirtySet = dirtySet
+        self.ignoredTypes = ignoredTypes
+        self.verbose = verbose
+        self.inotify = Inotify()
+        # watch descriptor -> (parent watch descriptor, directory name)
+        self.dirs = {}
+        # watch descriptors of changed directories not yet written to the dirty set
+        self.pending = set()
+        # directories renamed inside root, whose IN_MOVE_SELF must not remove their watch
+        self.reparented = set()
+        # directories that couldn't be watched, forcing full scans
+        self.unwatched = 0
+        self.running = False
+        self.lastFlush = time.monotonic()
+
+    def start(self):
+        '''Requests a full scan, since changes were missed while not running, and watches root'''
+        self.dirtySet.requestFullScan()
+        self.watchTree(self.root, None, '')
+        self.pending.clear()
+        if self.verbose:
+            print('watching {} directories under \'{}\''.format(len(self.dirs), self.root))
+
+    def watchTree(self, path, parent, name):
+        '''Watches directory at path and every directory below it, marking them changed'''
+        stack = [(path, parent, name)]
+        while stack:
+            path, parent, name = stack.pop()
+            try:
+                wd = self.inotify.addWatch(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self.unwatched += 1
+                # otherwise directory was removed or replaced before it could be watched
+                continue
+
+            if wd in self.dirs:
+                self.reparented.add(wd)
+
+            self.dirs[wd] = (parent, name)
+            self.pending.add(wd)
+            try:
+                for entry in os.scandir(path):
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, wd, entry.name))
+            except OSError:
+                continue
+
+    def path(self, wd):
+        '''Returns directory of watch descriptor relative to root, None if no longer under root'''
+        parts = []
+        while wd is not None:
+            entry = self.dirs.get(wd)
+            if entry is None:
+                return None
+
+            wd, name = entry
+            if name:
+                parts.append(name)
+
+        return '/'.join(reversed(parts))
+
+    def handle(self, events):
+        '''Records changed directories from list of inotify events'''
+        for wd, mask, _, name in events:
+            if mask & IN_Q_OVERFLOW:
+                if self.verbose:
+                    print('inotify event queue overflowed, requesting full scan')
+
+                self.dirtySet.requestFullScan()
+                continue
+
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                self.reparented.discard(wd)
+                continue
+
+            if wd not in self.dirs:
+                continue
+
+            if mask & IN_MOVE_SELF:
+                # directory moved out of root, renames inside root are handled by IN_MOVED_TO
+                if wd in self.reparented:
+                    self.reparented.discard(wd)
+                else:
+                    self.inotify.removeWatch(wd)
+
+                continue
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    parentPath = self.path(wd)
+                    if parentPath is not None:
+                        self.watchTree(os.path.join(self.root, parentPath, name), wd, name)
+            elif name.split('.')[-1] in self.ignoredTypes:
+                continue
+
+            self.pending.add(wd)
+
+    def flush(self):
+        '''Writes buffered changed directories to the dirty set'''
+        directories = set()
+        for wd in self.pending:
+            path = self.path(wd)
+            if path is None:
+                # an ancestor was moved out of root, so this directory is no longer under it
+                self.inotify.removeWatch(wd)
+            else:
+                directories.add(path)
+
+        self.pending.clear()
+        if directories:
+            self.dirtySet.add(sorted(directories))
+
+        if self.unwatched:
+            self.dirtySet.requestFullScan()
+
+        self.lastFlush = time.monotonic()
+
+    def poll(self, timeout):
+        '''Waits up to timeout seconds for events, handles them and flushes if due'''
+        ready, _, _ = select.select([self.inotify], [], [], timeout)
+        if ready:
+            self.handle(self.inotify.read())
+
+        if (len(self.pending) >= self.FLUSH_BATCH or
+                time.monotonic() - self.lastFlush >= self.FLUSH_INTERVAL):
+            self.flush()
+
+    def run(self):
+        '''Watches root until stop() is called'''
+        self.running = True
+        self.start()
+        try:
+            while self.running:
+                self.poll(self.FLUSH_INTERVAL)
+        finally:
+            self.flush()
+
+    def stop(self):
+        '''Makes run() return after flushing pending changes'''
+        self.running = False
+
+    def close(self):
+        '''Stops watching and closes dirty set'''
+        self.inotify.close()
+        self.dirtySet.close()
@@ -0,0 +1,148 @@
+'''Contains ContentStore class to keep a single copy of each unique file in the backup
+
+Every unique file content is stored once as a blob named after its BLAKE2 digest under
+NEXTCLOUD_DATA_BACKUP/.store/objects. The usual per-path backup tree is made of hardlinks
+to these blobs, so duplicated files (shared photos, files_versions and files_trashbin
+copies) only take up space once, and a renamed or moved file can be linked to its existing
+blob without being copied again. Since hardlinks share an inode, all paths pointing to the
+same blob share the metadata of the file that created the blob.
+Blobs whose links were replaced or removed during a run are the only ones checked for
+removal at its end, so pruning doesn't need a pass over every blob. Links moved to the trash
+are recorded in a pending file and their blobs checked once the trash directory is emptied.
+'''
+
+import hashlib
+import os
+import shutil
+import threading
+
+# blake2b is only available from python 3.6
+HASH = getattr(hashlib, 'blake2b', hashlib.sha256)
+CHUNK_SIZE = 1024 * 1024
+
+def hashFile(path):
+    '''Returns hex digest of the contents of given file'''
+    digest = HASH()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+class ContentStore:
+    '''Content addressed blob store with hardlinked per-path tree'''
+    STORE_DIR = '.store'
+    PENDING_NAME = 'pending'
+
+    def __init__(self, root):
+        '''Creates store inside given backup root'''
+        self.root = os.path.join(root, self.STORE_DIR)
+        self.objects = os.path.join(self.root, 'objects')
+        self.tmp = os.path.join(self.root, 'tmp')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.tmp, exist_ok=True)
+
+        # digests of blobs that lost a link during this run, and (trash name, digest) of blobs
+        # whose link was moved to a trash directory
+        self.lock = threading.Lock()
+        self.released = set()
+        self.trashed = []
+
+    def blobPath(self, digest):
+        '''Returns path of blob with given digest'''
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def tmpPath(self, name):
+        '''Returns unique temporary path inside the store for given name'''
+        return os.path.join(self.tmp, '{}.{}.{}'.format(os.getpid(), threading.get_ident(), name))
+
+    def add(self, src, digest=None):
+        '''Adds src to store if its contents aren't stored yet and returns its digest
+
+        digest can be given if already known (e.g. from the manifest) to avoid reading src
+        '''
+        if digest is None or not os.path.exists(self.blobPath(digest)):
+            digest = hashFile(src)
+
+        blob = self.blobPath(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = self.tmpPath(digest)
+            shutil.copy2(src, tmp)
+            os.replace(tmp, blob)
+
+        return digest
+
+    def link(self, digest, dst, previous=None):
+        '''Points dst at blob with given digest, replacing any existing file at dst
+
+        previous is the digest of the file at dst if known, otherwise it is read from dst
+        '''
+        blob = self.blobPath(digest)
+        try:
+            if os.path.samefile(blob, dst):
+                return
+
+            self.release(previous or hashFile(dst))
+        except FileNotFoundError:
+            pass
+
+        tmp = self.tmpPath(digest + '.link')
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            # e.g. EMLINK, too many links to a single inode: fall back to a copy
+            shutil.copy2(blob, tmp)
+
+        os.replace(tmp, dst)
+
+    def release(self, digest, trashName=None):
+        '''Records that a link to blob with given digest was replaced or removed, or moved to
+        trash directory trashName, so prune() checks whether the blob is still linked
+        '''
+        with self.lock:
+            if trashName is None:
+                self.released.add(digest)
+            else:
+                self.trashed.append((trashName, digest))
+
+    def prune(self, trashRoot=None):
+        '''Removes released blobs no longer linked from the backup tree, returns number removed
+
+        Blobs moved to a trash directory that still exists under trashRoot are kept pending
+        for a later run
+        '''
+        pendingPath = os.path.join(self.root, self.PENDING_NAME)
+        try:
+            with open(pendingPath) as fp:
+                pending = [tuple(x.split()) for x in fp if x.strip()]
+        except FileNotFoundError:
+            pending = []
+
+        with self.lock:
+            candidates, self.released = self.released, set()
+            pending += self.trashed
+            self.trashed = []
+
+        keep = []
+        for trashName, digest in pending:
+            if trashRoot is not None and os.path.isdir(os.path.join(trashRoot, trashName)):
+                keep.append((trashName, digest))
+            else:
+                candidates.add(digest)
+
+        removed = 0
+        for digest in candidates:
+            try:
+                if os.lstat(self.blobPath(digest)).st_nlink == 1:
+                    os.unlink(self.blobPath(digest))
+                    removed += 1
+            except FileNotFoundError:
+                pass
+
+        tmp = self.tmpPath(self.PENDING_NAME)
+        with open(tmp, 'w') as fp:
+            fp.writelines('{} {}\n'.format(*x) for x in keep)
+
+        os.replace(tmp, pendingPath)
+        return removed
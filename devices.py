@@ -0,0 +1,113 @@
+'''Contains functions to probe block devices and mounts, and to mount and spin down drives
+
+Instead of running lsblk, mount, umount and hdparm in a shell, block devices are looked up in
+/sys/class/block, mounts are read from /proc/self/mountinfo, and drives are mounted, unmounted
+and spun down through the mount(2), umount2(2) and ioctl(2) system calls, which saves a
+fork/exec per call. Devices are compared by exact name, so /dev/sdc1 never matches
+/dev/sdc10. The proc and sys paths are module constants so fixture files can be used in tests.
+'''
+
+import collections
+import ctypes
+import errno
+import os
+import re
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MOUNTINFO = '/proc/self/mountinfo'
+PROC_FILESYSTEMS = '/proc/filesystems'
+SYS_BLOCK = '/sys/class/block'
+# ioctl and ATA command used by hdparm -y to put a drive in standby mode
+HDIO_DRIVE_CMD = 0x031f
+ATA_OP_STANDBYNOW1 = 0xe0
+
+Mount = collections.namedtuple('Mount', ['source', 'mountPoint', 'fsType', 'options'])
+
+_libc = None
+
+def libc():
+    '''Returns C library loaded with errno support'''
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+
+    return _libc
+
+def raiseErrno(path):
+    '''Raises OSError for errno of last failed C library call'''
+    code = ctypes.get_errno()
+    raise OSError(code, os.strerror(code), path)
+
+def unescape(field):
+    '''Returns mountinfo field with octal escapes (e.g. \\040 for space) decoded'''
+    return re.sub(r'\\([0-7]{3})', lambda x: chr(int(x.group(1), 8)), field)
+
+def mounts(path=None):
+    '''Returns list of Mount entries read from mountinfo file at path'''
+    entries = []
+    with open(path or MOUNTINFO) as fp:
+        for line in fp:
+            fields = line.split()
+            # optional fields end with a single '-' separator
+            separator = fields.index('-', 6)
+            entries.append(Mount(unescape(fields[separator + 2]), unescape(fields[4]),
+                                 fields[separator + 1], fields[5]))
+
+    return entries
+
+def sameDevice(source, device):
+    '''Returns True if mount source refers to device, following symlinks such as /dev/disk/by-uuid'''
+    return source == device or (source.startswith('/') and
+                                os.path.realpath(source) == os.path.realpath(device))
+
+def mountPoints(device, path=None):
+    '''Returns list of directories device is mounted at'''
+    return [x.mountPoint for x in mounts(path) if sameDevice(x.source, device)]
+
+def blockDeviceExists(device, sysBlock=None):
+    '''Returns True if device is a block device known to the kernel
+
+    Raises OSError if sysfs isn't available
+    '''
+    sysBlock = sysBlock or SYS_BLOCK
+    if not os.path.isdir(sysBlock):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), sysBlock)
+
+    return os.path.lexists(os.path.join(sysBlock, os.path.basename(os.path.realpath(device))))
+
+def fileSystems(path=None):
+    '''Returns list of filesystem types backed by a device that the kernel supports'''
+    with open(path or PROC_FILESYSTEMS) as fp:
+        return [x.split()[-1] for x in fp if x.strip() and not x.startswith('nodev')]
+
+def mount(device, target, fsType=None, flags=0, data=''):
+    '''Mounts device at target, trying every supported filesystem type if fsType is None'''
+    for candidate in [fsType] if fsType else fileSystems():
+        if libc().mount(os.fsencode(device), os.fsencode(target), candidate.encode(),
+                        ctypes.c_ulong(flags), data.encode()) == 0:
+            return candidate
+
+        # EINVAL means the device doesn't contain a filesystem of this type
+        if ctypes.get_errno() != errno.EINVAL:
+            raiseErrno(device)
+
+    raise OSError(errno.EINVAL, 'no supported filesystem found', device)
+
+def umount(target, flags=0):
+    '''Unmounts filesystem mounted at target'''
+    if libc().umount2(os.fsencode(target), flags) != 0:
+        raiseErrno(target)
+
+def standby(device):
+    '''Puts drive holding device in standby mode, spinning it down like hdparm -y'''
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'ioctl is not supported on this system', device)
+
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        fcntl.ioctl(fd, HDIO_DRIVE_CMD, bytearray([ATA_OP_STANDBYNOW1, 0, 0, 0]))
+    finally:
+        os.close(fd)
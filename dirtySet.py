@@ -0,0 +1,71 @@
+'''Contains DirtySet class shared by the watch daemon and NextcloudBackup
+
+The dirty set is an SQLite database stored next to the backup logs listing directories of
+NEXTCLOUD_DATA in which something changed since the last backup, along with a flag requesting
+a full scan (set when the daemon starts, since changes made while it wasn't running were
+missed, and when the kernel event queue overflows). Every write gets an increasing sequence
+number, so a backup run can claim the current contents and, once it completes, only remove
+what it claimed: directories dirtied again during the run are kept for the next run.
+'''
+
+import sqlite3
+import threading
+
+class DirtySet:
+    '''Persistent set of changed directories'''
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS dirty (dir TEXT PRIMARY KEY, seq INTEGER NOT NULL) WITHOUT ROWID',
+              'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)']
+
+    def __init__(self, path):
+        '''Opens (or creates) dirty set database at path'''
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def nextSeq(self):
+        '''Returns next sequence number, caller must be inside a transaction'''
+        row = self.db.execute('SELECT value FROM state WHERE key = \'seq\'').fetchone()
+        seq = (row[0] if row else 0) + 1
+        self.db.execute('INSERT OR REPLACE INTO state VALUES (\'seq\', ?)', (seq,))
+        return seq
+
+    def add(self, directories):
+        '''Marks given directories (relative to NEXTCLOUD_DATA) as dirty'''
+        with self.lock, self.db:
+            seq = self.nextSeq()
+            self.db.executemany('INSERT OR REPLACE INTO dirty VALUES (?, ?)',
+                                ((x, seq) for x in directories))
+
+    def requestFullScan(self):
+        '''Requests a full scan on the next backup, e.g. after events were lost'''
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (\'full_scan\', ?)',
+                            (self.nextSeq(),))
+
+    def claim(self):
+        '''Returns (token, full scan needed, dirty directories) for a backup run
+
+        If the daemon never ran, a full scan is needed. token must be passed to release()
+        once the run completed
+        '''
+        with self.lock, self.db:
+            state = dict(self.db.execute('SELECT key, value FROM state'))
+            token = state.get('seq', 0)
+            directories = [x[0] for x in self.db.execute('SELECT dir FROM dirty WHERE seq <= ? '
+                                                         'ORDER BY dir', (token,))]
+
+        return token, 'seq' not in state or 'full_scan' in state, directories
+
+    def release(self, token):
+        '''Removes directories and full scan request claimed with given token'''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM dirty WHERE seq <= ?', (token,))
+            self.db.execute('DELETE FROM state WHERE key = \'full_scan\' AND value <= ?', (token,))
+
+    def close(self):
+        '''Closes database'''
+        self.db.close()
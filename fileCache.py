@@ -0,0 +1,131 @@
+'''Contains FileCache class to find changed directories through Nextcloud's oc_filecache table
+
+Nextcloud records every file and folder it knows about in its file cache table, with the
+modification time propagated to parent folders whenever a file is added, changed, renamed or
+removed. Instead of walking NEXTCLOUD_DATA, a single indexed query returns the entries
+changed since a given time, and their directories are mapped from storage IDs (home::user,
+local::/path/) to paths under the data directory. The directories are then listed and diffed
+against the manifest as usual, so entries with stale metadata are still caught. Database
+settings are read from Nextcloud's config.php. SQLite is supported out of the box, MySQL and
+PostgreSQL need the optional pymysql and psycopg2 packages.
+'''
+
+import os
+import re
+import sqlite3
+
+# matches 'key' => value entries of config.php with a string, number or boolean value
+CONFIG_ENTRY = re.compile(r'\'(\w+)\'\s*=>\s*(\'(?:[^\'\\]|\\.)*\'|-?\d+|true|false)', re.I)
+FOLDER_MIMETYPE = 'httpd/unix-directory'
+
+def readConfig(path):
+    '''Returns dict of top level string, number and boolean entries of config.php at path'''
+    with open(path) as fp:
+        text = fp.read()
+
+    config = {}
+    for key, value in CONFIG_ENTRY.findall(text):
+        if value.startswith('\''):
+            config[key] = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif value.lower() in ('true', 'false'):
+            config[key] = value.lower() == 'true'
+        else:
+            config[key] = int(value)
+
+    return config
+
+def openFileCache(config, dataDir):
+    '''Returns FileCache connected to Nextcloud database described by config
+
+    Raises ImportError if the driver for a MySQL or PostgreSQL database isn't installed, and
+    ValueError for unsupported database types
+    '''
+    dbtype = config.get('dbtype', 'sqlite3')
+    prefix = config.get('dbtableprefix', 'oc_')
+    host, _, port = config.get('dbhost', 'localhost').partition(':')
+    # the port may also be set on its own, a port or socket in dbhost takes precedence
+    port = port or str(config.get('dbport') or '')
+    if dbtype in ('sqlite', 'sqlite3'):
+        path = os.path.join(config.get('datadirectory', dataDir),
+                            config.get('dbname', 'owncloud') + '.db')
+        return FileCache(sqlite3.connect('file:{}?mode=ro'.format(path), uri=True), dataDir, prefix)
+
+    if dbtype == 'mysql':
+        import pymysql
+        options = {'host': host, 'user': config.get('dbuser'), 'password': config.get('dbpassword', ''),
+                   'database': config.get('dbname')}
+        if port.isdigit():
+            options['port'] = int(port)
+        elif port:
+            options['unix_socket'] = port
+
+        return FileCache(pymysql.connect(**options), dataDir, prefix, '%s')
+
+    if dbtype == 'pgsql':
+        import psycopg2
+        return FileCache(psycopg2.connect(host=host, port=port or None, dbname=config.get('dbname'),
+                                          user=config.get('dbuser'),
+                                          password=config.get('dbpassword', '')),
+                         dataDir, prefix, '%s')
+
+    raise ValueError('unsupported database type \'{}\''.format(dbtype))
+
+class FileCache:
+    '''Queries Nextcloud's file cache for directories changed since a given time'''
+    def __init__(self, connection, dataDir, prefix='oc_', placeholder='?'):
+        '''Uses open DB-API connection, mapping storages to paths under dataDir
+
+        placeholder is the parameter marker of the connection's driver
+        '''
+        self.connection = connection
+        self.dataDir = os.path.join(dataDir, '')
+        self.prefix = prefix
+        self.placeholder = placeholder
+
+    def storageRoot(self, storageId):
+        '''Returns root of storage relative to dataDir, or None if it isn't under dataDir'''
+        if storageId.startswith('home::'):
+            return storageId[len('home::'):]
+
+        if storageId.startswith('local::'):
+            path = os.path.join(storageId[len('local::'):], '')
+            if path.startswith(self.dataDir):
+                return path[len(self.dataDir):].strip('/')
+
+        # external and object storages don't keep files in the data directory
+        return None
+
+    def changedDirs(self, since):
+        '''Returns sorted list of directories, relative to dataDir, changed at or after since'''
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(('SELECT s.id, f.path, m.mimetype FROM {0}filecache f '
+                            'JOIN {0}storages s ON f.storage = s.numeric_id '
+                            'JOIN {0}mimetypes m ON f.mimetype = m.id '
+                            'WHERE f.mtime >= {1}').format(self.prefix, self.placeholder),
+                           (int(since),))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        roots = {}
+        directories = set()
+        for storageId, path, mimetype in rows:
+            if storageId not in roots:
+                roots[storageId] = self.storageRoot(storageId)
+
+            root = roots[storageId]
+            if root is None:
+                continue
+
+            # folders are listed themselves, files through their parent folder
+            if mimetype != FOLDER_MIMETYPE:
+                path = os.path.dirname(path)
+
+            directories.add('/'.join(x for x in [root, path] if x))
+
+        return sorted(directories)
+
+    def close(self):
+        '''Closes database connection'''
+        self.connection.close()
@@ -0,0 +1,241 @@
+'''Contains functions used to copy files from Nextcloud data to the backup'''
+
+import os
+import queue
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DELTA_BLOCK_SIZE = 1024 * 1024
+BUFFER_SIZE = 8 * 1024 * 1024
+# ioctl request to share extents between files on btrfs/XFS, from linux/fs.h
+FICLONE = 0x40049409
+# copy backends ordered from cheapest to most expensive
+BACKENDS = ['reflink', 'copy_file_range', 'sendfile', 'buffered']
+# chunk size and number of chunks buffered per destination when copying to several targets
+FAN_OUT_CHUNK_SIZE = 1024 * 1024
+FAN_OUT_DEPTH = 8
+
+def writeAll(fd, data, offset):
+    '''Writes all of data to fd at offset, retrying on short writes'''
+    view = memoryview(data)
+    while view:
+        count = os.pwrite(fd, view, offset)
+        view = view[count:]
+        offset += count
+
+def deltaCopy(src, dst, blockSize=DELTA_BLOCK_SIZE, digest=None):
+    '''Updates existing dst in place so it matches src, returns number of bytes written
+
+    Both files are compared block by block and only blocks that differ are rewritten,
+    so a large file modified in place (VM images, databases) only costs the changed blocks.
+    Since source and backup are both local, blocks are compared directly instead of through
+    rolling checksums. Every block of src is added to hash object digest if given.
+    Raises FileNotFoundError if dst does not exist
+    '''
+    written = 0
+    srcFd = os.open(src, os.O_RDONLY)
+    try:
+        dstFd = os.open(dst, os.O_RDWR)
+        try:
+            size = os.fstat(srcFd).st_size
+            offset = 0
+            while offset < size:
+                block = os.pread(srcFd, blockSize, offset)
+                if not block:
+                    break
+
+                if digest is not None:
+                    digest.update(block)
+
+                if os.pread(dstFd, len(block), offset) != block:
+                    writeAll(dstFd, block, offset)
+                    written += len(block)
+
+                offset += len(block)
+
+            os.ftruncate(dstFd, offset)
+        finally:
+            os.close(dstFd)
+    finally:
+        os.close(srcFd)
+
+    # match metadata given by shutil.copy2
+    shutil.copystat(src, dst)
+    return written
+
+def copyData(srcFd, dstFd, backend, digest=None):
+    '''Copies contents of srcFd to dstFd using given backend, returns number of bytes copied
+
+    Data copied by the buffered backend is also added to hash object digest if given
+    '''
+    if backend == 'reflink':
+        if fcntl is None:
+            raise OSError('reflink is not supported on this platform')
+
+        fcntl.ioctl(dstFd, FICLONE, srcFd)
+        return os.fstat(dstFd).st_size
+
+    copied = 0
+    buf = bytearray(BUFFER_SIZE) if backend == 'buffered' else None
+    while True:
+        if backend == 'copy_file_range':
+            count = os.copy_file_range(srcFd, dstFd, BUFFER_SIZE)
+        elif backend == 'sendfile':
+            count = os.sendfile(dstFd, srcFd, copied, BUFFER_SIZE)
+        elif backend == 'buffered':
+            count = os.readv(srcFd, [buf])
+            writeAll(dstFd, memoryview(buf)[:count], copied)
+            if digest is not None:
+                digest.update(memoryview(buf)[:count])
+        else:
+            raise ValueError('unknown copy backend \'{}\''.format(backend))
+
+        if not count:
+            return copied
+
+        copied += count
+
+def copyFile(src, dst, backend, digest=None):
+    '''Copies src to dst with given backend and copies metadata like shutil.copy2
+
+    If hash object digest is given, data goes through the buffered backend to be added to it
+    in the same pass. Returns number of bytes copied
+    '''
+    if digest is not None:
+        backend = 'buffered'
+
+    srcFd = os.open(src, os.O_RDONLY)
+    try:
+        dstFd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            copied = copyData(srcFd, dstFd, backend, digest)
+        finally:
+            os.close(dstFd)
+    finally:
+        os.close(srcFd)
+
+    shutil.copystat(src, dst)
+    return copied
+
+def probeBackend(src, dst):
+    '''Returns cheapest backend able to copy src to dst correctly, or None
+
+    src and dst should be scratch files on the source and destination filesystems,
+    dst is overwritten by each attempt
+    '''
+    with open(src, 'rb') as fp:
+        expected = fp.read()
+
+    for backend in BACKENDS:
+        if backend == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+            continue
+
+        try:
+            copyFile(src, dst, backend)
+            with open(dst, 'rb') as fp:
+                if fp.read() == expected:
+                    return backend
+        except (OSError, ValueError):
+            continue
+
+    return None
+
+class DestinationWriter:
+    '''Writes chunks of a file to one destination, remembering the first error instead of raising'''
+    def __init__(self, path):
+        '''Creates (or truncates) destination at path'''
+        self.path = path
+        self.error = None
+        self.fp = None
+        try:
+            self.fp = open(path, 'wb')
+        except OSError as e:
+            self.error = e
+
+    def write(self, chunk):
+        '''Writes chunk unless a previous operation failed'''
+        if self.error is None:
+            try:
+                self.fp.write(chunk)
+            except OSError as e:
+                self.error = e
+
+    def finish(self, src):
+        '''Closes destination and copies metadata of src like shutil.copy2'''
+        try:
+            if self.fp is not None:
+                self.fp.close()
+
+            if self.error is None:
+                shutil.copystat(src, self.path)
+        except OSError as e:
+            self.error = self.error or e
+
+    def drain(self, chunks):
+        '''Writes chunks taken from queue until None is received'''
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+
+            self.write(chunk)
+
+def fanOutCopy(src, dsts, chunkSize=FAN_OUT_CHUNK_SIZE, depth=FAN_OUT_DEPTH, digest=None):
+    '''Copies src to every path in dsts reading it only once, returns number of bytes read
+
+    The first destination is written by the calling thread, and every other one by its own
+    thread fed through a queue of at most depth chunks, so a slow destination only holds back
+    the others once its queue is full. Files smaller than one chunk are written to each
+    destination in turn without starting threads. If a destination fails, the others are still
+    completed, then the first error is raised. Chunks are added to hash object digest if given
+    '''
+    writers = [DestinationWriter(x) for x in dsts]
+    queues = []
+    threads = []
+    size = 0
+    try:
+        with open(src, 'rb') as fp:
+            chunk = fp.read(chunkSize)
+            if len(chunk) == chunkSize:
+                queues = [queue.Queue(depth) for _ in writers[1:]]
+                threads = [threading.Thread(target=writer.drain, args=(chunks,))
+                           for writer, chunks in zip(writers[1:], queues)]
+                for thread in threads:
+                    thread.start()
+
+            while chunk:
+                size += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+
+                for chunks in queues:
+                    chunks.put(chunk)
+
+                for writer in writers[:1] if queues else writers:
+                    writer.write(chunk)
+
+                chunk = fp.read(chunkSize)
+    except OSError as e:
+        # don't give partial copies the metadata of src
+        for writer in writers:
+            writer.error = writer.error or e
+    finally:
+        for chunks in queues:
+            chunks.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        for writer in writers:
+            writer.finish(src)
+
+    for writer in writers:
+        if writer.error is not None:
+            raise writer.error
+
+    return size
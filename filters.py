@@ -0,0 +1,171 @@
+'''Contains Filters class to decide which files and directories are backed up
+
+Rules are read from a filters file, one per line, using gitignore syntax:
+
+    # comment
+    appdata_*/preview/      exclude preview directories of every app data folder
+    /updater-*              exclude updater backups at the top of the data directory
+    *.log                   exclude log files in any directory
+    !nextcloud.log          but keep this one
+
+Patterns containing a slash (other than a trailing one) are anchored to the data directory,
+others match a name at any depth. * and ? don't match slashes, ** matches any number of
+directories and a trailing slash only matches directories. When several patterns match, the
+last one wins, and since excluded directories are never descended into, files inside them
+can't be included again. Files can also be filtered by size and age:
+
+    max-size 4G             exclude files larger than 4 GiB
+    max-size 50M *.iso      exclude ISO images larger than 50 MiB
+    min-age 10m             exclude files modified in the last 10 minutes
+
+Sizes take a K, M, G or T suffix and ages an s, m, h or d suffix. All patterns are compiled
+once into a single regular expression for files and one for directories, with alternatives in
+reverse order so the first alternative matching is the last rule.
+'''
+
+import re
+import time
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+AGE_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+LIMITS = ['max-size', 'min-size', 'max-age', 'min-age']
+
+def translate(pattern):
+    '''Returns regular expression matching paths relative to the data directory for a
+    gitignore-style pattern without trailing slash
+    '''
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+
+            out.append('[' + chars.replace('\\', '\\\\') + ']')
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+
+    return ('' if anchored else '(?:.*/)?') + ''.join(out)
+
+def parseSize(text):
+    '''Returns number of bytes given as a number with an optional K, M, G or T suffix'''
+    match = re.fullmatch(r'(\d+)([KMGT]?)B?', text.upper())
+    if match is None:
+        raise ValueError('invalid size \'{}\''.format(text))
+
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def parseAge(text):
+    '''Returns number of seconds given as a number with an optional s, m, h or d suffix'''
+    match = re.fullmatch(r'(\d+)([smhd]?)', text)
+    if match is None:
+        raise ValueError('invalid age \'{}\''.format(text))
+
+    return int(match.group(1)) * AGE_UNITS[match.group(2)]
+
+class Filters:
+    '''Compiled include/exclude rules and size/age limits'''
+    def __init__(self, lines=()):
+        '''Compiles given rule lines, raises ValueError for invalid ones'''
+        # (regex, exclude, directories only) in file order
+        rules = []
+        # (kind, value, regex or None)
+        self.limits = []
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            fields = line.split(None, 2)
+            if fields[0] in LIMITS:
+                if len(fields) < 2:
+                    raise ValueError('line {}: missing value of {}'.format(number, fields[0]))
+
+                parse = parseSize if fields[0].endswith('size') else parseAge
+                regex = re.compile(translate(fields[2].rstrip('/'))) if len(fields) > 2 else None
+                self.limits.append((fields[0], parse(fields[1]), regex))
+                continue
+
+            exclude = not line.startswith('!')
+            pattern = line if exclude else line[1:]
+            rules.append((translate(pattern.rstrip('/')), exclude, pattern.endswith('/')))
+
+        self.fileRules = [x for x in rules if not x[2]]
+        self.dirRules = rules
+        self.fileMatcher = self.compile(self.fileRules)
+        self.dirMatcher = self.compile(self.dirRules)
+
+    @staticmethod
+    def compile(rules):
+        '''Returns regex with one named group per rule, last rule first, or None if no rules'''
+        if not rules:
+            return None
+
+        return re.compile('|'.join('(?P<r{}>{})'.format(i, x[0])
+                                   for i, x in reversed(list(enumerate(rules)))))
+
+    @classmethod
+    def read(cls, path, extra=()):
+        '''Returns Filters compiled from extra rule lines followed by those of file at path'''
+        with open(path) as fp:
+            return cls(list(extra) + fp.readlines())
+
+    @staticmethod
+    def matches(matcher, rules, relPath):
+        '''Returns True if last rule matching relPath excludes it'''
+        if matcher is None:
+            return False
+
+        match = matcher.fullmatch(relPath)
+        return match is not None and rules[int(match.lastgroup[1:])][1]
+
+    def excludesDir(self, relPath):
+        '''Returns True if directory at relPath (relative to the data directory) is excluded'''
+        return self.matches(self.dirMatcher, self.dirRules, relPath)
+
+    def excludesFile(self, relPath):
+        '''Returns True if file at relPath is excluded by a pattern'''
+        return self.matches(self.fileMatcher, self.fileRules, relPath)
+
+    def excludesTree(self, relPath):
+        '''Returns True if directory at relPath or one of its parents is excluded'''
+        parts = relPath.split('/') if relPath else []
+        return any(self.excludesDir('/'.join(parts[:i])) for i in range(1, len(parts) + 1))
+
+    def exceedsLimits(self, relPath, stat, now=None):
+        '''Returns True if file at relPath with given stat result is excluded by a size or
+        age limit
+        '''
+        if not self.limits:
+            return False
+
+        age = (now if now is not None else time.time()) - stat.st_mtime
+        for kind, value, regex in self.limits:
+            if regex is not None and not regex.fullmatch(relPath):
+                continue
+
+            if (kind == 'max-size' and stat.st_size > value or
+                    kind == 'min-size' and stat.st_size < value or
+                    kind == 'max-age' and age > value or
+                    kind == 'min-age' and age < value):
+                return True
+
+        return False
@@ -0,0 +1,170 @@
+'''Contains Freeze class to back up a read-only point in time view of the data directory
+
+Walking and copying a large data directory takes long enough for files to change midway, which
+leaves torn copies in the backup. Instead, the filesystem holding the data directory can be
+snapshotted at the start of the run and the backup read from the snapshot:
+
+    lvm     'lvcreate --snapshot' of the logical volume, mounted read-only at a fixed mount point
+    btrfs   read-only 'btrfs subvolume snapshot' of the subvolume holding the directory, next to
+            the mounted root or in the snapshot mount point if the same filesystem is mounted there
+    zfs     'zfs snapshot' of the dataset, read through its .zfs/snapshot directory
+
+The filesystem is found by looking up the data directory in /proc/self/mountinfo, so the path
+of the data directory inside the snapshot is known. A btrfs snapshot doesn't include nested
+subvolumes, and mountinfo only lists mounted ones, so the subvolume actually holding the data
+directory is found by walking up to the first directory with the inode number btrfs gives
+subvolume roots. Snapshots have a fixed name, so one left
+behind by an interrupted run is removed before a new one is taken. A snapshot is never created
+inside the directory itself, where Nextcloud, the change tracking daemon and later backups
+would see a second copy of all the data.
+'''
+
+import datetime
+import os
+import devices
+
+METHODS = ['lvm', 'btrfs', 'zfs']
+SNAPSHOT_NAME = 'nextcloud_backup'
+# space reserved for blocks changed while an LVM snapshot exists
+LVM_SNAPSHOT_SIZE = '10%ORIGIN'
+MS_RDONLY = 1
+# inode number of the root directory of every btrfs subvolume
+BTRFS_SUBVOLUME_INO = 256
+
+def findMount(path, mountinfo=None):
+    '''Returns devices.Mount of the filesystem holding path'''
+    path = os.path.realpath(path)
+    best = None
+    for entry in devices.mounts(mountinfo):
+        prefix = entry.mountPoint.rstrip('/') + '/'
+        # later mounts hide earlier ones at the same mount point
+        if ((path + '/').startswith(prefix) and
+                (best is None or len(entry.mountPoint) >= len(best.mountPoint))):
+            best = entry
+
+    if best is None:
+        raise OSError('no filesystem found holding \'{}\''.format(path))
+
+    return best
+
+def findSubvolume(path, mountPoint):
+    '''Returns root of the btrfs subvolume holding path, mountPoint or a subvolume nested below it'''
+    path = os.path.realpath(path)
+    mountPoint = os.path.realpath(mountPoint)
+    while path != mountPoint and os.path.dirname(path) != path:
+        if os.stat(path).st_ino == BTRFS_SUBVOLUME_INO:
+            return path
+
+        path = os.path.dirname(path)
+
+    return mountPoint
+
+class Freeze:
+    '''Snapshot of the filesystem holding a directory'''
+    def __init__(self, method, directory, run, mountPoint, mountinfo=None):
+        '''Prepares snapshot of directory with method ('lvm', 'btrfs' or 'zfs')
+
+        run(command) runs a shell command and returns its output, mountPoint is where LVM
+        snapshots are mounted
+        '''
+        self.method = method
+        self.directory = directory
+        self.run = run
+        self.snapshotMount = mountPoint
+        self.mount = findMount(directory, mountinfo)
+        if method != self.mount.fsType and method != 'lvm':
+            raise OSError('\'{}\' is on a {} filesystem, not {}'
+                          .format(directory, self.mount.fsType, method))
+
+        # snapshots of the mounted root would miss a nested subvolume holding the directory
+        self.root = self.mount.mountPoint
+        if method == 'btrfs':
+            self.root = findSubvolume(directory, self.mount.mountPoint)
+
+        # btrfs snapshots must be on the same filesystem, next to the mounted root by default
+        self.btrfsView = os.path.join(self.mount.mountPoint, '.' + SNAPSHOT_NAME)
+        if method == 'btrfs':
+            other = findMount(mountPoint, mountinfo)
+            if other.fsType == 'btrfs' and other.source == self.mount.source:
+                self.btrfsView = os.path.join(mountPoint, SNAPSHOT_NAME)
+
+        # .zfs is hidden from directory listings, so only ZFS snapshots may be inside
+        view = os.path.realpath(self.view())
+        if method != 'zfs' and (view + '/').startswith(os.path.realpath(directory).rstrip('/') + '/'):
+            raise OSError('snapshot \'{}\' would be inside \'{}\', mount the {} filesystem '
+                          'at \'{}\' to take snapshots there'
+                          .format(view, directory, method, mountPoint))
+
+        self.time = None
+        self.created = False
+        self.mounted = False
+        self.lvmDevice = None
+
+    def view(self):
+        '''Returns directory the snapshot of the whole filesystem or subvolume is visible at'''
+        if self.method == 'lvm':
+            return self.snapshotMount
+        elif self.method == 'btrfs':
+            return self.btrfsView
+
+        return os.path.join(self.mount.mountPoint, '.zfs', 'snapshot', SNAPSHOT_NAME)
+
+    def path(self):
+        '''Returns path of directory inside the snapshot, with a trailing slash'''
+        relPath = os.path.relpath(os.path.realpath(self.directory), self.root)
+        return os.path.join(self.view(), '' if relPath == '.' else relPath, '')
+
+    def create(self):
+        '''Takes snapshot, removing one left behind by an interrupted run, and returns path()
+
+        The time the snapshot is taken at is stored in self.time
+        '''
+        if self.method == 'lvm':
+            group = self.run('lvs --noheadings -o vg_name {}'.format(self.mount.source)).strip()
+            self.lvmDevice = '/dev/{}/{}'.format(group, SNAPSHOT_NAME)
+
+        self.release(force=True)
+        self.time = datetime.datetime.now()
+        if self.method == 'lvm':
+            self.run('lvcreate --snapshot --extents {} --name {} {}'
+                     .format(LVM_SNAPSHOT_SIZE, SNAPSHOT_NAME, self.mount.source))
+            self.created = True
+            os.makedirs(self.snapshotMount, exist_ok=True)
+            # XFS refuses to mount a second filesystem with the same UUID
+            options = 'nouuid' if self.mount.fsType == 'xfs' else ''
+            try:
+                devices.mount(self.lvmDevice, self.snapshotMount, self.mount.fsType, MS_RDONLY,
+                              options)
+            except OSError:
+                self.run('mount -o ro{} {} {}'.format(',' + options if options else '',
+                                                      self.lvmDevice, self.snapshotMount))
+
+            self.mounted = True
+        elif self.method == 'btrfs':
+            self.run('btrfs subvolume snapshot -r {} {}'.format(self.root, self.view()))
+            self.created = True
+        else:
+            self.run('zfs snapshot {}@{}'.format(self.mount.source, SNAPSHOT_NAME))
+            self.created = True
+
+        return self.path()
+
+    def release(self, force=False):
+        '''Removes snapshot taken by create(), or any existing one with the same name if force'''
+        if self.method == 'lvm':
+            if self.mounted or (force and os.path.ismount(self.snapshotMount)):
+                try:
+                    devices.umount(self.snapshotMount)
+                except OSError:
+                    self.run('umount {}'.format(self.snapshotMount))
+
+            if self.created or (force and os.path.exists(self.lvmDevice)):
+                self.run('lvremove --force {}'.format(self.lvmDevice))
+        elif self.created or (force and os.path.isdir(self.view())):
+            if self.method == 'btrfs':
+                self.run('btrfs subvolume delete {}'.format(self.view()))
+            else:
+                self.run('zfs destroy {}@{}'.format(self.mount.source, SNAPSHOT_NAME))
+
+        self.mounted = False
+        self.created = False
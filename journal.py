@@ -0,0 +1,129 @@
+'''Contains RunJournal class to record progress of a backup run so it can be resumed
+
+The journal is an append-only file of JSON lines stored next to the backup logs. During a run
+it records the output mode, every file queued for backup, every file backed up (with the stat
+result recorded in the manifest), every file that errored and every directory whose files were
+all diffed against the manifest. Writes are buffered and synced to disk in batches, so the
+journal doesn't become the bottleneck when backing up many small files. Once a run completes,
+the journal is emptied. If a run is interrupted, the next run reads the journal to replay
+backed up files into the manifest, retry queued files first and skip directories already
+scanned, instead of rescanning everything and copying completed files again.
+'''
+
+import json
+import os
+import threading
+import time
+
+class JournalState:
+    '''Progress of an interrupted run recovered from the journal'''
+    def __init__(self):
+        '''Creates empty state'''
+        self.mode = None
+        # insertion ordered dict used as ordered set of files still to back up
+        self.pending = {}
+        self.scanned = set()
+        # (path, size, mtime_ns, inode, digest) of files backed up
+        self.done = []
+
+class RunJournal:
+    '''Append-only, batch synced journal of a backup run'''
+    SYNC_BATCH = 512
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, path):
+        '''Uses journal at given path, it is only opened for writing by open()'''
+        self.path = path
+        self.lock = threading.Lock()
+        self.fp = None
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+        # sync functions of outputs that must be on disk before the journal records their files
+        self.syncFirst = []
+
+    def recover(self):
+        '''Returns JournalState of interrupted run, or None if last run completed'''
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return None
+
+        state = JournalState()
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may have been cut short by a crash
+                    continue
+
+                kind = record[0]
+                if kind == 'run':
+                    state.mode = record[1]
+                elif kind in ('queued', 'errored'):
+                    state.pending[record[1]] = None
+                elif kind == 'done':
+                    state.pending.pop(record[1], None)
+                    state.done.append(tuple(record[1:]))
+                elif kind == 'scanned':
+                    state.scanned.add(record[1])
+
+        return state
+
+    def open(self, mode):
+        '''Opens journal for appending, recording output mode if journal is empty'''
+        self.fp = open(self.path, 'a')
+        if self.fp.tell() == 0:
+            self.append(['run', mode])
+
+    def append(self, record):
+        '''Appends record to journal, syncing to disk once enough records are buffered'''
+        with self.lock:
+            self.fp.write(json.dumps(record) + '\n')
+            self.unsynced += 1
+            if (self.unsynced >= self.SYNC_BATCH or
+                    time.monotonic() - self.lastSync >= self.SYNC_INTERVAL):
+                self._sync()
+
+    def queued(self, path):
+        '''Records that path was queued for backup'''
+        self.append(['queued', path])
+
+    def done(self, path, stat, digest=None):
+        '''Records that path was backed up'''
+        self.append(['done', path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest])
+
+    def errored(self, path):
+        '''Records that path could not be backed up'''
+        self.append(['errored', path])
+
+    def scanned(self, directory):
+        '''Records that every file of directory was diffed against the manifest'''
+        self.append(['scanned', directory])
+
+    def sync(self):
+        '''Writes buffered records to disk'''
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        '''Writes buffered records to disk, caller must hold self.lock'''
+        for sync in self.syncFirst:
+            sync()
+
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def complete(self):
+        '''Empties journal once run completed'''
+        with self.lock:
+            self.fp.seek(0)
+            self.fp.truncate(0)
+            self._sync()
+
+    def close(self):
+        '''Syncs and closes journal'''
+        if self.fp is not None:
+            self.sync()
+            self.fp.close()
+            self.fp = None
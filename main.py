@@ -9,6 +9,54 @@ def main():
     parser = argparse.ArgumentParser(description='script to perform incremental backups using NextcloudBackup class')
     parser.add_argument('--verbose', default=False, help='increases verbosity', action='store_true')
     parser.add_argument('--dry-run', default=False, help='run script without copying files, implies --verbose', action='store_true')
+    parser.add_argument('--delta', default=False, help='only rewrite changed blocks of large files already in backup', action='store_true')
+    parser.add_argument('--output', default='mirror', choices=NextcloudBackup.OUTPUT_MODES,
+                        help=('mirror: copy files to backup as is, store: keep one copy of each unique file and hardlink duplicates to it, '
+                              'snapshot: create a dated snapshot for each run, hardlinking unchanged files to the previous snapshot, '
+                              'archive: write changed files to compressed archive volumes'))
+    parser.add_argument('--keep-snapshots', default=7, type=int, metavar='N', help='number of snapshots to keep in snapshot output mode')
+    parser.add_argument('--volume-size', default=1024, type=int, metavar='MB', help='size of archive volumes in MiB in archive output mode')
+    parser.add_argument('--prometheus', default='', metavar='PATH', help='also write run metrics to PATH in the Prometheus textfile format')
+    parser.add_argument('--changes', default='scan', choices=NextcloudBackup.CHANGE_SOURCES,
+                        help=('scan: walk the data directory to find changed files, '
+                              'watch: only list directories recorded by watchDaemon.py, '
+                              'filecache: only list directories changed in Nextcloud\'s file cache'))
+    parser.add_argument('--reconcile-days', default=7, type=int, metavar='N',
+                        help='walk the whole data directory at least every N days when not using --changes scan')
+    parser.add_argument('--sync', default=False, action='store_true',
+                        help='also remove files removed from the data directory from the backup, and rename renamed files in it')
+    parser.add_argument('--trash-days', default=30, type=int, metavar='N',
+                        help='keep files removed by --sync in the backup trash for N days, 0 deletes them right away')
+    parser.add_argument('--target', dest='targets', default=[], action='append', metavar='PATH[=DEVICE]',
+                        help=('also write changed files to backup mounted at PATH in mirror output mode, mounting DEVICE there '
+                              'if given, can be repeated'))
+    parser.add_argument('--max-rate', default=0.0, type=float, metavar='MB', help='copy at most MB MiB per second, 0 is unlimited')
+    parser.add_argument('--max-files', default=0.0, type=float, metavar='N', help='copy at most N files per second, 0 is unlimited')
+    parser.add_argument('--max-latency', default=0.0, type=float, metavar='MS',
+                        help='slow down copying while requests to the data disk take more than MS milliseconds on average, 0 disables it')
+    parser.add_argument('--ionice', default='none', choices=NextcloudBackup.IO_PRIORITIES,
+                        help='I/O scheduling class to run the backup with, like ionice')
+    parser.add_argument('--drop-cache', default=False, action='store_true',
+                        help='drop copied files from the page cache so the backup doesn\'t evict files used by Nextcloud')
+    parser.add_argument('--checksum', default=False, action='store_true',
+                        help='compute the checksum of copied files while copying them and record it in the manifest')
+    parser.add_argument('--scrub', default=False, action='store_true',
+                        help='instead of backing up, verify backed up files against their recorded checksums and re-queue corrupted ones')
+    parser.add_argument('--restore', default=[], action='append', metavar='PATTERN',
+                        help=('instead of backing up, restore files matching PATTERN, a user, a path or a glob relative to the data '
+                              'directory, can be repeated'))
+    parser.add_argument('--restore-to', default='', metavar='DIR', help='restore files to DIR instead of the data directory')
+    parser.add_argument('--pack-size', default=0, type=int, metavar='KB',
+                        help='pack files smaller than KB KiB into bundles instead of copying them one by one in mirror output mode')
+    parser.add_argument('--filters', default='', metavar='PATH',
+                        help='read include/exclude rules from PATH instead of {}'.format(NextcloudBackup.NEXTCLOUD_BACKUP_FILTERS))
+    parser.add_argument('--scan-jobs', default=1, type=int, metavar='N',
+                        help='list up to N directories per device concurrently when scanning the whole data directory')
+    parser.add_argument('--freeze', default='none', choices=NextcloudBackup.FREEZE_METHODS,
+                        help='back up a snapshot of the data filesystem taken at the start of the run, or keep Nextcloud in maintenance mode until the backup is done')
+    parser.add_argument('--quiesce', action='store_true',
+                        help='enable maintenance mode while the snapshot is taken')
+    parser.add_argument('--jobs', default=1, type=int, metavar='N', help='number of files to copy concurrently')
 
     with NextcloudBackup(parser.parse_args()) as backup:
         backup.main()
@@ -0,0 +1,210 @@
+'''Contains Manifest class to persist the state of backed up files between runs
+
+The manifest is an SQLite database stored next to the backup logs that records the
+size, modification time (in nanoseconds), inode and, if known, content digest of every
+file that has been backed up.
+Rows are keyed by directory and file name relative to NEXTCLOUD_DATA so that a single
+indexed query returns everything known about one directory, which allows a directory
+listing to be diffed against the manifest without holding the whole index in memory.
+A small state table records timestamps of past runs, such as the last full scan.
+'''
+
+import sqlite3
+import threading
+
+class Manifest:
+    '''SQLite backed index of backed up files'''
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS files ('
+              'dir TEXT NOT NULL, '
+              'name TEXT NOT NULL, '
+              'size INTEGER NOT NULL, '
+              'mtime_ns INTEGER NOT NULL, '
+              'inode INTEGER NOT NULL, '
+              'digest TEXT, '
+              'PRIMARY KEY (dir, name)) WITHOUT ROWID')
+    STATE_SCHEMA = 'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value REAL NOT NULL)'
+    INDEXES = ['CREATE INDEX IF NOT EXISTS files_inode ON files (inode)']
+    BATCH_SIZE = 1000
+    # sorts after any path component, used as upper bound of directory subtrees
+    MAX_CHAR = '\U0010ffff'
+
+    def __init__(self, path):
+        '''Opens (or creates) manifest database at path'''
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(self.SCHEMA)
+        self.db.execute(self.STATE_SCHEMA)
+
+        # manifests created by older versions have no digest column
+        columns = [x[1] for x in self.db.execute('PRAGMA table_info(files)')]
+        if 'digest' not in columns:
+            self.db.execute('ALTER TABLE files ADD COLUMN digest TEXT')
+
+        for index in self.INDEXES:
+            self.db.execute(index)
+
+        self.db.commit()
+
+        # pending writes are batched to avoid one transaction per file
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pendingRemovals = []
+
+        # flush functions of indexes that must be written before the manifest, so it never
+        # lists a file they don't
+        self.flushFirst = []
+
+    def lookupDir(self, directory):
+        '''Returns dict mapping file name to (size, mtime_ns, inode) for given directory'''
+        with self.lock:
+            rows = self.db.execute('SELECT name, size, mtime_ns, inode FROM files WHERE dir = ?',
+                                   (directory,)).fetchall()
+
+        return {name: (size, mtime, inode) for name, size, mtime, inode in rows}
+
+    def hasDir(self, directory):
+        '''Returns True if any file of given directory was backed up'''
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM files WHERE dir = ? LIMIT 1',
+                                   (directory,)).fetchone() is not None
+
+    def childDirs(self, directory):
+        '''Returns set of names of subdirectories of directory containing backed up files
+
+        Skips over the subtree of each child found, so only one indexed query is needed per child
+        '''
+        prefix = directory + '/' if directory else ''
+        children = set()
+        cursor = prefix
+        with self.lock:
+            while True:
+                row = self.db.execute('SELECT dir FROM files WHERE dir > ? AND dir < ? ORDER BY dir '
+                                      'LIMIT 1', (cursor, prefix + self.MAX_CHAR)).fetchone()
+                if row is None:
+                    return children
+
+                child = row[0][len(prefix):].split('/')[0]
+                children.add(child)
+                # siblings such as 'a.b' sort between 'a' and 'a/x', so only skip once inside
+                # the child's subtree
+                cursor = row[0] if row[0] == prefix + child else prefix + child + '/' + self.MAX_CHAR
+
+    def findMoved(self, stat):
+        '''Returns list of (directory, name, digest) of files with same inode, size and mtime as stat'''
+        with self.lock:
+            return self.db.execute('SELECT dir, name, digest FROM files WHERE inode = ? AND size = ? '
+                                   'AND mtime_ns = ?',
+                                   (stat.st_ino, stat.st_size, stat.st_mtime_ns)).fetchall()
+
+    def findDigest(self, stat):
+        '''Returns known digest of file with same inode, size and mtime as stat, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM files WHERE inode = ? AND size = ? AND '
+                                  'mtime_ns = ? AND digest IS NOT NULL LIMIT 1',
+                                  (stat.st_ino, stat.st_size, stat.st_mtime_ns)).fetchone()
+
+        return row[0] if row else None
+
+    def lookupDigest(self, directory, name):
+        '''Returns digest of file name in directory, or None if it isn't known'''
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM files WHERE dir = ? AND name = ?',
+                                  (directory, name)).fetchone()
+
+        return row[0] if row else None
+
+    def treeDigests(self, directory):
+        '''Returns set of known digests of files of directory and its subdirectories'''
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT digest FROM files WHERE (dir = ? OR '
+                                   '(dir > ? AND dir < ?)) AND digest IS NOT NULL',
+                                   (directory, directory + '/',
+                                    directory + '/' + self.MAX_CHAR)).fetchall()
+
+        return {x[0] for x in rows}
+
+    def digests(self, after=None, limit=BATCH_SIZE):
+        '''Returns up to limit (directory, name, digest) rows with a known digest, in key order
+        starting after (directory, name) key after
+        '''
+        directory, name = after or ('', '')
+        with self.lock:
+            return self.db.execute('SELECT dir, name, digest FROM files WHERE (dir > ? OR '
+                                   '(dir = ? AND name > ?)) AND digest IS NOT NULL '
+                                   'ORDER BY dir, name LIMIT ?',
+                                   (directory, directory, name, limit)).fetchall()
+
+    def record(self, directory, name, stat, digest=None):
+        '''Queues state of given file to be written to manifest'''
+        with self.lock:
+            self.pending.append((directory, name, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                                 digest))
+            if len(self.pending) >= self.BATCH_SIZE:
+                self._flush()
+
+    def remove(self, directory, name):
+        '''Queues given file to be removed from manifest'''
+        with self.lock:
+            self.pendingRemovals.append((directory, name))
+            if len(self.pendingRemovals) >= self.BATCH_SIZE:
+                self._flush()
+
+    def removeTree(self, directory):
+        '''Removes every file of directory and its subdirectories from manifest'''
+        with self.lock:
+            self._flush()
+            self.db.execute('DELETE FROM files WHERE dir = ? OR (dir > ? AND dir < ?)',
+                            (directory, directory + '/', directory + '/' + self.MAX_CHAR))
+            self.db.commit()
+
+    def flush(self):
+        '''Writes all queued records to manifest'''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        '''Writes queued records, caller must hold self.lock'''
+        if not self.pending and not self.pendingRemovals:
+            return
+
+        for flush in self.flushFirst:
+            flush()
+
+        self.db.executemany('DELETE FROM files WHERE dir = ? AND name = ?', self.pendingRemovals)
+        self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', self.pending)
+        self.db.commit()
+        self.pending = []
+        self.pendingRemovals = []
+
+    def clear(self):
+        '''Forgets every backed up file and the state of past runs'''
+        with self.lock:
+            self.pending = []
+            self.pendingRemovals = []
+            self.db.execute('DELETE FROM files')
+            self.db.execute('DELETE FROM state')
+            self.db.commit()
+
+    def getState(self, key):
+        '''Returns value stored under key in state table, or None'''
+        with self.lock:
+            row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def setState(self, key, value):
+        '''Stores value under key in state table'''
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+            self.db.commit()
+
+    def close(self):
+        '''Flushes queued records and closes database'''
+        self.flush()
+        self.db.close()
+
+    @staticmethod
+    def isChanged(known, stat):
+        '''Returns True if stat differs from manifest entry known, or if known is None'''
+        return known is None or known != (stat.st_size, stat.st_mtime_ns, stat.st_ino)
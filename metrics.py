@@ -0,0 +1,142 @@
+'''Contains RunMetrics class to collect timings and counters of a backup run
+
+A run records named timing spans (e.g. mounting, scanning, unmounting), counters (files
+scanned, files copied, bytes, errors) and latency histograms (per-file stat and copy
+latency). The summary can be written as JSON and in the Prometheus textfile collector format,
+so alerts can be raised when backup windows grow.
+'''
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+# upper bounds of histogram buckets in seconds
+HISTOGRAM_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+PROMETHEUS_PREFIX = 'nextcloud_backup_'
+
+class Histogram:
+    '''Latency histogram with fixed buckets'''
+    def __init__(self):
+        '''Creates empty histogram'''
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        '''Adds value in seconds to histogram'''
+        index = 0
+        while index < len(HISTOGRAM_BUCKETS) and value > HISTOGRAM_BUCKETS[index]:
+            index += 1
+
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        '''Returns list of (upper bound, cumulative count) including +Inf bucket'''
+        total = 0
+        out = []
+        for bound, count in zip(HISTOGRAM_BUCKETS + [float('inf')], self.counts):
+            total += count
+            out.append((bound, total))
+
+        return out
+
+class RunMetrics:
+    '''Thread safe collection of spans, counters and histograms for one run'''
+    def __init__(self):
+        '''Starts collecting metrics'''
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now()
+        self.spans = {}
+        self.counters = {}
+        self.histograms = {}
+        self.info = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        '''Context manager adding time spent inside it to span with given name'''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.addSpan(name, time.monotonic() - start)
+
+    def addSpan(self, name, seconds):
+        '''Adds seconds to span with given name'''
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def increment(self, name, value=1):
+        '''Adds value to counter with given name'''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        '''Adds latency in seconds to histogram with given name'''
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+
+            self.histograms[name].observe(value)
+
+    def summary(self):
+        '''Returns dict summarizing the run'''
+        with self.lock:
+            return {
+                'started': self.started.isoformat(),
+                'finished': datetime.datetime.now().isoformat(),
+                'info': dict(self.info),
+                'spans': {name: round(value, 6) for name, value in self.spans.items()},
+                'counters': dict(self.counters),
+                'histograms': {name: {'count': hist.count,
+                                      'sum': round(hist.sum, 6),
+                                      'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                                                  for bound, count in hist.cumulative()]}
+                               for name, hist in self.histograms.items()}
+            }
+
+    def prometheus(self):
+        '''Returns metrics in the Prometheus text exposition format'''
+        summary = self.summary()
+        lines = []
+        lines.append('# TYPE {}last_run_timestamp_seconds gauge'.format(PROMETHEUS_PREFIX))
+        lines.append('{}last_run_timestamp_seconds {}'.format(PROMETHEUS_PREFIX, time.time()))
+
+        lines.append('# TYPE {}span_seconds gauge'.format(PROMETHEUS_PREFIX))
+        for name, value in sorted(summary['spans'].items()):
+            lines.append('{}span_seconds{{span="{}"}} {}'.format(PROMETHEUS_PREFIX, name, value))
+
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('# TYPE {}{} gauge'.format(PROMETHEUS_PREFIX, name))
+            lines.append('{}{} {}'.format(PROMETHEUS_PREFIX, name, value))
+
+        for name, hist in sorted(summary['histograms'].items()):
+            metric = '{}{}_seconds'.format(PROMETHEUS_PREFIX, name)
+            lines.append('# TYPE {} histogram'.format(metric))
+            for bound, count in hist['buckets']:
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, count))
+
+            lines.append('{}_sum {}'.format(metric, hist['sum']))
+            lines.append('{}_count {}'.format(metric, hist['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, jsonPath, prometheusPath=None):
+        '''Writes summary as JSON to jsonPath, and in Prometheus format to prometheusPath if given
+
+        Files are replaced atomically so collectors never read partial files
+        '''
+        outputs = [(jsonPath, json.dumps(self.summary(), indent=2) + '\n')]
+        if prometheusPath:
+            outputs.append((prometheusPath, self.prometheus()))
+
+        for path, content in outputs:
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as fp:
+                fp.write(content)
+
+            os.replace(tmp, path)
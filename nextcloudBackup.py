@@ -13,6 +13,32 @@ import sys
 import shutil
 import subprocess
 import argparse
+import collections
+import concurrent.futures
+import threading
+import queue
+import time
+import types
+from manifest import Manifest
+from contentStore import ContentStore, HASH, hashFile
+from snapshots import SnapshotSet
+from archive import ArchiveWriter
+from metrics import RunMetrics
+from journal import RunJournal
+from dirtySet import DirtySet
+from bundles import BundleStore
+import fileCopy
+import fileCache
+import devices
+import throttle
+import scrub
+import restore
+import shardScan
+from filters import Filters
+import freeze
+
+# backup destination: mount point and partition mounted there, None if mounted by the system
+BackupTarget = collections.namedtuple('BackupTarget', ['root', 'partition'])
 
 class Singleton(type):
     '''Metaclass to ensure only one instance of cls exists at a time'''
@@ -30,23 +56,148 @@ class NextcloudBackup(metaclass=Singleton):
     NEXTCLOUD_BACKUP_LOG = '/var/log/nextcloud/backups/backups.log'
     NEXTCLOUD_BACKUP_ERROR_LOG = '/var/log/nextcloud/backups/error.log'
     NEXTCLOUD_ERRORED_FILES_LOG = '/var/log/nextcloud/backups/errored_files.log'
+    NEXTCLOUD_BACKUP_MANIFEST = '/var/log/nextcloud/backups/manifest.db'
+    NEXTCLOUD_ARCHIVE_MANIFEST = '/var/log/nextcloud/backups/archive_manifest.db'
+    NEXTCLOUD_BACKUP_METRICS = '/var/log/nextcloud/backups/metrics.json'
+    NEXTCLOUD_BACKUP_JOURNAL = '/var/log/nextcloud/backups/journal.log'
+    NEXTCLOUD_BACKUP_DIRTY = '/var/log/nextcloud/backups/dirty.db'
+    NEXTCLOUD_BACKUP_SCRUB = '/var/log/nextcloud/backups/scrub.json'
     NEXTCLOUD_DATA = '/var/www/nextcloud/data/'
+    NEXTCLOUD_CONFIG = '/var/www/nextcloud/config/config.php'
+    NEXTCLOUD_BACKUP_FILTERS = '/etc/nextcloud/backup_filters'
     NEXTCLOUD_DATA_BACKUP = '/mnt/nextcloud_backup/'
     NEXTCLOUD_BACKUP_PARTITION = '/dev/sdc1'
+    # occ command run as the web server user, and where LVM snapshots of the data are mounted
+    NEXTCLOUD_OCC = 'sudo -u www-data php /var/www/nextcloud/occ'
+    NEXTCLOUD_SNAPSHOT_MOUNT = '/mnt/nextcloud_snapshot/'
+    # file types never backed up, on top of the rules of the filters file
     IGNORED_FILE_TYPES = ['part']
     OLD_DUMMY_DATE = 'Tue Jan 29 19:37:23 2000\n'
+    # scratch file used to probe copy capabilities between data and backup filesystems, copied
+    # from an existing file of at most COPY_PROBE_SIZE bytes found in the first COPY_PROBE_DIRS
+    # directories of NEXTCLOUD_DATA
+    COPY_PROBE_FILE = '.nextcloud_backup_probe'
+    COPY_PROBE_SIZE = 64 * 1024
+    COPY_PROBE_DIRS = 100
+    # files at least this large are copied by a smaller pool of workers when --jobs > 1
+    LARGE_FILE_SIZE = 8 * 1024 * 1024
+    LARGE_FILE_JOBS_DIVISOR = 4
+    # maximum number of changed files waiting to be copied
+    QUEUE_SIZE = 1000
+    # optional command line arguments and their default values
+    OPTIONAL_ARGS = {'jobs': 1, 'delta': False, 'output': 'mirror', 'keep_snapshots': 7,
+                     'volume_size': 1024, 'prometheus': '', 'changes': 'scan', 'reconcile_days': 7,
+                     'sync': False, 'trash_days': 30,
+                     'targets': [], 'max_rate': 0.0, 'max_files': 0.0, 'max_latency': 0.0,
+                     'ionice': 'none', 'drop_cache': False, 'checksum': False, 'scrub': False,
+                     'restore': [], 'restore_to': '', 'pack_size': 0, 'filters': '',
+                     'scan_jobs': 1, 'freeze': 'none', 'quiesce': False}
+    # I/O scheduling classes the backup can run with, 'none' keeps the inherited one
+    IO_PRIORITIES = ['none', 'best-effort', 'idle']
+    # how files are kept from changing while they are backed up: not at all, by backing up a
+    # snapshot of the data filesystem, or by keeping Nextcloud in maintenance mode
+    FREEZE_METHODS = ['none'] + freeze.METHODS + ['maintenance']
+    OUTPUT_MODES = ['mirror', 'store', 'snapshot', 'archive']
+    # how changed files are found: walking NEXTCLOUD_DATA, or listing directories recorded
+    # by the change tracking daemon (watchDaemon.py) or changed in Nextcloud's file cache
+    CHANGE_SOURCES = ['scan', 'watch', 'filecache']
+    # directories inside NEXTCLOUD_DATA_BACKUP holding snapshots and archive volumes
+    SNAPSHOT_DIR = 'snapshots'
+    ARCHIVE_DIR = 'archives'
+    # directory inside NEXTCLOUD_DATA_BACKUP holding backups of removed files when using --sync
+    TRASH_DIR = '.trash'
+    # file written to an extra target once a run has backed up every file to it
+    TARGET_MARKER = '.nextcloud_backup_target'
+    # file inside NEXTCLOUD_DATA_BACKUP holding the identity recorded in the manifest
+    BACKUP_ID_FILE = '.nextcloud_backup_id'
+    # files at least this large are updated in place when using --delta
+    DELTA_MIN_SIZE = 64 * 1024 * 1024
+    # number of files sorted by disk offset and verified together by --scrub
+    SCRUB_BATCH = 10000
+    # seconds between progress reports of a restore
+    RESTORE_PROGRESS_INTERVAL = 5
 
     def __init__(self, args):
         '''Initializes object, validates constants/passed arguments, and mounts backup partition'''
-        # list of files to backup
+        # timings and counters of this run
+        self.metrics = RunMetrics()
+        start = time.monotonic()
+
+        # list of files that errored during the last run, backed up before scanning
         self.toBackup = []
 
+        # destination directories known to exist
+        self.createdDirs = set()
+
+        # manifest of backed up files, opened in main()
+        self.manifest = None
+
+        # deduplicated blob store, used if output mode is 'store'
+        self.store = None
+
+        # directory files are backed up to, and directory holding the last backup of
+        # unchanged files. both differ from NEXTCLOUD_DATA_BACKUP in snapshot output mode
+        self.backupRoot = self.NEXTCLOUD_DATA_BACKUP
+        self.referenceRoot = self.NEXTCLOUD_DATA_BACKUP
+
+        # include/exclude rules applied while scanning, read from the filters file by main()
+        self.filters = Filters(['*.' + x for x in self.IGNORED_FILE_TYPES])
+
+        # bundles of small files, used in mirror output mode if using --pack-size or if the
+        # backup already contains bundles
+        self.bundles = None
+
+        # dated snapshots, used if output mode is 'snapshot'
+        self.snapshots = None
+
+        # rolling archive volumes, used if output mode is 'archive'
+        self.archive = None
+
+        # journal of this run's progress, and progress of an interrupted previous run
+        self.journal = None
+        self.resumed = None
+
+        # directories changed since the last run recorded by the change tracking daemon, and
+        # directories to list instead of walking NEXTCLOUD_DATA (None walks the whole tree)
+        self.dirtySet = None
+        self.scanDirs = None
+
+        # files and directories (relative to NEXTCLOUD_DATA) removed since they were backed up,
+        # collected while scanning if using --sync
+        self.removedFiles = []
+        self.removedDirs = []
+
+        # rate limit of the copy phase, None if unlimited
+        self.throttle = None
+
+        # extra targets no run has completed a backup to yet, which get every file
+        self.newTargets = []
+
+        # snapshot files are backed up from when using --freeze, whether maintenance mode was
+        # enabled by this run, and the time files were last known to be backed up, written to
+        # the backup log by tearDown()
+        self.freeze = None
+        self.maintenance = False
+        self.cutoff = None
+
+        # NEXTCLOUD_DATA outside the snapshot while backing up from one, otherwise None
+        self.liveData = None
+
+        # kernel copy backend chosen after mounting backup partition, shutil.copy2 if None
+        self.copyBackend = None
+        self.copiedBytes = 0
+
+        # locks shared by copy workers
+        self.logLock = threading.Lock()
+        self.dirLock = threading.Lock()
+
         # verify argparse namespace object
         self.args = self.checkArgs(args)
 
         # verify that NEXTCLOUD_DATA, NEXTCLOUD_DATA_BACKUP, and
         # NEXTCLOUD_BACKUP_PARTITION exist
-        self.checkDataExists()
+        with self.metrics.span('check_data'):
+            self.checkDataExists()
 
         # log variables
         self.log = self.openLogFile(self.NEXTCLOUD_BACKUP_LOG)
@@ -57,14 +208,15 @@ class NextcloudBackup(metaclass=Singleton):
         if os.stat(self.NEXTCLOUD_BACKUP_LOG).st_size == 0:
             self.log.write(self.OLD_DUMMY_DATE)
 
-        # if errored files log contains files, read them first
+        # if errored files log contains files, read them first. the log is only emptied
+        # by main() once these files are recorded in the run journal
         if os.stat(self.NEXTCLOUD_ERRORED_FILES_LOG).st_size != 0:
             self.toBackup = [x.strip('\n') for x in self.erroredFiles.readlines()]
-            # remove recently read files from log
-            # edge case -- program crashes mid operation: errored filenames are lost
-            self.erroredFiles.truncate(0)
 
-        self.mountBackupPartition()
+        with self.metrics.span('mount'):
+            self.mountBackupPartition()
+
+        self.metrics.addSpan('init', time.monotonic() - start)
 
     def __enter__(self):
         '''Returns self when used in context manager'''
@@ -75,22 +227,59 @@ class NextcloudBackup(metaclass=Singleton):
         self.tearDown()
 
     def tearDown(self):
-        '''Unmounts Nextcloud backup partition and closes open log files'''
-        # unmount storage partition
-        self.executeCommand('umount {}'.format(self.NEXTCLOUD_BACKUP_PARTITION))
+        '''Releases data snapshot, unmounts Nextcloud backup partition, writes run metrics and
+        closes open log files
+        '''
+        with self.metrics.span('teardown'):
+            self.thaw()
+            for target in self.backupTargets():
+                if target.partition is None:
+                    continue
 
-        # force drive to spin down
-        self.executeCommand('hdparm -y {}'.format(self.NEXTCLOUD_BACKUP_PARTITION))
+                # unmount storage partition
+                for mountPoint in self.partitionMountPoints(target.partition):
+                    self.unmount(mountPoint)
 
-        # write current date in log if not dry run
+                # force drive to spin down
+                self.spinDown(target.partition)
+
+        # write start of run (or time data was frozen at) in log and metrics of this run if not
+        # dry run, so files changed while it ran are checked again by the next one. a scrub or
+        # restore doesn't back up anything, so it isn't recorded as the last backup
         if not self.args.dry_run:
-            self.log.write(datetime.datetime.now().strftime('%c') + '\n')
+            if not self.args.scrub and not self.args.restore:
+                self.log.write((self.cutoff or datetime.datetime.now()).strftime('%c') + '\n')
+
+            self.writeMetrics()
+
+        # close journal, manifest, dirty set and log files
+        if self.journal is not None:
+            self.journal.close()
+
+        if self.dirtySet is not None:
+            self.dirtySet.close()
+
+        if self.bundles is not None:
+            self.bundles.close()
+
+        if self.manifest is not None:
+            self.manifest.close()
 
-        # close log files
         self.log.close()
         self.error.close()
         self.erroredFiles.close()
 
+    def writeMetrics(self):
+        '''Writes summary of run metrics as JSON and, if requested, for Prometheus'''
+        self.metrics.info.update({'output': self.args.output,
+                                  'jobs': self.args.jobs,
+                                  'copy_backend': self.copyBackend or 'copy2'})
+        try:
+            self.metrics.write(self.NEXTCLOUD_BACKUP_METRICS, self.args.prometheus)
+        except OSError as e:
+            self.reportError(('{}: caught error \'{}\' while attempting to write metrics'
+                              .format(datetime.datetime.now().strftime('%c'), e)))
+
     def checkDataExists(self):
         '''Verifies that data location, backup mount point, and backup partition exist'''
         # test if nextcloud data directory exists
@@ -98,15 +287,31 @@ class NextcloudBackup(metaclass=Singleton):
             sys.exit(('Error: Nextcloud data directory \'{}\' '
                       'does not exist'.format(self.NEXTCLOUD_DATA)))
 
-        # test if nextcloud backup mount point exists
-        if not os.path.exists(self.NEXTCLOUD_DATA_BACKUP):
-            sys.exit(('Error: Nextcloud backup mount point \'{}\' does '
-                      'not exist'.format(self.NEXTCLOUD_DATA_BACKUP)))
+        for target in self.backupTargets():
+            # test if nextcloud backup mount point exists
+            if not os.path.exists(target.root):
+                sys.exit(('Error: Nextcloud backup mount point \'{}\' does '
+                          'not exist'.format(target.root)))
+
+            # verifies if specified partition exists
+            if target.partition is not None and not self.partitionExists(target.partition):
+                sys.exit(('Error: Nextcloud backup partition \'{}\' '
+                          'does not exist'.format(target.partition)))
+
+    def loadFilters(self):
+        '''Returns Filters excluding IGNORED_FILE_TYPES and compiled from --filters, or from
+        NEXTCLOUD_BACKUP_FILTERS if it exists
+        '''
+        ignored = ['*.' + x for x in self.IGNORED_FILE_TYPES]
+        path = self.args.filters or self.NEXTCLOUD_BACKUP_FILTERS
+        try:
+            return Filters.read(path, ignored)
+        except (OSError, ValueError) as e:
+            # the default filters file is optional
+            if isinstance(e, FileNotFoundError) and not self.args.filters:
+                return Filters(ignored)
 
-        # verifies if specified partition exists
-        if self.NEXTCLOUD_BACKUP_PARTITION.split('/')[-1] not in self.executeCommand('lsblk -l'):
-            sys.exit(('Error: Nextcloud backup partition \'{}\' '
-                      'does not exist'.format(self.NEXTCLOUD_BACKUP_PARTITION)))
+            sys.exit('Error: unable to read filters file \'{}\': {}'.format(path, e))
 
     def checkArgs(self, args):
         '''Validates passed command line arguments and returns passed object if valid'''
@@ -125,6 +330,97 @@ class NextcloudBackup(metaclass=Singleton):
                 sys.exit(('Error: expected property of type \'bool\', '
                           'found type \'{}\''.format(type(val))))
 
+        # optional attributes take their default value if missing
+        for name, default in self.OPTIONAL_ARGS.items():
+            if not hasattr(args, name):
+                setattr(args, name, default)
+            elif type(getattr(args, name)) is not type(default):
+                sys.exit(('Error: expected property of type \'{}\', '
+                          'found type \'{}\''.format(type(default), type(getattr(args, name)))))
+
+        if args.jobs < 1:
+            sys.exit('Error: number of jobs must be at least 1')
+
+        if args.scan_jobs < 1:
+            sys.exit('Error: number of scan jobs must be at least 1')
+
+        if args.freeze not in self.FREEZE_METHODS:
+            sys.exit(('Error: unknown freeze method \'{}\', expected one of {}'
+                      .format(args.freeze, ', '.join(self.FREEZE_METHODS))))
+
+        if args.freeze != 'none' and (args.scrub or args.restore):
+            sys.exit('Error: --freeze can\'t be used with --scrub or --restore')
+
+        # maintenance mode already keeps files from changing for the whole run
+        if args.quiesce and args.freeze not in freeze.METHODS:
+            sys.exit('Error: --quiesce needs a filesystem snapshot freeze method')
+
+        if args.output not in self.OUTPUT_MODES:
+            sys.exit(('Error: unknown output mode \'{}\', expected one of {}'
+                      .format(args.output, ', '.join(self.OUTPUT_MODES))))
+
+        if args.changes not in self.CHANGE_SOURCES:
+            sys.exit(('Error: unknown change source \'{}\', expected one of {}'
+                      .format(args.changes, ', '.join(self.CHANGE_SOURCES))))
+
+        # snapshots must link every unchanged file, so they always walk the whole tree
+        if args.changes != 'scan' and args.output == 'snapshot':
+            sys.exit(('Error: change source \'{}\' can\'t be used with snapshot output mode'
+                      .format(args.changes)))
+
+        if args.reconcile_days < 1:
+            sys.exit('Error: number of days between full scans must be at least 1')
+
+        if args.trash_days < 0:
+            sys.exit('Error: number of days to keep removed files must not be negative')
+
+        # snapshots already leave out removed files, and archives are append-only
+        if args.sync and args.output not in ('mirror', 'store'):
+            sys.exit(('Error: removed files can\'t be synced in {} output mode'
+                      .format(args.output)))
+
+        for target in args.targets:
+            if not target.startswith('/'):
+                sys.exit('Error: backup target \'{}\' must be an absolute path'.format(target))
+
+        # every file is copied as is to extra targets
+        if args.targets and args.output != 'mirror':
+            sys.exit('Error: extra backup targets can only be used in mirror output mode')
+
+        if args.max_rate < 0 or args.max_files < 0 or args.max_latency < 0:
+            sys.exit('Error: rate and latency limits must not be negative')
+
+        if args.ionice not in self.IO_PRIORITIES:
+            sys.exit(('Error: unknown I/O scheduling class \'{}\', expected one of {}'
+                      .format(args.ionice, ', '.join(self.IO_PRIORITIES))))
+
+        # archive volumes hold compressed copies, which don't match digests of the files
+        if args.scrub and args.output == 'archive':
+            sys.exit('Error: archive output mode backups can\'t be scrubbed')
+
+        if args.scrub and args.restore:
+            sys.exit('Error: --scrub and --restore can\'t be used together')
+
+        if args.restore and args.output == 'archive':
+            sys.exit('Error: archive output mode backups can\'t be restored')
+
+        if args.restore_to and not args.restore_to.startswith('/'):
+            sys.exit(('Error: restore destination \'{}\' must be an absolute path'
+                      .format(args.restore_to)))
+
+        if args.pack_size < 0:
+            sys.exit('Error: size of packed files must not be negative')
+
+        # other output modes keep every file as a file of its own or in an archive
+        if args.pack_size and (args.output != 'mirror' or args.targets):
+            sys.exit('Error: small files can only be packed in mirror output mode without extra targets')
+
+        if args.keep_snapshots < 1:
+            sys.exit('Error: number of snapshots to keep must be at least 1')
+
+        if args.volume_size < 1:
+            sys.exit('Error: archive volume size must be at least 1 MiB')
+
         # dry run implies verbose
         if args.dry_run:
             args.verbose = True
@@ -148,12 +444,14 @@ class NextcloudBackup(metaclass=Singleton):
             return ''
 
         # create subprocess object with passed command
-        process = subprocess.Popen(command,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   shell=True)
-        # get stdout and stderr from process object
-        out, err = process.communicate()
+        with self.metrics.span('command_' + command.split()[0]):
+            process = subprocess.Popen(command,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       shell=True)
+            # get stdout and stderr from process object
+            out, err = process.communicate()
+
         out = out[:-1].decode()
         err = err[:-1].decode()
 
@@ -168,62 +466,1380 @@ class NextcloudBackup(metaclass=Singleton):
         # return captured stdout from executed command
         return out
 
+    def backupTargets(self):
+        '''Returns list of BackupTarget, NEXTCLOUD_DATA_BACKUP first followed by --target ones
+
+        Extra targets are given as MOUNTPOINT=PARTITION, or as MOUNTPOINT alone for
+        destinations mounted by the system such as NAS exports
+        '''
+        targets = [BackupTarget(self.NEXTCLOUD_DATA_BACKUP, self.NEXTCLOUD_BACKUP_PARTITION)]
+        for target in self.args.targets:
+            root, _, partition = target.partition('=')
+            targets.append(BackupTarget(os.path.join(root, ''), partition or None))
+
+        return targets
+
+    def partitionExists(self, partition=None):
+        '''Returns True if partition (default NEXTCLOUD_BACKUP_PARTITION) exists, using lsblk if
+        sysfs is unavailable
+        '''
+        partition = partition or self.NEXTCLOUD_BACKUP_PARTITION
+        try:
+            return devices.blockDeviceExists(partition)
+        except OSError:
+            name = partition.split('/')[-1]
+            return any(line.split()[:1] == [name]
+                       for line in self.executeCommand('lsblk -l').split('\n'))
+
+    def partitionMountPoints(self, partition=None):
+        '''Returns directories partition (default NEXTCLOUD_BACKUP_PARTITION) is mounted at,
+        using mount -l if /proc is unavailable
+        '''
+        partition = partition or self.NEXTCLOUD_BACKUP_PARTITION
+        try:
+            return devices.mountPoints(partition)
+        except OSError:
+            # lines look like '/dev/sdc1 on /mnt/nextcloud_backup type ext4 (rw)'
+            return [fields[2] for fields in (x.split() for x in self.executeCommand('mount -l').split('\n'))
+                    if fields[:2] == [partition, 'on']]
+
+    def unmount(self, target):
+        '''Unmounts filesystem mounted at target, running umount if the system call fails'''
+        if self.args.dry_run:
+            return
+
+        try:
+            devices.umount(target)
+        except OSError:
+            self.executeCommand('umount {}'.format(target))
+
+    def spinDown(self, partition):
+        '''Spins down drive holding partition, running hdparm if the ioctl fails'''
+        if self.args.dry_run:
+            return
+
+        try:
+            devices.standby(partition)
+        except OSError:
+            self.executeCommand('hdparm -y {}'.format(partition))
+
     def mountBackupPartition(self):
-        '''Mounts Nextcloud backup partition and unmounts required resources if used'''
-        # if something is mounted at our backup mount point, unmount it
-        if os.path.ismount(self.NEXTCLOUD_DATA_BACKUP):
-            self.executeCommand('umount {}'.format(self.NEXTCLOUD_DATA_BACKUP))
+        '''Mounts backup partitions of every target and unmounts required resources if used'''
+        for target in self.backupTargets():
+            if target.partition is None:
+                continue
 
-        # if our backup partition is mounted, unmount it
-        if self.NEXTCLOUD_BACKUP_PARTITION in self.executeCommand('mount -l'):
-            self.executeCommand('umount {}'.format(self.NEXTCLOUD_BACKUP_PARTITION))
+            # if something is mounted at our backup mount point, unmount it
+            if os.path.ismount(target.root):
+                self.unmount(target.root)
 
-        # mount storage partition
-        self.executeCommand('mount {} {}'
-                            .format(self.NEXTCLOUD_BACKUP_PARTITION, self.NEXTCLOUD_DATA_BACKUP))
+            # if our backup partition is mounted, unmount it
+            for mountPoint in self.partitionMountPoints(target.partition):
+                self.unmount(mountPoint)
 
-    def main(self):
-        '''Main routine to perform incremental backup'''
-        # get datetime of last backup
-        lastBackup = datetime.datetime.strptime(self.log.readlines()[-1].strip('\n'), '%c')
+            # mount storage partition
+            if not self.args.dry_run:
+                try:
+                    devices.mount(target.partition, target.root)
+                except OSError:
+                    self.executeCommand('mount {} {}'.format(target.partition, target.root))
+
+        if not self.args.dry_run:
+            self.copyBackend = self.probeCopyBackend()
+
+    def probeCopyBackend(self):
+        '''Returns cheapest copy backend supported from NEXTCLOUD_DATA to NEXTCLOUD_DATA_BACKUP
+
+        Copies an existing small file of NEXTCLOUD_DATA, which is only read, to a scratch file
+        in the backup with each backend in fileCopy.BACKENDS. Returns None (use shutil.copy2)
+        if no such file is found or the scratch file can't be created
+        '''
+        src = self.findProbeFile()
+        dst = os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.COPY_PROBE_FILE)
+        try:
+            backend = fileCopy.probeBackend(src, dst) if src is not None else None
+        except OSError:
+            backend = None
+        finally:
+            if os.path.exists(dst):
+                os.remove(dst)
+
+        if self.args.verbose:
+            print('using \'{}\' copy backend'.format(backend or 'copy2'))
+
+        return backend
+
+    def findProbeFile(self):
+        '''Returns path of a non-empty regular file of at most COPY_PROBE_SIZE bytes found
+        breadth first in the first COPY_PROBE_DIRS directories of NEXTCLOUD_DATA, or None
+        '''
+        directories = collections.deque([self.NEXTCLOUD_DATA])
+        for _ in range(self.COPY_PROBE_DIRS):
+            if not directories:
+                break
+
+            try:
+                entries = list(os.scandir(directories.popleft()))
+            except OSError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.is_symlink():
+                        continue
+
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif entry.is_file() and 0 < entry.stat().st_size <= self.COPY_PROBE_SIZE:
+                        return entry.path
+                except OSError:
+                    continue
+
+        return None
+
+    def reportError(self, errorMessage, erroredFile=None):
+        '''Records error message in error log and prints it to stderr
 
-        # iterate through nextcloud data and find all files that need to be backed up
-        for subdir, dirs, files in os.walk(self.NEXTCLOUD_DATA):
-            for f in files:
-                path = os.path.join(subdir, f)
-                if datetime.datetime.fromtimestamp(os.path.getmtime(path)) > lastBackup or \
-                    not os.path.exists(path.replace(self.NEXTCLOUD_DATA, self.NEXTCLOUD_DATA_BACKUP)):
-                    self.toBackup.append(path)
+        If erroredFile is given, it is added to the errored files log to be retried next run
+        '''
+        self.metrics.increment('errors')
+        if erroredFile is not None:
+            erroredFile = self.livePath(erroredFile)
 
-        # iterate over all files that need to be backed up and copy them
+        with self.logLock:
+            self.error.write(errorMessage + '\n')
+            print(errorMessage, file=sys.stderr)
+            if erroredFile is not None:
+                self.erroredFiles.write(erroredFile + '\n')
+
+        if erroredFile is not None and self.journal is not None:
+            self.journal.errored(erroredFile)
+
+    def scanData(self, directories=None):
+        '''Yields (directory, file entries, subdirectory names) for every directory under NEXTCLOUD_DATA
+
+        Uses os.scandir so that each entry's stat result is fetched at most once,
+        directories are traversed top-down and entries are sorted by name. If directories
+        is given, only those directories are listed, descending only into subdirectories
+        without backed up files at any depth (e.g. created or renamed), and directories
+        removed since are skipped
+        '''
+        stack = [self.NEXTCLOUD_DATA] if directories is None else list(reversed(directories))
+        listed = set()
+        while stack:
+            directory = stack.pop()
+            if directories is not None:
+                if directory in listed or self.filters.excludesTree(self.relativeDir(directory)):
+                    continue
+
+                listed.add(directory)
+
+            try:
+                files, names, subdirs = self.listDirectory(directory)
+            except OSError as e:
+                if directories is None or not isinstance(e, FileNotFoundError):
+                    self.reportError(('{}: caught error \'{}\' while attempting to scan \'{}\''
+                                      .format(datetime.datetime.now().strftime('%c'), e, directory)))
+                continue
+
+            # subdirectories holding only folders have no files of their own in the manifest
+            if directories is not None:
+                known = self.manifest.childDirs(self.relativeDir(directory))
+                subdirs = [x for x in subdirs if os.path.basename(x) not in known]
+
+            stack.extend(reversed(subdirs))
+
+            self.metrics.increment('dirs_scanned')
+            yield directory, files, names
+
+    def listDirectory(self, directory, statFiles=False):
+        '''Returns (file entries, subdirectory names, subdirectories to descend into) of directory
+
+        Entries are sorted by name. Symlinks to directories and excluded directories are not
+        descended into. If statFiles is True, the stat result of each file is fetched and cached
+        in its entry. Raises OSError if directory can't be listed
+        '''
+        with self.metrics.span('scan_listing'):
+            entries = sorted(os.scandir(directory), key=lambda x: x.name)
+
+        files = []
+        subdirs = []
+        names = set()
+        for entry in entries:
+            if entry.is_dir():
+                names.add(entry.name)
+                # mirror os.walk behavior: symlinks to directories are not followed
+                if entry.is_symlink():
+                    continue
+
+                # excluded directories are pruned without being listed
+                if self.filters.excludesDir(self.relativeDir(entry.path)):
+                    self.metrics.increment('dirs_excluded')
+                else:
+                    subdirs.append(entry.path)
+            else:
+                files.append(entry)
+                if statFiles:
+                    try:
+                        entry.stat()
+                    except OSError:
+                        # reported again when the entry is diffed against the manifest
+                        pass
+
+        return files, names, subdirs
+
+    def scanShards(self):
+        '''Yields the same as scanData() for every directory under NEXTCLOUD_DATA, listing
+        shards concurrently
+
+        Each top level directory (one per user, plus app data) and each mount point below
+        them is a shard, grouped by the device it is on. Shards of a device are walked by
+        --scan-jobs threads with an adaptive limit on the number of directories listed at once,
+        see shardScan. File entries are stat'ed by the scanning threads, so the main thread
+        only diffs listings against the manifest. Directories come in no particular order
+        '''
+        try:
+            files, names, subdirs = self.listDirectory(self.NEXTCLOUD_DATA)
+        except OSError as e:
+            self.reportError(('{}: caught error \'{}\' while attempting to scan \'{}\''
+                              .format(datetime.datetime.now().strftime('%c'), e,
+                                      self.NEXTCLOUD_DATA)))
+            return
+
+        self.metrics.increment('dirs_scanned')
+        yield self.NEXTCLOUD_DATA, files, names
+
+        mountPoints = self.nestedMountPoints()
+        shards = []
+        for directory in subdirs + sorted(mountPoints):
+            try:
+                shards.append((os.stat(directory).st_dev, directory))
+            except OSError as e:
+                self.reportError(('{}: caught error \'{}\' while attempting to scan \'{}\''
+                                  .format(datetime.datetime.now().strftime('%c'), e, directory)))
+
+        def listShard(directory):
+            '''Lists directory of a shard, leaving nested mount points to their own shard'''
+            try:
+                files, names, subdirs = self.listDirectory(directory, statFiles=True)
+            except OSError as e:
+                self.reportError(('{}: caught error \'{}\' while attempting to scan \'{}\''
+                                  .format(datetime.datetime.now().strftime('%c'), e, directory)))
+                return None, [], 1
+
+            self.metrics.increment('dirs_scanned')
+            return ((directory, files, names), [x for x in subdirs if x not in mountPoints],
+                    len(files) + 1)
+
+        yield from shardScan.scan(shards, listShard, self.args.scan_jobs, self.QUEUE_SIZE)
+
+    def nestedMountPoints(self):
+        '''Returns set of paths of mount points inside the top level directories of
+        NEXTCLOUD_DATA that aren't excluded, or an empty set if mounts can't be read
+        '''
+        try:
+            entries = devices.mounts()
+        except (OSError, ValueError):
+            return set()
+
+        root = os.path.realpath(self.NEXTCLOUD_DATA)
+        mountPoints = set()
+        for entry in entries:
+            if not entry.mountPoint.startswith(root + '/'):
+                continue
+
+            relDir = entry.mountPoint[len(root):].strip('/')
+            if '/' in relDir and not self.filters.excludesTree(relDir):
+                mountPoints.add(os.path.join(self.NEXTCLOUD_DATA, relDir))
+
+        return mountPoints
+
+    def relativeDir(self, directory):
+        '''Returns directory relative to NEXTCLOUD_DATA, used as manifest key'''
+        return directory[len(self.NEXTCLOUD_DATA):].strip('/')
+
+    def backupPath(self, src, root=None):
+        '''Returns path of given file inside root, defaults to current backup root'''
+        return (root or self.backupRoot) + src[len(self.NEXTCLOUD_DATA):]
+
+    def recordBackedUp(self, src, stat=None, digest=None):
+        '''Records given file in manifest as backed up'''
+        if self.args.dry_run:
+            return
+
+        if stat is None:
+            stat = os.stat(src)
+
+        self.manifest.record(self.relativeDir(os.path.dirname(src)), os.path.basename(src),
+                             stat, digest)
+
+    def changedFiles(self, lastBackup):
+        '''Yields (path, stat, unchanged) for every file that needs to be backed up
+
+        Files left pending by an interrupted run and files from the errored files log are
+        yielded first without a stat result. The scan then diffs each directory listing against
+        the manifest, skipping directories an interrupted run already scanned. Files missing
+        from the manifest (e.g. first run after upgrading) fall back to comparing against the
+        last backup date and checking for the file in the backup. Unchanged files are only
+        yielded (with unchanged set to True) in snapshot output mode, to be linked from the
+        last snapshot, and while an extra target is new, to be copied to it. If using --sync,
+        files missing from the manifest may be renamed in the backup instead, and files and
+        directories missing from the listing are collected to be removed from the backup once
+        the scan is done
+        '''
+        pending = list(self.resumed.pending) if self.resumed is not None else []
+        scanned = self.resumed.scanned if self.resumed is not None else set()
         for src in self.toBackup:
-            if src.split('.')[-1] in self.IGNORED_FILE_TYPES:
+            if self.resumed is None or src not in self.resumed.pending:
+                pending.append(src)
+                if self.journal is not None:
+                    self.journal.queued(self.livePath(src))
+
+        # errored files are safely recorded in the journal, so their log can be emptied
+        if self.journal is not None and self.toBackup:
+            self.journal.sync()
+            self.erroredFiles.seek(0)
+            self.erroredFiles.truncate(0)
+
+        for src in pending:
+            src = self.currentPath(src)
+            relPath = src[len(self.NEXTCLOUD_DATA):]
+            if not (self.filters.excludesFile(relPath) or
+                    self.filters.excludesTree(os.path.dirname(relPath))):
+                yield src, None, False
+
+        if self.scanDirs is None and self.args.scan_jobs > 1:
+            listings = self.scanShards()
+        else:
+            listings = self.scanData(self.scanDirs)
+
+        for directory, files, subdirs in listings:
+            relDir = self.relativeDir(directory)
+            if relDir in scanned:
                 continue
 
-            dst = src.replace(self.NEXTCLOUD_DATA, self.NEXTCLOUD_DATA_BACKUP)
-            destPath = dst.replace(dst[dst.rfind('/') + 1:], '')
+            known = self.manifest.lookupDir(relDir)
+            for entry in files:
+                relPath = os.path.join(relDir, entry.name)
+                if self.filters.excludesFile(relPath):
+                    self.metrics.increment('files_excluded')
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # file was removed after directory was listed
+                    continue
+                finally:
+                    self.metrics.observe('stat', time.perf_counter() - start)
+
+                self.metrics.increment('files_scanned')
+                if self.filters.exceedsLimits(relPath, stat):
+                    self.metrics.increment('files_excluded')
+                    continue
+
+                renamed = None
+                if entry.name not in known and self.args.sync:
+                    renamed = self.moveRenamed(entry.path, stat)
+
+                if entry.name in known:
+                    changed = Manifest.isChanged(known[entry.name], stat)
+                elif renamed is not None:
+                    # a rename that failed on a target is copied to every target instead
+                    changed = not renamed
+                elif self.referenceRoot is None:
+                    changed = True
+                else:
+                    changed = (datetime.datetime.fromtimestamp(stat.st_mtime) > lastBackup or
+                               not os.path.exists(self.backupPath(entry.path, self.referenceRoot)))
+                    if not changed:
+                        self.recordBackedUp(entry.path, stat)
+
+                if changed:
+                    self.metrics.increment('files_changed')
+                    if self.journal is not None:
+                        self.journal.queued(self.livePath(entry.path))
+
+                    yield entry.path, stat, False
+                elif self.snapshots is not None or self.newTargets:
+                    yield entry.path, stat, True
+
+            if self.args.sync:
+                names = {x.name for x in files}
+                self.removedFiles.extend((relDir, x) for x in known if x not in names)
+                self.removedDirs.extend(os.path.join(relDir, x)
+                                        for x in self.manifest.childDirs(relDir) if x not in subdirs)
+
+            if self.journal is not None:
+                self.journal.scanned(relDir)
 
-            # if directory doesn't exist, create it
-            if not os.path.exists(destPath):
+    def moveRenamed(self, src, stat):
+        '''Renames backup of the file src was renamed from, returns None if src is a new file
+
+        A backed up file with the same inode, size and modification time whose path no longer
+        exists in NEXTCLOUD_DATA is assumed to have been renamed to src. Extra targets missing
+        the old backup get a copy of src instead. Returns False if the rename failed on a
+        target, in which case src must be copied to every target
+        '''
+        for directory, name, digest in self.manifest.findMoved(stat):
+            old = os.path.join(self.NEXTCLOUD_DATA, directory, name)
+            if os.path.lexists(old) or not os.path.isfile(self.backupPath(old)):
+                continue
+
+            for target in self.backupTargets():
+                backup = self.backupPath(old, target.root)
+                dst = self.backupPath(src, target.root)
                 if self.args.verbose:
-                    print('creating \'{}\''.format(destPath))
+                    print('renaming \'{}\' --> \'{}\''.format(backup, dst))
+
+                if self.args.dry_run:
+                    continue
+
+                try:
+                    self.makeBackupDir(os.path.join(os.path.dirname(dst), ''))
+                    if os.path.isfile(backup):
+                        os.replace(backup, dst)
+                    else:
+                        shutil.copy2(src, dst)
+                except OSError as e:
+                    self.reportError(('{}: caught error \'{}\' while attempting to rename \'{}\''
+                                      .format(datetime.datetime.now().strftime('%c'), e, backup)))
+                    return False
 
-                os.makedirs(destPath, exist_ok=True)
+            if not self.args.dry_run:
+                self.manifest.remove(directory, name)
+                self.recordBackedUp(src, stat, digest)
+                if self.journal is not None:
+                    self.journal.done(self.livePath(src), stat, digest)
+
+            self.metrics.increment('files_renamed')
+            return True
+
+        return None
+
+    def removeBackup(self, relPath, trashName):
+        '''Moves backups of removed file or directory to trashName under TRASH_DIR of every
+        target, or deletes them if trashName is None
+        '''
+        for target in self.backupTargets():
+            path = os.path.join(target.root, relPath)
+            if self.args.verbose:
+                print('removing \'{}\''.format(path))
+
+            if self.args.dry_run:
+                continue
 
-            # attempt to copy file. if error is caught, record error in log and
-            # add errored file to erroredFiles log if it still exists
-            # (if it wasn't deleted during this process)
             try:
-                if self.args.verbose:
-                    print('\'{}\' --> \'{}\''.format(src, dst))
+                if trashName is not None:
+                    dst = os.path.join(target.root, self.TRASH_DIR, trashName, relPath)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.rename(path, dst)
+                elif os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                # already renamed, or never backed up
+                pass
+            except OSError as e:
+                self.reportError(('{}: caught error \'{}\' while attempting to remove \'{}\''
+                                  .format(datetime.datetime.now().strftime('%c'), e, path)))
+
+    def syncRemoved(self):
+        '''Removes backups of files and directories removed from NEXTCLOUD_DATA
+
+        They are moved to a dated directory under TRASH_DIR, unless --trash-days is 0, and trash
+        directories older than --trash-days days are deleted
+        '''
+        trash = None
+        if self.args.trash_days:
+            trash = datetime.datetime.now().strftime(SnapshotSet.NAME_FORMAT)
+
+        for relDir in self.removedDirs:
+            self.removeBackup(relDir, trash)
+            if not self.args.dry_run:
+                if self.store is not None:
+                    for digest in self.manifest.treeDigests(relDir):
+                        self.store.release(digest, trash)
+
+                self.manifest.removeTree(relDir)
+                if self.bundles is not None:
+                    self.bundles.removeTree(relDir)
+
+        for relDir, name in self.removedFiles:
+            self.removeBackup(os.path.join(relDir, name), trash)
+            if not self.args.dry_run:
+                digest = self.manifest.lookupDigest(relDir, name)
+                if self.store is not None and digest is not None:
+                    self.store.release(digest, trash)
+
+                self.manifest.remove(relDir, name)
+                if self.bundles is not None:
+                    self.bundles.remove(relDir, name)
+
+        self.metrics.increment('dirs_removed', len(self.removedDirs))
+        self.metrics.increment('files_removed', len(self.removedFiles))
+
+        if self.args.dry_run:
+            return
+
+        expired = datetime.datetime.now() - datetime.timedelta(days=self.args.trash_days)
+        for target in self.backupTargets():
+            trashRoot = os.path.join(target.root, self.TRASH_DIR)
+            if not os.path.isdir(trashRoot):
+                continue
+
+            for name in os.listdir(trashRoot):
+                try:
+                    expiredTrash = datetime.datetime.strptime(name, SnapshotSet.NAME_FORMAT) < expired
+                except ValueError:
+                    continue
+
+                if expiredTrash:
+                    if self.args.verbose:
+                        print('emptying trash \'{}\''.format(os.path.join(trashRoot, name)))
+
+                    shutil.rmtree(os.path.join(trashRoot, name))
+
+    def backupFile(self, src, stat=None, unchanged=False):
+        '''Copies given file to backup, recording errors in error logs
+
+        Unchanged files are hardlinked from the last snapshot if it contains them, or only
+        copied to new extra targets
+        '''
+        dst = self.backupPath(src)
+        destPath = os.path.join(os.path.dirname(dst), '')
+
+        # attempt to copy file. if error is caught, record error in log and
+        # add errored file to erroredFiles log if it still exists
+        # (if it wasn't deleted during this process)
+        try:
+            if stat is None and self.bundles is not None:
+                stat = os.stat(src)
+
+            # packed files don't need a directory in the backup
+            if self.archive is None and not self.isPacked(stat):
+                self.makeBackupDir(destPath)
+
+            if unchanged and self.newTargets:
+                if not self.args.dry_run:
+                    self.copyToNewTargets(src, stat)
+
+                return
+
+            if unchanged:
+                if self.args.dry_run or self.linkUnchanged(src, dst, stat):
+                    self.metrics.increment('files_linked')
+                    return
+
+            if self.args.verbose:
+                print('\'{}\' --> \'{}\''.format(src, dst))
+
+            if not self.args.dry_run:
+                if self.throttle is not None:
+                    self.metrics.observe('throttle', self.throttle.wait(
+                        stat.st_size if stat is not None else os.path.getsize(src)))
+
+                start = time.perf_counter()
+                digest = self.copyFile(src, dst, stat)
+                self.metrics.observe('copy', time.perf_counter() - start)
+                if self.args.drop_cache:
+                    throttle.dropCache(src)
+                    if self.archive is None:
+                        throttle.dropCache(dst, writeBack=True)
+
+                self.metrics.increment('files_copied')
+                self.recordBackedUp(src, stat, digest)
+                if self.journal is not None:
+                    self.journal.done(self.livePath(src),
+                                      stat if stat is not None else os.stat(src), digest)
+        except Exception as e:
+            self.reportError(('{}: caught error \'{}\' while attempting to copy \'{}\''
+                              .format(datetime.datetime.now().strftime('%c'), e, dst)),
+                             src if os.path.exists(src) else None)
+
+    def copyToNewTargets(self, src, stat):
+        '''Copies unchanged file src to extra targets no run has completed a backup to, unless
+        they already hold a copy of the same size and modification time
+        '''
+        dsts = [self.backupPath(src, x) for x in self.newTargets]
+        dsts = [x for x in dsts if not restore.isIdentical(stat, x)]
+        if not dsts:
+            return
+
+        for path in dsts:
+            self.makeBackupDir(os.path.join(os.path.dirname(path), ''))
+
+        self.addCopiedBytes(fileCopy.fanOutCopy(src, dsts) * len(dsts))
+        self.metrics.increment('files_copied')
+
+    def findNewTargets(self):
+        '''Returns roots of extra targets missing TARGET_MARKER, i.e. that no run completed a
+        backup to, such as targets added since the last run or emptied
+        '''
+        return [x.root for x in self.backupTargets()[1:]
+                if not os.path.isfile(os.path.join(x.root, self.TARGET_MARKER))]
+
+    def makeBackupDir(self, destPath):
+        '''Creates given backup directory if it doesn't exist'''
+        with self.dirLock:
+            if destPath not in self.createdDirs:
+                if not os.path.exists(destPath):
+                    if self.args.verbose:
+                        print('creating \'{}\''.format(destPath))
+
+                    os.makedirs(destPath, exist_ok=True)
+
+                self.createdDirs.add(destPath)
+
+    def linkUnchanged(self, src, dst, stat):
+        '''Hardlinks backup of src in last snapshot to dst, returns False if it can't be linked
+
+        The manifest may list a version of src copied into a snapshot that was never completed,
+        so the backup in the last snapshot is only linked if its size and modification time
+        still match stat
+        '''
+        if self.referenceRoot == self.backupRoot:
+            return False
+
+        reference = self.backupPath(src, self.referenceRoot)
+        try:
+            current = os.stat(reference)
+            if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                return False
+
+            os.link(reference, dst)
+        except OSError:
+            return False
+
+        return True
+
+    def copyFile(self, src, dst, stat=None):
+        '''Copies src to dst and returns content digest of src if it was computed
+
+        In store output mode, src is added to the content store and dst is linked to its blob.
+        In archive output mode, src is appended to the current archive volume instead of dst.
+        Files smaller than --pack-size are appended to a bundle instead of dst. With extra
+        targets, src is read once and written to each of them as well. Otherwise only changed
+        blocks of large files are updated if using --delta. Using --checksum, the digest of
+        files not stored in the content store is computed while they are copied
+        '''
+        if self.archive is not None:
+            self.addCopiedBytes(self.archive.add(src, src[len(self.NEXTCLOUD_DATA):],
+                                                 stat if stat is not None else os.stat(src)))
+            return None
+
+        if self.store is not None:
+            digest = self.store.add(src, self.manifest.findDigest(stat) if stat else None)
+            self.store.link(digest, dst, self.manifest.lookupDigest(
+                self.relativeDir(os.path.dirname(src)), os.path.basename(src)))
+            return digest
+
+        if self.isPacked(stat):
+            return self.packFile(src, dst, stat)
+
+        # a file packed while it was small is now copied as is
+        if self.bundles is not None:
+            self.bundles.remove(self.relativeDir(os.path.dirname(src)), os.path.basename(src))
+
+        digest = HASH() if self.args.checksum else None
+
+        # read each file once and write it to every target
+        if self.args.targets:
+            dsts = [dst] + [self.backupPath(src, x.root) for x in self.backupTargets()[1:]]
+            for path in dsts[1:]:
+                self.makeBackupDir(os.path.join(os.path.dirname(path), ''))
+
+            self.addCopiedBytes(fileCopy.fanOutCopy(src, dsts, digest=digest) * len(dsts))
+        elif not (self.args.delta and stat is not None and stat.st_size >= self.DELTA_MIN_SIZE and
+                  self.deltaCopy(src, dst, digest)):
+            if self.copyBackend is None and digest is None:
+                shutil.copy2(src, dst)
+                self.addCopiedBytes(stat.st_size if stat is not None else 0)
+            else:
+                self.addCopiedBytes(fileCopy.copyFile(src, dst, self.copyBackend or 'buffered', digest))
+
+        return digest.hexdigest() if digest is not None else None
+
+    def packFile(self, src, dst, stat):
+        '''Appends src to current bundle and returns its digest if using --checksum'''
+        with open(src, 'rb') as fp:
+            data = fp.read()
+
+        self.bundles.add(self.relativeDir(os.path.dirname(src)), os.path.basename(src), data, stat)
+
+        # a copy made while the file was large would shadow the packed one
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+
+        self.addCopiedBytes(len(data))
+        return HASH(data).hexdigest() if self.args.checksum else None
+
+    def deltaCopy(self, src, dst, digest=None):
+        '''Updates backup dst of src in place, returns False if dst isn't in backup yet'''
+        try:
+            self.addCopiedBytes(fileCopy.deltaCopy(src, dst, digest=digest))
+        except FileNotFoundError:
+            # nothing to diff against if file isn't in backup yet
+            if not os.path.exists(src):
+                raise
+
+            return False
+
+        return True
+
+    def addCopiedBytes(self, count):
+        '''Adds count to number of bytes written to backup during this run'''
+        with self.logLock:
+            self.copiedBytes += count
+
+        self.metrics.increment('bytes_copied', count)
+
+    def copyWorker(self, work):
+        '''Backs up (path, stat, unchanged) items taken from work queue until None is received'''
+        while True:
+            item = work.get()
+            if item is None:
+                return
+
+            self.backupFile(*item)
+
+    def resumeJournal(self):
+        '''Opens run journal, recovering progress of an interrupted previous run if any
+
+        Files backed up by the interrupted run are replayed into the manifest and its scan
+        progress is reused, both only with the same output mode and never in snapshot output
+        mode, since the interrupted snapshot those files were copied into is discarded. Archive
+        volumes are synced before the journal records their members, so those are replayed
+        '''
+        self.journal = RunJournal(self.NEXTCLOUD_BACKUP_JOURNAL)
+        self.resumed = self.journal.recover()
+        if self.resumed is not None:
+            if self.resumed.mode == self.args.output and self.args.output != 'snapshot':
+                for path, size, mtime, inode, digest in self.resumed.done:
+                    stat = types.SimpleNamespace(st_size=size, st_mtime_ns=mtime, st_ino=inode)
+                    directory = self.relativeDir(os.path.dirname(path))
+                    name = os.path.basename(path)
+                    # the bundle index of a packed file may not have been written yet
+                    if self.isPacked(stat):
+                        entry = self.bundles.lookup(directory, name)
+                        if entry is None or entry.mtime_ns != mtime:
+                            continue
+
+                    self.manifest.record(directory, name, stat, digest)
 
+                self.manifest.flush()
+
+            # new targets need unchanged files of every directory
+            if (self.resumed.mode != self.args.output or self.args.output == 'snapshot' or
+                    self.newTargets):
+                self.resumed.scanned = set()
+
+            if self.args.verbose:
+                print('resuming interrupted run, {} files pending'.format(len(self.resumed.pending)))
+
+        self.journal.open(self.args.output)
+
+    def checkBackupIdentity(self):
+        '''Forgets the manifest if NEXTCLOUD_DATA_BACKUP isn't the backup it describes
+
+        The manifest is kept on the system disk, so a replaced, reformatted or emptied backup
+        disk would look up to date and nothing would be copied to it. A random identity is
+        written to BACKUP_ID_FILE in the backup and recorded in the manifest, and every file
+        is backed up again when they differ. Returns True if the manifest was forgotten
+        '''
+        path = os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.BACKUP_ID_FILE)
+        try:
+            with open(path) as fp:
+                identity = int(fp.read())
+        except (OSError, ValueError):
+            identity = None
+
+        known = self.manifest.getState('backup_id')
+        if identity is not None and known == identity:
+            return False
+
+        # manifests written by older versions don't know their backup yet
+        forget = known is not None
+        if forget:
+            if self.args.verbose:
+                print('\'{}\' isn\'t the backup the manifest describes, backing up every file'
+                      .format(self.NEXTCLOUD_DATA_BACKUP))
+
+            self.manifest.clear()
+
+        # the backup directory of a first run is only created once files are copied
+        if identity is None and os.path.isdir(self.NEXTCLOUD_DATA_BACKUP):
+            # fits the manifest's REAL state values exactly
+            identity = int.from_bytes(os.urandom(6), 'big')
+            with open(path, 'w') as fp:
+                fp.write(str(identity))
+
+        if identity is not None:
+            self.manifest.setState('backup_id', identity)
+
+        return forget
+
+    def scrubBackup(self, runStart):
+        '''Verifies backed up files with a known digest, re-queueing corrupted ones
+
+        Files are read back in batches of SCRUB_BATCH sorted by disk offset, by --jobs threads
+        and subject to the throttle. The key of the last file of each batch is saved to
+        NEXTCLOUD_BACKUP_SCRUB so an interrupted scrub resumes after it. Corrupted and missing
+        files are added to the errored files log so the next backup copies them again
+        '''
+        root = self.NEXTCLOUD_DATA_BACKUP
+        if self.args.output == 'snapshot':
+            root = SnapshotSet(os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.SNAPSHOT_DIR)).latest()
+            if root is None:
+                return
+
+        if self.args.output == 'store' and not self.args.dry_run:
+            self.store = ContentStore(self.NEXTCLOUD_DATA_BACKUP)
+
+        cursor = scrub.readCursor(self.NEXTCLOUD_BACKUP_SCRUB)
+        if cursor is not None and self.args.verbose:
+            print('resuming scrub after \'{}\''.format(os.path.join(*cursor)))
+
+        with concurrent.futures.ThreadPoolExecutor(self.args.jobs) as executor:
+            while True:
+                rows = self.manifest.digests(cursor, self.SCRUB_BATCH)
+                if not rows:
+                    break
+
+                paths = [os.path.join(root, directory, name) for directory, name, _ in rows]
+                list(executor.map(lambda x: self.scrubFile(paths[x], *rows[x]),
+                                  scrub.diskOrder(paths)))
+                cursor = rows[-1][:2]
+                if not self.args.dry_run:
+                    scrub.writeCursor(self.NEXTCLOUD_BACKUP_SCRUB, cursor)
+
+        if not self.args.dry_run:
+            scrub.writeCursor(self.NEXTCLOUD_BACKUP_SCRUB, None)
+            self.manifest.setState('last_scrub', runStart)
+
+    def scrubFile(self, path, directory, name, digest):
+        '''Verifies that backup at path can be read and still has given digest, reporting it
+        otherwise
+        '''
+        try:
+            entry = self.bundles.lookup(directory, name) if self.bundles is not None else None
+            size = entry.size if entry is not None else os.path.getsize(path)
+            if self.throttle is not None:
+                self.metrics.observe('throttle', self.throttle.wait(size))
+
+            start = time.perf_counter()
+            if entry is not None:
+                actual = HASH(self.bundles.read(entry)).hexdigest()
+            else:
+                actual = hashFile(path)
+            self.metrics.observe('scrub', time.perf_counter() - start)
+            self.metrics.increment('files_scrubbed')
+            self.metrics.increment('bytes_scrubbed', size)
+            if actual == digest:
+                return
+
+            message = 'backup \'{}\' does not match checksum {}'.format(path, digest)
+        except OSError as e:
+            # missing, or unreadable because of bad sectors
+            message = 'caught error \'{}\' while attempting to scrub \'{}\''.format(e, path)
+
+        self.metrics.increment('files_corrupted')
+
+        # the store would link the next copy to the same blob, so it's removed
+        if self.store is not None:
+            try:
+                os.remove(self.store.blobPath(digest))
+            except FileNotFoundError:
+                pass
+
+        src = os.path.join(self.NEXTCLOUD_DATA, directory, name)
+        self.reportError('{}: {}'.format(datetime.datetime.now().strftime('%c'), message),
+                         src if os.path.exists(src) else None)
+
+    def restoreBackup(self):
+        '''Restores backed up files matching --restore patterns to --restore-to, NEXTCLOUD_DATA
+        by default
+
+        Mirror and store backups are restored from NEXTCLOUD_DATA_BACKUP, snapshot backups from
+        the latest snapshot. Files already identical at the destination are skipped, the others
+        are copied by --jobs threads while progress is printed every RESTORE_PROGRESS_INTERVAL
+        seconds. When running as root, restored files and directories are given the owner of
+        the destination so Nextcloud can access them
+        '''
+        root = self.NEXTCLOUD_DATA_BACKUP
+        if self.args.output == 'snapshot':
+            root = SnapshotSet(os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.SNAPSHOT_DIR)).latest()
+            if root is None:
+                sys.exit('Error: no snapshot to restore from')
+
+        # a new destination gets the owner of its closest existing parent
+        target = self.args.restore_to or self.NEXTCLOUD_DATA
+        existing = os.path.abspath(target)
+        while not os.path.lexists(existing):
+            existing = os.path.dirname(existing)
+
+        try:
+            destination = os.stat(existing)
+            owner = (destination.st_uid, destination.st_gid) if os.geteuid() == 0 else None
+            if not self.args.dry_run:
+                self.makeRestoreDir(target, owner)
+        except OSError as e:
+            sys.exit('Error: unable to create restore destination \'{}\': {}'.format(target, e))
+
+        with self.metrics.span('restore_scan'):
+            files = []
+            for src, stat, entry in self.restoreCandidates(root):
+                dst = os.path.join(target, os.path.relpath(src, root))
+                if restore.isIdentical(stat, dst):
+                    self.metrics.increment('files_identical')
+                else:
+                    files.append((src, dst, stat, entry))
+
+        progress = restore.Progress(len(files), sum(x[2].st_size for x in files))
+        with self.metrics.span('restore'), \
+             concurrent.futures.ThreadPoolExecutor(self.args.jobs) as executor:
+            pending = [executor.submit(self.restoreFile, src, dst, stat, owner, progress, entry)
+                       for src, dst, stat, entry in files]
+            while pending:
+                pending = concurrent.futures.wait(pending, self.RESTORE_PROGRESS_INTERVAL)[1]
                 if not self.args.dry_run:
-                    shutil.copy2(src, dst)
-            except Exception as e:
-                errorMessage = ('{}: caught error \'{}\' while attempting to copy \'{}\''
-                                .format(datetime.datetime.now().strftime('%c'), e, dst))
-                self.error.write(errorMessage + '\n')
-                print(errorMessage, file=sys.stderr)
-
-                if os.path.exists(src):
-                    self.erroredFiles.write(src + '\n')
+                    print(progress.report())
+
+    def restoreCandidates(self, root):
+        '''Yields (path, stat, entry) of files under backup root matching --restore patterns
+
+        Only the directories under the literal prefix of each pattern are walked, and the
+        directories used by other output modes and --sync at the top of root are skipped.
+        Files packed into bundles come with their bundle Entry, the others with None
+        '''
+        internal = [self.SNAPSHOT_DIR, self.ARCHIVE_DIR, self.TRASH_DIR, ContentStore.STORE_DIR,
+                    BundleStore.BUNDLE_DIR, self.COPY_PROBE_FILE, self.BACKUP_ID_FILE]
+        for relRoot in restore.walkRoots(self.args.restore):
+            if self.bundles is not None:
+                packed = self.bundles.entries(relRoot)
+                entry = self.bundles.lookup(*os.path.split(relRoot)) if relRoot else None
+                if entry is not None:
+                    packed.append(os.path.split(relRoot) + (entry,))
+
+                for directory, name, entry in packed:
+                    if restore.matches(os.path.join(directory, name), self.args.restore):
+                        stat = types.SimpleNamespace(st_size=entry.size, st_mtime_ns=entry.mtime_ns)
+                        yield os.path.join(root, directory, name), stat, entry
+
+            top = os.path.join(root, relRoot)
+            if os.path.isfile(top):
+                yield top, os.stat(top), None
+                continue
+
+            for directory, subdirs, files in os.walk(top):
+                relDir = os.path.relpath(directory, root)
+                if relDir == '.':
+                    subdirs[:] = [x for x in subdirs if x not in internal]
+                    files = [x for x in files if x not in internal]
+                    relDir = ''
+
+                for name in files:
+                    path = os.path.join(directory, name)
+                    if restore.matches(os.path.join(relDir, name), self.args.restore):
+                        try:
+                            yield path, os.stat(path), None
+                        except OSError:
+                            continue
+
+    def restoreFile(self, src, dst, stat, owner, progress, entry=None):
+        '''Copies backup src to dst, or extracts it from its bundle if entry is given, reporting
+        errors in error log
+        '''
+        if self.args.verbose:
+            print('\'{}\' --> \'{}\''.format(src, dst))
+
+        if self.args.dry_run:
+            return
+
+        try:
+            self.makeRestoreDir(os.path.dirname(dst), owner)
+            if self.throttle is not None:
+                self.metrics.observe('throttle', self.throttle.wait(stat.st_size))
+
+            start = time.perf_counter()
+            if entry is not None:
+                self.bundles.extract(entry, dst)
+            elif self.copyBackend is None:
+                shutil.copy2(src, dst)
+            else:
+                fileCopy.copyFile(src, dst, self.copyBackend)
+
+            if owner is not None:
+                os.chown(dst, *owner)
+
+            self.metrics.observe('copy', time.perf_counter() - start)
+            self.metrics.increment('files_restored')
+            self.metrics.increment('bytes_restored', stat.st_size)
+            progress.add(stat.st_size)
+        except Exception as e:
+            self.reportError(('{}: caught error \'{}\' while attempting to restore \'{}\''
+                              .format(datetime.datetime.now().strftime('%c'), e, dst)))
+
+    def makeRestoreDir(self, directory, owner):
+        '''Creates given restore directory and its missing parents, owned by owner if given'''
+        with self.dirLock:
+            if directory in self.createdDirs or os.path.isdir(directory):
+                self.createdDirs.add(directory)
+                return
+
+        self.makeRestoreDir(os.path.dirname(directory), owner)
+        with self.dirLock:
+            if directory not in self.createdDirs:
+                if self.args.verbose:
+                    print('creating \'{}\''.format(directory))
+
+                os.makedirs(directory, exist_ok=True)
+                if owner is not None:
+                    os.chown(directory, *owner)
+
+                self.createdDirs.add(directory)
+
+    def claimChanges(self):
+        '''Claims directories recorded by the change tracking daemon
+
+        Returns (claim token, changed directories). Directories are None if the daemon
+        requested a full scan (because it restarted, its event queue overflowed, or it never ran)
+        '''
+        self.dirtySet = DirtySet(self.NEXTCLOUD_BACKUP_DIRTY)
+        token, fullScan, directories = self.dirtySet.claim()
+        return token, None if fullScan else directories
+
+    def queryFileCache(self, since):
+        '''Returns directories changed since given timestamp according to Nextcloud's file cache
+
+        Returns None if the file cache can't be queried, so the whole tree is walked instead
+        '''
+        try:
+            cache = fileCache.openFileCache(fileCache.readConfig(self.NEXTCLOUD_CONFIG),
+                                            self.NEXTCLOUD_DATA)
+            try:
+                return cache.changedDirs(since)
+            finally:
+                cache.close()
+        except Exception as e:
+            self.reportError(('{}: caught error \'{}\' while attempting to query Nextcloud '
+                              'file cache'.format(datetime.datetime.now().strftime('%c'), e)))
+            return None
+
+    def openBundles(self):
+        '''Opens bundle store in mirror output mode if using --pack-size, or if the backup
+        already contains bundles so their files can be restored, scrubbed and replaced
+        '''
+        if self.args.output != 'mirror':
+            return
+
+        if os.path.isdir(os.path.join(self.NEXTCLOUD_DATA_BACKUP, BundleStore.BUNDLE_DIR)) or \
+                (self.args.pack_size and not self.args.dry_run):
+            self.bundles = BundleStore(self.NEXTCLOUD_DATA_BACKUP)
+
+    def isPacked(self, stat):
+        '''Returns True if file with given stat result is packed into a bundle'''
+        return (self.bundles is not None and stat is not None and
+                stat.st_size < self.args.pack_size * 1024)
+
+    def createThrottle(self):
+        '''Returns Throttle enforcing --max-rate, --max-files and --max-latency, or None if the
+        copy phase is unlimited
+
+        Latency is watched on the disk holding NEXTCLOUD_DATA, the backoff is disabled if it
+        isn't listed in /proc/diskstats
+        '''
+        if not (self.args.max_rate or self.args.max_files or self.args.max_latency):
+            return None
+
+        latency = None
+        if self.args.max_latency:
+            try:
+                latency = throttle.DiskLatency(os.stat(self.NEXTCLOUD_DATA).st_dev)
+                if latency.last is None:
+                    raise OSError('device not found in {}'.format(latency.path))
+            except OSError as e:
+                latency = None
+                self.reportError(('{}: caught error \'{}\' while attempting to read latency of '
+                                  'disk holding \'{}\''.format(datetime.datetime.now().strftime('%c'),
+                                                                 e, self.NEXTCLOUD_DATA)))
+
+        return throttle.Throttle(self.args.max_rate * 1024 * 1024, self.args.max_files, latency,
+                                 self.args.max_latency)
+
+    def setIoPriority(self):
+        '''Lowers I/O scheduling class of this run if using --ionice, inherited by copy workers'''
+        if self.args.ionice == 'none':
+            return
+
+        try:
+            throttle.setIoPriority(self.args.ionice)
+        except OSError as e:
+            self.reportError(('{}: caught error \'{}\' while attempting to set I/O scheduling '
+                              'class \'{}\''.format(datetime.datetime.now().strftime('%c'), e,
+                                                      self.args.ionice)))
+
+    def findChangedDirs(self, runStart):
+        '''Sets directories to list instead of walking NEXTCLOUD_DATA, depending on --changes
+
+        The whole tree is walked if the change source can't tell what changed, and at least
+        every --reconcile-days days to catch changes it missed (e.g. files modified outside
+        Nextcloud). Returns claim token of the change tracking daemon's dirty set, or None
+        '''
+        token = directories = None
+        if self.args.changes == 'watch':
+            token, directories = self.claimChanges()
+        elif self.args.changes == 'filecache':
+            since = self.manifest.getState('last_run')
+            if since is not None:
+                directories = self.queryFileCache(since)
+
+        # new extra targets need every file, so the whole tree is walked
+        lastFullScan = self.manifest.getState('full_scan')
+        if directories is not None and (lastFullScan is None or self.newTargets or
+                                        runStart - lastFullScan >= self.args.reconcile_days * 86400):
+            directories = None
+
+        self.scanDirs = (None if directories is None else
+                         [os.path.join(self.NEXTCLOUD_DATA, x) for x in directories])
+        self.metrics.info['full_scan'] = directories is None
+        if self.args.verbose and self.args.changes != 'scan':
+            print('walking whole data directory' if directories is None else
+                  'listing {} changed directories'.format(len(directories)))
+
+        return token
+
+    def freezeData(self):
+        '''Keeps files from changing while they are backed up, depending on --freeze
+
+        A filesystem snapshot only takes a few seconds, during which Nextcloud is kept in
+        maintenance mode if using --quiesce so no upload is caught halfway, and files are then
+        read from the snapshot. With 'maintenance', Nextcloud stays in maintenance mode until
+        the backup is done. Either way, the time data was frozen at is recorded as the cutoff
+        of the next run
+        '''
+        if self.args.freeze == 'none' or self.args.dry_run:
+            return
+
+        if self.args.freeze == 'maintenance':
+            self.cutoff = datetime.datetime.now()
+            self.setMaintenance(True)
+            return
+
+        try:
+            snapshot = freeze.Freeze(self.args.freeze, self.NEXTCLOUD_DATA, self.executeCommand,
+                                     self.NEXTCLOUD_SNAPSHOT_MOUNT)
+        except (OSError, ValueError) as e:
+            sys.exit('Error: unable to freeze data directory: {}'.format(e))
+
+        if self.args.quiesce:
+            self.setMaintenance(True)
+
+        # snapshot is released by tearDown(), even if it was only partly created
+        self.freeze = snapshot
+        try:
+            with self.metrics.span('freeze'):
+                frozenData = snapshot.create()
+        except OSError as e:
+            sys.exit('Error: unable to freeze data directory: {}'.format(e))
+        finally:
+            if self.args.quiesce:
+                self.setMaintenance(False)
+
+        # a snapshot missing the data would make every backed up file look removed
+        if not os.path.isdir(frozenData) or (not os.listdir(frozenData) and
+                                             (self.manifest.hasDir('') or self.manifest.childDirs(''))):
+            sys.exit('Error: snapshot \'{}\' doesn\'t contain the data directory'.format(frozenData))
+
+        self.liveData = self.NEXTCLOUD_DATA
+        self.NEXTCLOUD_DATA = frozenData
+        self.cutoff = snapshot.time
+        if self.scanDirs is not None:
+            self.scanDirs = [self.currentPath(x) for x in self.scanDirs]
+
+        if self.args.verbose:
+            print('backing up {} snapshot \'{}\' taken at {}'
+                  .format(self.args.freeze, frozenData, snapshot.time.strftime('%c')))
+
+    def thaw(self):
+        '''Leaves maintenance mode if enabled by this run and releases data snapshot'''
+        if self.maintenance:
+            self.setMaintenance(False)
+
+        if self.freeze is not None:
+            snapshot, self.freeze = self.freeze, None
+            snapshot.release()
+
+    def setMaintenance(self, enabled):
+        '''Turns Nextcloud's maintenance mode on or off through occ'''
+        self.executeCommand('{} maintenance:mode --{}'.format(self.NEXTCLOUD_OCC,
+                                                             'on' if enabled else 'off'))
+        self.maintenance = enabled
+
+    def livePath(self, path):
+        '''Returns path of a file read from the data snapshot inside the live data directory
+
+        Paths kept across runs, in the journal and errored files log, always use the live data
+        directory, since the next run may not back up from a snapshot
+        '''
+        if self.liveData is None or not path.startswith(self.NEXTCLOUD_DATA):
+            return path
+
+        return self.liveData + path[len(self.NEXTCLOUD_DATA):]
+
+    def currentPath(self, path):
+        '''Returns path of a file of the live data directory inside the data snapshot'''
+        if self.liveData is None or not path.startswith(self.liveData):
+            return path
+
+        return self.NEXTCLOUD_DATA + path[len(self.liveData):]
+
+    def main(self):
+        '''Main routine to perform incremental backup
+
+        Scanning and copying overlap: changed files are streamed from the scan into bounded
+        queues consumed by copy worker threads, so copying starts as soon as the first changed
+        file is found and memory use does not grow with the number of changed files. When
+        using more than one job, small and large files go to separate queues and worker pools,
+        since small files are dominated by per-file latency and benefit from many concurrent
+        workers, while large files are bandwidth bound and only need a few workers
+        '''
+        start = time.monotonic()
+        runStart = time.time()
+        self.filters = self.loadFilters()
+        self.setIoPriority()
+        self.throttle = self.createThrottle()
+        self.openBundles()
+        if self.args.restore:
+            self.restoreBackup()
+            return
+
+        # files changed from now on are checked again by the next run
+        self.cutoff = datetime.datetime.now()
+
+        # get datetime of last backup
+        lastBackup = datetime.datetime.strptime(self.log.readlines()[-1].strip('\n'), '%c')
+
+        # archives are a separate backup chain, so they need their own manifest
+        if self.args.output == 'archive':
+            self.manifest = Manifest(self.NEXTCLOUD_ARCHIVE_MANIFEST)
+        else:
+            self.manifest = Manifest(self.NEXTCLOUD_BACKUP_MANIFEST)
+
+        # packed files are indexed in the bundles before the manifest records them
+        if self.bundles is not None:
+            self.manifest.flushFirst.append(self.bundles.flush)
+
+        if self.args.scrub:
+            self.scrubBackup(runStart)
+            return
+
+        self.newTargets = self.findNewTargets()
+        if self.newTargets and self.args.verbose:
+            print('copying every file to new targets {}'.format(', '.join(self.newTargets)))
+
+        if not self.args.dry_run:
+            self.resumeJournal()
+            if self.checkBackupIdentity() and self.resumed is not None:
+                self.resumed.scanned = set()
+
+        token = self.findChangedDirs(runStart)
+
+        # freeze after claiming changes, so changes made meanwhile are also kept for next run
+        self.freezeData()
+
+        if self.args.output == 'store' and not self.args.dry_run:
+            self.store = ContentStore(self.NEXTCLOUD_DATA_BACKUP)
+
+        # back up into a new snapshot, linking unchanged files from the previous one
+        self.backupRoot = self.referenceRoot = self.NEXTCLOUD_DATA_BACKUP
+        if self.args.output == 'snapshot':
+            self.snapshots = SnapshotSet(os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.SNAPSHOT_DIR))
+            self.referenceRoot = self.snapshots.latest() or self.backupRoot
+            if not self.args.dry_run:
+                self.backupRoot = self.snapshots.begin(datetime.datetime.now())
+
+        # archive every file missing from the archive manifest
+        if self.args.output == 'archive':
+            self.referenceRoot = None
+            if not self.args.dry_run:
+                self.archive = ArchiveWriter(os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.ARCHIVE_DIR),
+                                             datetime.datetime.now().strftime(SnapshotSet.NAME_FORMAT),
+                                             self.args.volume_size * 1024 * 1024)
+                # archived members must be on disk before the manifest or journal records them
+                self.manifest.flushFirst.append(self.archive.sync)
+                self.journal.syncFirst.append(self.archive.sync)
+
+        smallQueue = queue.Queue(self.QUEUE_SIZE)
+        largeQueue = smallQueue
+        workers = [(smallQueue, threading.Thread(target=self.copyWorker, args=(smallQueue,)))
+                   for _ in range(self.args.jobs)]
+        if self.args.jobs > 1:
+            largeQueue = queue.Queue(self.QUEUE_SIZE)
+            workers += [(largeQueue, threading.Thread(target=self.copyWorker, args=(largeQueue,)))
+                        for _ in range(max(1, self.args.jobs // self.LARGE_FILE_JOBS_DIVISOR))]
+
+        for _, worker in workers:
+            worker.start()
+
+        try:
+            for src, stat, unchanged in self.changedFiles(lastBackup):
+                if not unchanged and stat is not None and stat.st_size >= self.LARGE_FILE_SIZE:
+                    largeQueue.put((src, stat, unchanged))
+                else:
+                    smallQueue.put((src, stat, unchanged))
+        finally:
+            # one sentinel per worker, then wait for queued files to finish copying
+            for work, _ in workers:
+                work.put(None)
+
+            for _, worker in workers:
+                worker.join()
+
+        if self.args.sync:
+            self.syncRemoved()
+
+        self.manifest.flush()
+        if self.journal is not None:
+            self.journal.complete()
+
+        # changes recorded while this run was scanning are kept for the next run
+        if not self.args.dry_run:
+            if token is not None:
+                self.dirtySet.release(token)
+
+            if self.scanDirs is None:
+                self.manifest.setState('full_scan', runStart)
+
+            self.manifest.setState('last_run', runStart)
+
+            # new targets now hold every file, files that failed are retried as errored files
+            for root in self.newTargets:
+                with open(os.path.join(root, self.TARGET_MARKER), 'w'):
+                    pass
+
+        # remove blobs whose paths were all replaced or removed during this run
+        if self.store is not None:
+            self.store.prune(os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.TRASH_DIR))
+
+        if self.archive is not None:
+            for volume in self.archive.close():
+                if self.args.verbose:
+                    print('wrote archive volume \'{}\''.format(volume))
+
+        if self.snapshots is not None and not self.args.dry_run:
+            self.snapshots.commit(self.backupRoot)
+            for name in self.snapshots.prune(self.args.keep_snapshots):
+                if self.args.verbose:
+                    print('removed snapshot \'{}\''.format(name))
+
+        self.metrics.addSpan('main', time.monotonic() - start)
+        if self.args.verbose and not self.args.dry_run:
+            elapsed = max(time.monotonic() - start, 1e-9)
+            print('copied {} bytes in {:.2f}s ({:.2f} MB/s) using \'{}\' copy backend'
+                  .format(self.copiedBytes, elapsed, self.copiedBytes / elapsed / 1e6,
+                          self.copyBackend or 'copy2'))
@@ -0,0 +1,98 @@
+'''Contains functions used to select files to restore from the backup and track progress
+
+Files are selected by patterns relative to the data directory: a user ('alice'), a path
+('alice/files/Photos') or a shell-style glob ('alice/files/*.pdf', where * also matches /).
+A file is restored if it or one of its parent directories matches a pattern, and only the
+directories under the literal prefix of each pattern are walked. Files whose size and
+modification time already match at the destination are skipped, so an interrupted restore can
+simply be run again.
+'''
+
+import datetime
+import fnmatch
+import os
+import threading
+import time
+
+GLOB_CHARS = '*?['
+
+def walkRoots(patterns):
+    '''Returns sorted list of directories to walk to find every file matching patterns'''
+    roots = set()
+    for pattern in patterns:
+        literal = []
+        for part in pattern.strip('/').split('/'):
+            if any(x in part for x in GLOB_CHARS):
+                break
+
+            literal.append(part)
+
+        roots.add('/'.join(literal))
+
+    # directories inside another root are walked with it
+    return [x for x in sorted(roots)
+            if not any(x != y and (not y or x.startswith(y + '/')) for y in roots)]
+
+def matches(relPath, patterns):
+    '''Returns True if relPath or one of its parent directories matches any of patterns'''
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+        if not pattern:
+            return True
+
+        path = relPath
+        while path:
+            if fnmatch.fnmatchcase(path, pattern):
+                return True
+
+            path = os.path.dirname(path)
+
+    return False
+
+def isIdentical(stat, dst):
+    '''Returns True if file at dst has the size and modification time given by stat'''
+    try:
+        current = os.stat(dst)
+    except OSError:
+        return False
+
+    return current.st_size == stat.st_size and current.st_mtime_ns == stat.st_mtime_ns
+
+def formatDuration(seconds):
+    '''Returns seconds formatted as H:MM:SS'''
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+class Progress:
+    '''Thread safe count of restored files and bytes, with estimated time remaining'''
+    def __init__(self, files, size, clock=time.monotonic):
+        '''Starts tracking restore of given number of files totalling size bytes'''
+        self.files = files
+        self.size = size
+        self.clock = clock
+        self.start = clock()
+        self.doneFiles = 0
+        self.doneBytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        '''Records that a file of size bytes was restored'''
+        with self.lock:
+            self.doneFiles += 1
+            self.doneBytes += size
+
+    def report(self):
+        '''Returns one line summary of progress, transfer rate and time remaining'''
+        with self.lock:
+            doneFiles, doneBytes = self.doneFiles, self.doneBytes
+
+        elapsed = max(self.clock() - self.start, 1e-9)
+        rate = doneBytes / elapsed
+        remaining = 'unknown'
+        if rate:
+            remaining = formatDuration((self.size - doneBytes) / rate)
+        elif doneFiles == self.files:
+            remaining = formatDuration(0)
+
+        return ('restored {}/{} files, {:.1f}/{:.1f} MB in {} ({:.2f} MB/s), {} remaining'
+                .format(doneFiles, self.files, doneBytes / 1e6, self.size / 1e6,
+                        formatDuration(elapsed), rate / 1e6, remaining))
@@ -0,0 +1,79 @@
+'''Contains functions used to verify backed up files against their recorded checksums
+
+A scrub reads back files from the backup disk and compares their digest with the one recorded
+in the manifest when they were copied, so bitrot on a drive that is spun down most of the time
+is found before a restore needs the file. Files are verified in batches sorted by the physical
+offset of their first extent, read through the FIEMAP ioctl, so the drive reads mostly
+sequentially. The key of the last verified file is saved after each batch, so an interrupted
+scrub resumes where it stopped.
+'''
+
+import json
+import os
+import struct
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl returning the extents of a file and its structures, from linux/fiemap.h
+FS_IOC_FIEMAP = 0xc020660b
+FIEMAP_HEADER = struct.Struct('QQIIII')
+FIEMAP_EXTENT = struct.Struct('QQQQQIIII')
+FIEMAP_MAX_OFFSET = 2 ** 64 - 1
+
+def physicalOffset(path):
+    '''Returns offset on disk of the first extent of file at path, or None if it's unknown'''
+    if fcntl is None:
+        return None
+
+    request = bytearray(FIEMAP_HEADER.pack(0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0) +
+                        bytes(FIEMAP_EXTENT.size))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    # empty files and filesystems without extents (e.g. tmpfs) map no extent
+    if not FIEMAP_HEADER.unpack_from(request)[3]:
+        return None
+
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+def diskOrder(paths):
+    '''Returns indices of paths sorted by physical offset, files without one first'''
+    offsets = [physicalOffset(x) for x in paths]
+    return sorted(range(len(paths)), key=lambda x: (offsets[x] is not None, offsets[x] or 0))
+
+def readCursor(path):
+    '''Returns (directory, name) of last file verified by an interrupted scrub, or None'''
+    try:
+        with open(path) as fp:
+            cursor = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    return cursor['dir'], cursor['name']
+
+def writeCursor(path, cursor):
+    '''Atomically saves (directory, name) of last verified file, or removes it if cursor is None'''
+    if cursor is None:
+        if os.path.exists(path):
+            os.remove(path)
+
+        return
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump({'dir': cursor[0], 'name': cursor[1]}, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.replace(tmp, path)
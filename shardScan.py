@@ -0,0 +1,149 @@
+'''Contains functions to walk directory trees spread over several devices concurrently
+
+On network filesystems (NFS, CephFS) listing a directory and reading file metadata are bound
+by round trip latency rather than bandwidth, so a single walker leaves both the network and the
+servers mostly idle. The tree is split into shards, such as the top level user directories and
+the mount points below them, and the shards of each device are walked by their own pool of
+threads sharing a stack of directories to list. The number of directories of a device listed at
+once adapts to it: it grows by one after each window of listings while the average latency per
+metadata operation stays close to the lowest seen, and is halved when the latency climbs, so a
+slow local disk isn't flooded with requests while a remote filesystem gets many in flight.
+Listings are merged into a single bounded queue consumed by the caller.
+'''
+
+import queue
+import threading
+import time
+
+# initial number of directories of a device listed at once
+INITIAL_JOBS = 2
+# number of listings per adjustment of the limit
+ADJUST_WINDOW = 32
+# latency above CONGESTION_FACTOR times the baseline halves the limit
+CONGESTION_FACTOR = 2.0
+# the baseline may rise by this factor per window, following slower devices
+BASELINE_DRIFT = 1.1
+
+class DeviceScan:
+    '''Directories of one device waiting to be listed, with an adaptive concurrency limit'''
+    def __init__(self, directories, maxJobs):
+        '''Starts scan of given shard directories listing at most maxJobs directories at once'''
+        self.pending = list(reversed(directories))
+        self.active = 0
+        self.maxJobs = maxJobs
+        self.limit = min(INITIAL_JOBS, maxJobs)
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.baseline = None
+        self.total = 0.0
+        self.samples = 0
+
+    def take(self):
+        '''Returns next directory to list, waiting for a free slot, or None once the device is
+        fully scanned or the scan is stopped
+        '''
+        with self.condition:
+            while True:
+                if self.stopped or (not self.pending and not self.active):
+                    return None
+
+                if self.pending and self.active < self.limit:
+                    self.active += 1
+                    return self.pending.pop()
+
+                self.condition.wait()
+
+    def done(self, subdirs, seconds, operations):
+        '''Records that a directory was listed in seconds using given number of metadata
+        operations, queueing its subdirectories
+        '''
+        with self.condition:
+            self.active -= 1
+            self.pending.extend(reversed(subdirs))
+            self.observe(seconds / max(operations, 1))
+            self.condition.notify_all()
+
+    def observe(self, latency):
+        '''Adds latency of one metadata operation, adjusting limit once per ADJUST_WINDOW'''
+        self.total += latency
+        self.samples += 1
+        if self.samples < ADJUST_WINDOW:
+            return
+
+        mean = self.total / self.samples
+        self.total = 0.0
+        self.samples = 0
+        if self.baseline is None:
+            self.baseline = mean
+        else:
+            self.baseline = min(mean, self.baseline * BASELINE_DRIFT)
+
+        if mean > self.baseline * CONGESTION_FACTOR:
+            self.limit = max(1, self.limit // 2)
+        elif self.limit < self.maxJobs:
+            self.limit += 1
+
+    def stop(self):
+        '''Makes waiting and future take() calls return None'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+def scan(shards, listDirectory, jobs, queueSize=1000):
+    '''Yields results of listDirectory for every directory of given (device, directory) shards
+
+    listDirectory(directory) must return (result, subdirectories, operations), where result is
+    yielded unless it is None and subdirectories are listed next on the same device. Each
+    device is walked by jobs threads. Results come in no particular order between directories
+    '''
+    byDevice = {}
+    for device, directory in shards:
+        byDevice.setdefault(device, []).append(directory)
+
+    scans = [DeviceScan(x, jobs) for x in byDevice.values()]
+    results = queue.Queue(queueSize)
+    finished = object()
+
+    def worker(deviceScan):
+        '''Lists directories of deviceScan until it is done'''
+        try:
+            while True:
+                directory = deviceScan.take()
+                if directory is None:
+                    return
+
+                start = time.perf_counter()
+                result, subdirs, operations = None, [], 1
+                try:
+                    result, subdirs, operations = listDirectory(directory)
+                finally:
+                    deviceScan.done(subdirs, time.perf_counter() - start, operations)
+
+                if result is not None:
+                    results.put(result)
+        finally:
+            results.put(finished)
+
+    threads = [threading.Thread(target=worker, args=(x,)) for x in scans for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+
+    running = len(threads)
+    try:
+        while running:
+            result = results.get()
+            if result is finished:
+                running -= 1
+            else:
+                yield result
+    finally:
+        # stop workers if the caller stopped early, draining results they are blocked on
+        for deviceScan in scans:
+            deviceScan.stop()
+
+        while running:
+            if results.get() is finished:
+                running -= 1
+
+        for thread in threads:
+            thread.join()
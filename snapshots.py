@@ -0,0 +1,60 @@
+'''Contains SnapshotSet class to manage dated snapshots of the backup
+
+Each snapshot is a full directory tree named after the time it was taken. Files that did not
+change since the previous snapshot are hardlinked to it, in the style of rsync --link-dest,
+so a snapshot only costs the changed bytes plus one link per unchanged file. Snapshots are
+created with a '.partial' suffix which is removed once the run completes, so an interrupted
+run never becomes the base of the next snapshot.
+'''
+
+import os
+import shutil
+
+class SnapshotSet:
+    '''Dated snapshot directories inside given root'''
+    NAME_FORMAT = '%Y-%m-%d_%H%M%S'
+    PARTIAL_SUFFIX = '.partial'
+
+    def __init__(self, root):
+        '''Uses given directory to hold snapshots, creating it if needed'''
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def list(self):
+        '''Returns names of completed snapshots, oldest first'''
+        return sorted(x for x in os.listdir(self.root)
+                      if not x.endswith(self.PARTIAL_SUFFIX) and
+                      os.path.isdir(os.path.join(self.root, x)))
+
+    def latest(self):
+        '''Returns path of most recent completed snapshot, or None if there are none'''
+        snapshots = self.list()
+        return os.path.join(self.root, snapshots[-1], '') if snapshots else None
+
+    def begin(self, when):
+        '''Starts snapshot for given datetime and returns its path
+
+        Leftovers of interrupted runs are removed first
+        '''
+        for name in os.listdir(self.root):
+            if name.endswith(self.PARTIAL_SUFFIX):
+                shutil.rmtree(os.path.join(self.root, name))
+
+        path = os.path.join(self.root, when.strftime(self.NAME_FORMAT) + self.PARTIAL_SUFFIX, '')
+        os.makedirs(path)
+        return path
+
+    def commit(self, path):
+        '''Marks snapshot started with begin() as complete and returns its final path'''
+        final = path.rstrip('/')[:-len(self.PARTIAL_SUFFIX)]
+        os.rename(path, final)
+        return os.path.join(final, '')
+
+    def prune(self, keep):
+        '''Removes all but the newest keep completed snapshots, returns names removed'''
+        snapshots = self.list()
+        removed = snapshots[:max(len(snapshots) - keep, 0)]
+        for name in removed:
+            shutil.rmtree(os.path.join(self.root, name))
+
+        return removed
@@ -8,8 +8,34 @@ from io import StringIO
 import os
 import shutil
 import datetime
+import tempfile
 from dateutil.relativedelta import relativedelta
-from nextcloudBackup import NextcloudBackup
+from nextcloudBackup import NextcloudBackup, BackupTarget
+import fileCopy
+import contentStore
+from snapshots import SnapshotSet
+import archive
+import tarfile
+import gzip
+import benchmark
+import json
+from metrics import RunMetrics
+from journal import RunJournal
+from manifest import Manifest
+from dirtySet import DirtySet
+from bundles import BundleStore
+import changeWatcher
+import devices
+import throttle
+import scrub
+import restore
+import shardScan
+from filters import Filters
+import freeze
+import fileCache
+import sqlite3
+import ctypes
+import errno
 
 class NextcloudBackupTests(TestCase):
     '''Class containing tests to verify functionality of NextcloudBackup class'''
@@ -154,151 +180,1121 @@ class NextcloudBackupTests(TestCase):
             self.assertEqual(self.obj.toBackup, self.SAMPLE_ERRORED_FILES.split('\n')[:-1])
             mockLog().write.assert_called_once_with(self.OLD_DUMMY_DATE)
 
-    @patch('os.path.exists', MagicMock(return_value=True))
-    @patch('os.stat', MagicMock(side_effect=[MagicMock(st_size=1), MagicMock(st_size=0)]))
-    @patch('os.path.isfile', MagicMock(return_value=True))
-    @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.mountBackupPartition', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.executeCommand', MagicMock(return_value=''))
-    @patch('shutil.copy2')
-    @patch('os.walk')
-    @patch('os.path.getmtime')
-    def test_main(self, mockGetmtime, mockWalk, mockShutil):
-        '''Tests that NextcloudBackup.main() can be run correctly'''
-        mockGetmtime.return_value = self.DUMMY_EPOCH_TIME
-        mockWalk.return_value = [(self.NEXTCLOUD_DATA, 'dirs', self.FAKE_FILES)]
+    def makeDataTree(self, files, mtime=DUMMY_EPOCH_TIME):
+        '''Creates temporary data directory containing files and points constants at it'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        data = os.path.join(tmp, 'data', '')
+        backup = os.path.join(tmp, 'backup', '')
+        os.makedirs(data)
+        for f in files:
+            path = os.path.join(data, f)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fp:
+                fp.write(f)
 
-        # log file setup
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+
+        patcher = patch.multiple(NextcloudBackup,
+                                 NEXTCLOUD_DATA=data,
+                                 NEXTCLOUD_DATA_BACKUP=backup,
+                                 NEXTCLOUD_BACKUP_MANIFEST=os.path.join(tmp, 'manifest.db'),
+                                 NEXTCLOUD_ARCHIVE_MANIFEST=os.path.join(tmp, 'archive_manifest.db'),
+                                 NEXTCLOUD_BACKUP_JOURNAL=os.path.join(tmp, 'journal.log'),
+                                 NEXTCLOUD_BACKUP_DIRTY=os.path.join(tmp, 'dirty.db'),
+                                 NEXTCLOUD_BACKUP_SCRUB=os.path.join(tmp, 'scrub.json'),
+                                 NEXTCLOUD_BACKUP_FILTERS=os.path.join(tmp, 'filters'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return data, backup
+
+    def createBackup(self, args, logData=OLD_DUMMY_DATE, erroredData=''):
+        '''Creates NextcloudBackup object with mocked log files and returns log file mocks'''
         mainHandler = mock_open()
-        mockLog = mock_open(read_data=self.OLD_DUMMY_DATE)
+        mockLog = mock_open(read_data=logData)
         mockError = mock_open()
-        mockErroredFiles = mock_open()
+        mockErroredFiles = mock_open(read_data=erroredData)
         mainHandler.side_effect = [
             mockLog.return_value,
             mockError.return_value,
             mockErroredFiles.return_value
         ]
 
-        with patch('builtins.open', mainHandler):
-            self.obj = NextcloudBackup(Namespace(dry_run=False, verbose=False))
-            self.obj.main()
-            self.assertEqual(mockShutil.call_count, 1)
-            self.assertEqual(self.obj.toBackup,
-                             [os.path.join(self.NEXTCLOUD_DATA, x) for x in self.FAKE_FILES])
+        with patch('os.stat', MagicMock(side_effect=[MagicMock(st_size=1),
+                                                     MagicMock(st_size=len(erroredData))])), \
+             patch('os.path.isfile', MagicMock(return_value=True)), \
+             patch('builtins.open', mainHandler), \
+             patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock()), \
+             patch('nextcloudBackup.NextcloudBackup.mountBackupPartition', MagicMock()), \
+             patch('nextcloudBackup.NextcloudBackup.executeCommand', MagicMock(return_value='')):
+            self.obj = NextcloudBackup(args)
+
+        return mockLog(), mockError(), mockErroredFiles()
+
+    def resetBackup(self):
+        '''Closes current NextcloudBackup object's manifest so a new object can be created'''
+        if self.obj.journal is not None:
+            self.obj.journal.close()
+
+        if self.obj.dirtySet is not None:
+            self.obj.dirtySet.close()
+
+        if self.obj.bundles is not None:
+            self.obj.bundles.close()
+
+        if self.obj.manifest is not None:
+            self.obj.manifest.close()
+
+        type(self.obj)._instance = None
 
-    @patch('os.path.exists', MagicMock(side_effect=[False, True, True]))
-    @patch('os.stat', MagicMock(side_effect=[MagicMock(st_size=1), MagicMock(st_size=0)]))
-    @patch('os.path.isfile', MagicMock(return_value=True))
-    @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.mountBackupPartition', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.executeCommand', MagicMock(return_value=''))
     @patch('shutil.copy2')
-    @patch('os.walk')
-    @patch('os.path.getmtime')
-    def test_no_exist_copy(self, mockGetmtime, mockWalk, mockShutil):
+    def test_main(self, mockShutil):
         '''Tests that NextcloudBackup.main() can be run correctly'''
+        data, _ = self.makeDataTree(self.FAKE_FILES)
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        self.obj.main()
+        self.assertEqual(mockShutil.call_count, 1)
+        self.assertEqual(mockShutil.call_args[0][0], os.path.join(data, self.FAKE_FILES[0]))
+
+    @patch('shutil.copy2')
+    def test_no_exist_copy(self, mockShutil):
+        '''Tests that NextcloudBackup.main() copies old files missing from the backup'''
         olderDate = datetime.datetime.strptime(self.OLD_DUMMY_DATE.strip('\n'), '%c') - relativedelta(years=5)
-        mockGetmtime.side_effect = [self.DUMMY_EPOCH_TIME, self.DUMMY_EPOCH_TIME, olderDate.timestamp()]
-        mockWalk.return_value = [(self.NEXTCLOUD_DATA, 'dirs', self.FAKE_FILES + ['file3.png'])]
+        data, _ = self.makeDataTree(self.FAKE_FILES)
+        open(os.path.join(data, 'file3.png'), 'w').close()
+        os.utime(os.path.join(data, 'file3.png'), (olderDate.timestamp(), olderDate.timestamp()))
 
-        # log file setup
-        mainHandler = mock_open()
-        mockLog = mock_open(read_data=self.OLD_DUMMY_DATE)
-        mockError = mock_open()
-        mockErroredFiles = mock_open()
-        mainHandler.side_effect = [
-            mockLog.return_value,
-            mockError.return_value,
-            mockErroredFiles.return_value
-        ]
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        self.obj.main()
+        self.assertEqual(mockShutil.call_count, 2)
+        self.assertEqual([x[0][0] for x in mockShutil.call_args_list],
+                         [os.path.join(data, x) for x in [self.FAKE_FILES[0], 'file3.png']])
 
-        with patch('builtins.open', mainHandler):
-            self.obj = NextcloudBackup(Namespace(dry_run=False, verbose=False))
+    @patch('shutil.copy2')
+    def test_main_errored_files_first(self, mockShutil):
+        '''Tests that files which errored during the last run are copied before scanned files'''
+        olderDate = datetime.datetime.strptime(self.OLD_DUMMY_DATE.strip('\n'), '%c') - relativedelta(years=5)
+        data, backup = self.makeDataTree(['z/old.txt', 'a/new.txt'])
+        os.utime(os.path.join(data, 'z', 'old.txt'), (olderDate.timestamp(), olderDate.timestamp()))
+        os.makedirs(os.path.join(backup, 'z'))
+        open(os.path.join(backup, 'z', 'old.txt'), 'w').close()
+
+        self.createBackup(Namespace(dry_run=False, verbose=False),
+                          erroredData=os.path.join(data, 'z', 'old.txt') + '\n')
+        self.obj.main()
+        self.assertEqual([x[0][0] for x in mockShutil.call_args_list],
+                         [os.path.join(data, 'z', 'old.txt'), os.path.join(data, 'a', 'new.txt')])
+
+    def test_manifest_skips_unchanged(self):
+        '''Tests that files recorded in the manifest are skipped without checking the backup'''
+        data, backup = self.makeDataTree(self.FAKE_FILES + ['sub/file3.png'])
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        self.obj.main()
+        self.assertTrue(os.path.isfile(os.path.join(backup, 'sub', 'file3.png')))
+        self.resetBackup()
+
+        # modify one file, everything else is known to the manifest
+        with open(os.path.join(data, 'file1.txt'), 'a') as fp:
+            fp.write('changed')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch('os.path.exists', MagicMock(return_value=True)) as mockExists, \
+             patch('shutil.copy2', wraps=shutil.copy2) as mockShutil:
             self.obj.main()
-            self.assertEqual(mockShutil.call_count, 2)
-            self.assertEqual(self.obj.toBackup,
-                             [os.path.join(self.NEXTCLOUD_DATA, x) for x in self.FAKE_FILES + ['file3.png']])
+            checked = [x[0][0] for x in mockExists.call_args_list]
+            self.assertNotIn(os.path.join(backup, 'file1.txt'), checked)
+            self.assertNotIn(os.path.join(backup, 'sub', 'file3.png'), checked)
+            mockShutil.assert_called_once_with(os.path.join(data, 'file1.txt'),
+                                               os.path.join(backup, 'file1.txt'))
 
-    @patch('os.makedirs', MagicMock())
-    @patch('shutil.copy2', MagicMock())
-    @patch('os.path.exists', MagicMock(side_effect=[False, True]))
-    @patch('os.stat', MagicMock(side_effect=[MagicMock(st_size=1), MagicMock(st_size=0)]))
-    @patch('os.path.isfile', MagicMock(return_value=True))
+    def test_manifest_seeded_from_existing_backup(self):
+        '''Tests that files already present in the backup are recorded without being copied'''
+        olderDate = datetime.datetime.strptime(self.OLD_DUMMY_DATE.strip('\n'), '%c') - relativedelta(years=5)
+        data, backup = self.makeDataTree(['file1.txt'], olderDate.timestamp())
+        os.makedirs(backup)
+        shutil.copy2(os.path.join(data, 'file1.txt'), backup)
+
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertFalse(mockShutil.called)
+
+        known = self.obj.manifest.lookupDir('')
+        self.assertEqual(known['file1.txt'][0], os.stat(os.path.join(data, 'file1.txt')).st_size)
+
+    def test_manifest_backup_replaced(self):
+        '''Tests that every file is backed up again to a replaced or rotated backup disk'''
+        data, backup = self.makeDataTree(self.FAKE_FILES)
+        for _ in range(2):
+            self.createBackup(Namespace(dry_run=False, verbose=False))
+            self.obj.main()
+            self.resetBackup()
+
+        self.assertTrue(os.path.isfile(os.path.join(backup, NextcloudBackup.BACKUP_ID_FILE)))
+        for replaced in ['', '1']:
+            shutil.rmtree(backup)
+            os.makedirs(backup)
+            if replaced:
+                with open(os.path.join(backup, NextcloudBackup.BACKUP_ID_FILE), 'w') as fp:
+                    fp.write(replaced)
+
+            self.createBackup(Namespace(dry_run=False, verbose=False))
+            self.obj.main()
+            self.assertTrue(os.path.isfile(os.path.join(backup, self.FAKE_FILES[0])))
+            self.resetBackup()
+
+        # a matching identity keeps the manifest
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertFalse(mockShutil.called)
+
+        self.assertEqual(self.obj.manifest.getState('backup_id'), 1)
+
+    def test_main_parallel(self):
+        '''Tests that NextcloudBackup.main() copies every file when using multiple jobs'''
+        files = ['a/{}.txt'.format(x) for x in range(20)] + ['b/c/big.bin', 'b/skip.part']
+        data, backup = self.makeDataTree(files)
+        with open(os.path.join(data, 'b', 'c', 'big.bin'), 'wb') as fp:
+            fp.truncate(NextcloudBackup.LARGE_FILE_SIZE)
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, jobs=4))
+        self.obj.main()
+        for f in files[:-1]:
+            self.assertTrue(os.path.isfile(os.path.join(backup, f)))
+
+        self.assertFalse(os.path.exists(os.path.join(backup, 'b', 'skip.part')))
+        self.assertEqual(len(self.obj.manifest.lookupDir('a')), 20)
+
+    @patch('nextcloudBackup.NextcloudBackup.DELTA_MIN_SIZE', 1)
+    def test_main_delta(self):
+        '''Tests that NextcloudBackup.main() updates files in place when using --delta'''
+        data, backup = self.makeDataTree(['new.txt', 'old.txt'])
+        os.makedirs(backup)
+        with open(os.path.join(backup, 'old.txt'), 'w') as fp:
+            fp.write('stale')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, delta=True))
+        with patch('fileCopy.deltaCopy', wraps=fileCopy.deltaCopy) as mockDelta:
+            self.obj.main()
+            self.assertEqual(mockDelta.call_count, 2)
+
+        for f in ['new.txt', 'old.txt']:
+            with open(os.path.join(backup, f)) as fp:
+                self.assertEqual(fp.read(), f)
+
+    def test_main_store(self):
+        '''Tests that store output mode keeps one copy of duplicated files'''
+        data, backup = self.makeDataTree(['a/photo.jpg', 'b/photo.jpg', 'c/other.jpg'])
+        with open(os.path.join(data, 'b', 'photo.jpg'), 'w') as fp:
+            fp.write('a/photo.jpg')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='store'))
+        self.obj.main()
+        self.assertTrue(os.path.samefile(os.path.join(backup, 'a', 'photo.jpg'),
+                                         os.path.join(backup, 'b', 'photo.jpg')))
+        self.assertFalse(os.path.samefile(os.path.join(backup, 'a', 'photo.jpg'),
+                                          os.path.join(backup, 'c', 'other.jpg')))
+        self.assertIsNotNone(self.obj.manifest.findDigest(os.stat(os.path.join(data, 'c', 'other.jpg'))))
+        old = self.obj.store.blobPath(self.obj.manifest.lookupDigest('c', 'other.jpg'))
+        self.resetBackup()
+
+        # blob of the replaced version is pruned without listing the store
+        with open(os.path.join(data, 'c', 'other.jpg'), 'w') as fp:
+            fp.write('changed')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='store'))
+        with patch('os.scandir', wraps=os.scandir) as mockScandir:
+            self.obj.main()
+
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(any(x[0][0].startswith(self.obj.store.objects)
+                             for x in mockScandir.call_args_list))
+
+    def test_main_store_rename(self):
+        '''Tests that store output mode links renamed files without reading them again'''
+        data, backup = self.makeDataTree(['a/photo.jpg', 'a/old.jpg'])
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='store'))
+        self.obj.main()
+        self.resetBackup()
+
+        os.rename(os.path.join(data, 'a', 'photo.jpg'), os.path.join(data, 'a', 'renamed.jpg'))
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='store'))
+        with patch('contentStore.hashFile') as mockHash:
+            self.obj.main()
+            self.assertFalse(mockHash.called)
+
+        with open(os.path.join(backup, 'a', 'renamed.jpg')) as fp:
+            self.assertEqual(fp.read(), 'a/photo.jpg')
+
+        # no new blob is stored for the renamed file
+        blobs = [f for _, _, files in os.walk(os.path.join(backup, '.store', 'objects')) for f in files]
+        self.assertEqual(len(blobs), 2)
+
+    def test_main_sync(self):
+        '''Tests that --sync renames backups of renamed files and trashes removed ones'''
+        data, backup = self.makeDataTree(['a.txt', 'keep.txt', 'docs/b.txt', 'old/c.txt',
+                                          'old/sub/d.txt'])
+        self.createBackup(Namespace(dry_run=False, verbose=False, sync=True))
+        self.obj.main()
+        self.resetBackup()
+
+        os.remove(os.path.join(data, 'a.txt'))
+        os.rename(os.path.join(data, 'docs'), os.path.join(data, 'moved'))
+        shutil.rmtree(os.path.join(data, 'old'))
+        self.createBackup(Namespace(dry_run=False, verbose=False, sync=True))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertFalse(mockShutil.called)
+
+        with open(os.path.join(backup, 'moved', 'b.txt')) as fp:
+            self.assertEqual(fp.read(), 'docs/b.txt')
+
+        trash = os.path.join(backup, NextcloudBackup.TRASH_DIR)
+        trashed = sorted(os.path.relpath(os.path.join(d, f), trash).split('/', 1)[1]
+                         for d, _, files in os.walk(trash) for f in files)
+        self.assertEqual(trashed, ['a.txt', 'old/c.txt', 'old/sub/d.txt'])
+        self.assertFalse(os.path.exists(os.path.join(backup, 'old')))
+        self.assertEqual(set(self.obj.manifest.lookupDir('')), {'keep.txt'})
+        self.assertEqual(set(self.obj.manifest.lookupDir('moved')), {'b.txt'})
+        self.assertEqual(self.obj.manifest.childDirs(''), {'moved'})
+        self.assertEqual(self.obj.metrics.counters['files_renamed'], 1)
+
+        # expired trash is emptied, and removed files are deleted right away without trash
+        self.resetBackup()
+        os.makedirs(os.path.join(trash, '2000-01-01_000000'))
+        os.remove(os.path.join(data, 'keep.txt'))
+        self.createBackup(Namespace(dry_run=False, verbose=False, sync=True, trash_days=0))
+        self.obj.main()
+        self.assertEqual(os.listdir(trash), [])
+        self.assertFalse(os.path.exists(os.path.join(backup, 'keep.txt')))
+
+    def test_main_targets(self):
+        '''Tests that changed files are written to every target, and --sync applies to each of them'''
+        data, backup = self.makeDataTree(['a.txt', 'docs/b.txt'])
+        second = os.path.join(os.path.dirname(os.path.dirname(data)), 'second')
+        os.makedirs(second)
+        args = Namespace(dry_run=False, verbose=False, sync=True, trash_days=0, targets=[second])
+        self.createBackup(args)
+        self.assertEqual(self.obj.backupTargets()[1], BackupTarget(second + '/', None))
+        self.obj.main()
+        self.resetBackup()
+        for root in [backup, second]:
+            with open(os.path.join(root, 'docs', 'b.txt')) as fp:
+                self.assertEqual(fp.read(), 'docs/b.txt')
+
+        # renamed on the first target, and copied to a target missing the old backup
+        os.remove(os.path.join(second, 'a.txt'))
+        os.rename(os.path.join(data, 'a.txt'), os.path.join(data, 'c.txt'))
+        shutil.rmtree(os.path.join(data, 'docs'))
+        self.createBackup(args)
+        self.obj.main()
+        self.resetBackup()
+        self.assertEqual(sorted(os.listdir(backup)), [NextcloudBackup.BACKUP_ID_FILE, 'c.txt'])
+        self.assertEqual(sorted(os.listdir(second)), [NextcloudBackup.TARGET_MARKER, 'c.txt'])
+
+        # a target added later gets unchanged files too
+        third = os.path.join(os.path.dirname(second), 'third')
+        os.makedirs(third)
+        args.targets = [second, third]
+        self.createBackup(args)
+        self.obj.main()
+        self.resetBackup()
+        self.assertEqual(sorted(os.listdir(third)), [NextcloudBackup.TARGET_MARKER, 'c.txt'])
+        self.assertEqual(self.obj.metrics.counters['files_copied'], 1)
+
+        # a rename failing on one target is copied to every target
+        os.rename(os.path.join(data, 'c.txt'), os.path.join(data, 'd.txt'))
+        replace = os.replace
+
+        def failingReplace(src, dst):
+            '''Fails to rename backups in the second target'''
+            if dst.startswith(second):
+                raise OSError('FAKE ERROR')
+
+            replace(src, dst)
+
+        self.createBackup(args)
+        with patch('os.replace', side_effect=failingReplace), redirect_stderr(StringIO()):
+            self.obj.main()
+
+        for root in [second, third]:
+            self.assertEqual(sorted(os.listdir(root)), [NextcloudBackup.TARGET_MARKER, 'd.txt'])
+
+        self.assertEqual(sorted(os.listdir(backup)), [NextcloudBackup.BACKUP_ID_FILE, 'd.txt'])
+        self.assertEqual(set(self.obj.manifest.lookupDir('')), {'d.txt'})
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False,
+                                                          targets=['relative']))
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False,
+                                                          targets=[second], output='store'))
+
+    @patch('shutil.copy2')
+    def test_main_throttle(self, mockShutil):
+        '''Tests that NextcloudBackup.main() waits for the throttle and drops copied files from cache'''
+        self.makeDataTree(self.FAKE_FILES)
+        self.createBackup(Namespace(dry_run=False, verbose=False, max_files=1000.0, drop_cache=True,
+                                    ionice='idle'))
+        with patch('throttle.dropCache') as mockDrop, \
+             patch('throttle.setIoPriority') as mockPriority:
+            self.obj.main()
+            self.assertEqual(mockDrop.call_count, 2)
+            # the copy is written back first, or its dirty pages aren't dropped
+            self.assertEqual(mockDrop.call_args_list[1][1], {'writeBack': True})
+
+        mockPriority.assert_called_once_with('idle')
+        self.assertEqual(self.obj.metrics.histograms['throttle'].count, 1)
+        self.resetBackup()
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False, max_rate=-1.0))
+
+    def test_main_scrub(self):
+        '''Tests that --scrub reports corrupted and missing backups, and resumes after saved cursor'''
+        data, backup = self.makeDataTree(['a.txt', 'b.txt', 'docs/c.txt'])
+        self.createBackup(Namespace(dry_run=False, verbose=False, checksum=True))
+        self.obj.main()
+        self.assertEqual(self.obj.manifest.findDigest(os.stat(os.path.join(data, 'a.txt'))),
+                         contentStore.hashFile(os.path.join(data, 'a.txt')))
+        self.resetBackup()
+
+        with open(os.path.join(backup, 'b.txt'), 'w') as fp:
+            fp.write('bitrot')
+
+        os.remove(os.path.join(backup, 'docs', 'c.txt'))
+        _, _, mockErroredFiles = self.createBackup(Namespace(dry_run=False, verbose=False, scrub=True,
+                                                             jobs=2))
+        self.obj.main()
+        self.assertEqual(sorted(x[0][0] for x in mockErroredFiles.write.call_args_list),
+                         [os.path.join(data, 'b.txt\n'), os.path.join(data, 'docs', 'c.txt\n')])
+        self.assertEqual(self.obj.metrics.counters['files_scrubbed'], 2)
+        self.assertEqual(self.obj.metrics.counters['files_corrupted'], 2)
+        self.assertFalse(os.path.exists(NextcloudBackup.NEXTCLOUD_BACKUP_SCRUB))
+        self.assertIsNotNone(self.obj.manifest.getState('last_scrub'))
+        self.resetBackup()
+
+        # an interrupted scrub resumes after the last verified file
+        scrub.writeCursor(NextcloudBackup.NEXTCLOUD_BACKUP_SCRUB, ('', 'b.txt'))
+        _, _, mockErroredFiles = self.createBackup(Namespace(dry_run=False, verbose=False, scrub=True))
+        self.obj.main()
+        mockErroredFiles.write.assert_called_once_with(os.path.join(data, 'docs', 'c.txt\n'))
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False, scrub=True,
+                                                          output='archive'))
+
+    def test_main_restore(self):
+        '''Tests that --restore copies files matching patterns back, skipping identical ones'''
+        data, backup = self.makeDataTree(['alice/files/a.txt', 'alice/files/sub/b.txt',
+                                          'bob/files/c.txt', 'bob/files/d.pdf', 'carol/files/e.txt'])
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        self.obj.main()
+        self.resetBackup()
+
+        shutil.rmtree(os.path.join(data, 'alice'))
+        for name in ['bob/files/c.txt', 'bob/files/d.pdf', 'carol/files/e.txt']:
+            os.remove(os.path.join(data, name))
+
+        os.makedirs(os.path.join(backup, NextcloudBackup.TRASH_DIR, 'x'))
+        self.createBackup(Namespace(dry_run=False, verbose=False, jobs=2,
+                                    restore=['alice', 'bob/files/*.txt']))
+        with redirect_stdout(StringIO()) as out:
+            self.obj.main()
+
+        restored = sorted(os.path.relpath(os.path.join(d, f), data)
+                          for d, _, files in os.walk(data) for f in files)
+        self.assertEqual(restored, ['alice/files/a.txt', 'alice/files/sub/b.txt', 'bob/files/c.txt'])
+        self.assertEqual(os.stat(os.path.join(data, 'bob/files/c.txt')).st_mtime, self.DUMMY_EPOCH_TIME)
+        self.assertIn('restored 3/3 files', out.getvalue())
+        self.resetBackup()
+
+        # restoring again skips identical files
+        self.createBackup(Namespace(dry_run=False, verbose=False, restore=['/']))
+        with redirect_stdout(StringIO()):
+            self.obj.main()
+
+        self.assertEqual(self.obj.metrics.counters['files_identical'], 3)
+        self.assertEqual(self.obj.metrics.counters['files_restored'], 2)
+        self.assertTrue(os.path.exists(os.path.join(data, 'carol/files/e.txt')))
+        self.assertFalse(os.path.exists(os.path.join(data, NextcloudBackup.TRASH_DIR)))
+        self.resetBackup()
+
+        # a destination that doesn't exist yet is created, one that can't be is an error
+        target = os.path.join(os.path.dirname(os.path.dirname(data)), 'new', 'data')
+        self.createBackup(Namespace(dry_run=False, verbose=False, restore=['bob'], restore_to=target))
+        with redirect_stdout(StringIO()):
+            self.obj.main()
+
+        self.assertEqual(sorted(os.listdir(os.path.join(target, 'bob/files'))), ['c.txt', 'd.pdf'])
+        self.resetBackup()
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, restore=['bob'],
+                                    restore_to=os.path.join(data, 'bob/files/c.txt', 'x')))
+        with self.assertRaises(SystemExit):
+            self.obj.main()
+
+    def test_main_pack(self):
+        '''Tests that --pack-size packs small files into bundles which can be scrubbed and restored'''
+        data, backup = self.makeDataTree(['thumbs/a.png', 'thumbs/b.png', 'big.bin'])
+        with open(os.path.join(data, 'big.bin'), 'wb') as fp:
+            fp.write(b'x' * 2048)
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, pack_size=1, checksum=True))
+        self.obj.main()
+        self.assertEqual(sorted(os.listdir(backup)), ['.bundles', NextcloudBackup.BACKUP_ID_FILE,
+                                                     'big.bin'])
+        self.assertEqual(self.obj.bundles.read(self.obj.bundles.lookup('thumbs', 'b.png')),
+                         b'thumbs/b.png')
+        self.resetBackup()
+
+        # a packed file growing past the threshold is copied as is
+        with open(os.path.join(data, 'thumbs', 'a.png'), 'wb') as fp:
+            fp.write(b'y' * 2048)
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, pack_size=1, checksum=True))
+        self.obj.main()
+        self.assertIsNone(self.obj.bundles.lookup('thumbs', 'a.png'))
+        self.assertTrue(os.path.isfile(os.path.join(backup, 'thumbs', 'a.png')))
+        self.resetBackup()
+
+        _, _, mockErroredFiles = self.createBackup(Namespace(dry_run=False, verbose=False, scrub=True))
+        self.obj.main()
+        self.assertEqual(self.obj.metrics.counters['files_scrubbed'], 3)
+        self.assertFalse(mockErroredFiles.write.called)
+        self.resetBackup()
+
+        restored = os.path.join(os.path.dirname(os.path.dirname(data)), 'restored')
+        os.makedirs(restored)
+        self.createBackup(Namespace(dry_run=False, verbose=False, restore=['thumbs/b.png'],
+                                    restore_to=restored))
+        with redirect_stdout(StringIO()):
+            self.obj.main()
+
+        with open(os.path.join(restored, 'thumbs', 'b.png')) as fp:
+            self.assertEqual(fp.read(), 'thumbs/b.png')
+
+        self.assertEqual(os.stat(os.path.join(restored, 'thumbs', 'b.png')).st_mtime,
+                         self.DUMMY_EPOCH_TIME)
+        self.assertEqual(os.listdir(restored), ['thumbs'])
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False, pack_size=1,
+                                                          output='store'))
+
+    def test_main_filters(self):
+        '''Tests that excluded directories are pruned and excluded files are skipped'''
+        data, backup = self.makeDataTree(['appdata_x/preview/1.png', 'appdata_x/avatar.png',
+                                          'updater-1/a.php', 'alice/updater-2/b.txt',
+                                          'alice/files/app.log', 'alice/files/nextcloud.log',
+                                          'alice/files_trashbin/old.txt', 'alice/files/big.iso'])
+        with open(os.path.join(data, 'alice/files/big.iso'), 'w') as fp:
+            fp.write('x' * 2048)
+
+        with open(NextcloudBackup.NEXTCLOUD_BACKUP_FILTERS, 'w') as fp:
+            fp.write('# unwanted trees\nappdata_*/preview/\n/updater-*\nfiles_trashbin/\n'
+                     '*.log\n!nextcloud.log\nmax-size 1K *.iso\n')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch('os.scandir', wraps=os.scandir) as mockScandir:
+            self.obj.main()
+
+        listed = {os.path.relpath(x[0][0], data) for x in mockScandir.call_args_list}
+        self.assertNotIn('appdata_x/preview', listed)
+        self.assertNotIn('alice/files_trashbin', listed)
+        backedUp = sorted(os.path.relpath(os.path.join(d, f), backup)
+                          for d, _, files in os.walk(backup) for f in files)
+        self.assertEqual(backedUp, ['alice/files/nextcloud.log', 'alice/updater-2/b.txt',
+                                    'appdata_x/avatar.png'])
+
+        self.resetBackup()
+        self.createBackup(Namespace(dry_run=False, verbose=False, filters=os.path.join(data, 'missing')))
+        with self.assertRaises(SystemExit):
+            self.obj.main()
+
+    def test_main_scan_jobs(self):
+        '''Tests that a sharded scan backs up every file, walking nested mount points as shards'''
+        files = ['root.txt', 'alice/files/a.txt', 'alice/files/ext/b.txt', 'alice/files/ext/c/d.txt',
+                 'bob/files/e.txt', 'appdata_x/preview/f.png']
+        data, backup = self.makeDataTree(files)
+        mount = devices.Mount('server:/ext', os.path.realpath(os.path.join(data, 'alice/files/ext')),
+                              'nfs4', 'rw')
+        self.createBackup(Namespace(dry_run=False, verbose=False, scan_jobs=3))
+        with patch('devices.mounts', return_value=[mount]), \
+             patch('shardScan.scan', wraps=shardScan.scan) as mockScan:
+            self.obj.main()
+
+        shards = sorted(os.path.relpath(x[1], data) for x in mockScan.call_args[0][0])
+        self.assertEqual(shards, ['alice', 'alice/files/ext', 'appdata_x', 'bob'])
+        backedUp = sorted(os.path.relpath(os.path.join(d, f), backup)
+                          for d, _, names in os.walk(backup) for f in names)
+        self.assertEqual(backedUp, sorted(files))
+
+        # removed directories are still detected when listings come out of order
+        self.resetBackup()
+        shutil.rmtree(os.path.join(data, 'alice/files/ext/c'))
+        self.createBackup(Namespace(dry_run=False, verbose=False, scan_jobs=3, sync=True))
+        with patch('devices.mounts', return_value=[mount]):
+            self.obj.main()
+
+        self.assertFalse(os.path.exists(os.path.join(backup, 'alice/files/ext/c')))
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False, scan_jobs=0))
+
+    def test_main_freeze(self):
+        '''Tests that files are read from a snapshot taken in maintenance mode, and that paths
+        kept for the next run point at the live data directory
+        '''
+        data, backup = self.makeDataTree(['alice/files/a.txt', 'bob/files/b.txt'])
+        tmp = os.path.realpath(os.path.dirname(os.path.dirname(data)))
+        mountinfo = os.path.join(tmp, 'mountinfo')
+        with open(mountinfo, 'w') as fp:
+            fp.write('22 1 8:1 / / rw - ext4 /dev/sda1 rw\n'
+                     '40 22 0:50 / {} rw - btrfs /dev/sdb1 rw\n'.format(tmp))
+
+        view = os.path.join(tmp, '.' + freeze.SNAPSHOT_NAME)
+
+        def run(command):
+            '''Simulates occ and btrfs, changing a file right after the snapshot is taken'''
+            if command.startswith('btrfs subvolume snapshot'):
+                shutil.copytree(data, os.path.join(view, 'data'))
+                with open(os.path.join(data, 'alice/files/a.txt'), 'w') as fp:
+                    fp.write('changed')
+            elif command.startswith('btrfs subvolume delete'):
+                shutil.rmtree(view)
+
+            return ''
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, freeze='btrfs', quiesce=True))
+        with patch('devices.MOUNTINFO', mountinfo), patch('freeze.BTRFS_SUBVOLUME_INO', -1), \
+             patch('nextcloudBackup.NextcloudBackup.executeCommand', side_effect=run) as mockRun:
+            self.obj.main()
+            frozen = os.path.join(view, 'data', 'alice/files/a.txt')
+            self.assertEqual(self.obj.livePath(frozen), os.path.join(data, 'alice/files/a.txt'))
+            self.obj.thaw()
+
+        occ = NextcloudBackup.NEXTCLOUD_OCC + ' maintenance:mode --'
+        self.assertEqual([x[0][0] for x in mockRun.call_args_list],
+                         [occ + 'on', 'btrfs subvolume snapshot -r {} {}'.format(tmp, view),
+                          occ + 'off', 'btrfs subvolume delete {}'.format(view)])
+        with open(os.path.join(backup, 'alice/files/a.txt')) as fp:
+            self.assertEqual(fp.read(), 'alice/files/a.txt')
+
+        self.assertEqual(self.obj.manifest.lookupDir('alice/files').keys(), {'a.txt'})
+        self.assertFalse(os.path.exists(view))
+
+        with self.assertRaises(SystemExit):
+            NextcloudBackup.checkArgs(self.obj, Namespace(dry_run=False, verbose=False, quiesce=True))
+
+        def runEmpty(command):
+            '''Simulates a snapshot missing the data directory, as a nested subvolume would be'''
+            if command.startswith('btrfs subvolume snapshot'):
+                os.makedirs(os.path.join(view, 'data'))
+            elif command.startswith('btrfs subvolume delete'):
+                shutil.rmtree(view)
+
+            return ''
+
+        self.resetBackup()
+        self.createBackup(Namespace(dry_run=False, verbose=False, freeze='btrfs', sync=True))
+        with patch('devices.MOUNTINFO', mountinfo), patch('freeze.BTRFS_SUBVOLUME_INO', -1), \
+             patch('nextcloudBackup.NextcloudBackup.executeCommand', side_effect=runEmpty):
+            with self.assertRaises(SystemExit):
+                self.obj.main()
+
+            self.obj.tearDown()
+
+        self.assertTrue(os.path.exists(os.path.join(backup, 'alice/files/a.txt')))
+        self.assertFalse(os.path.exists(view))
+
+    def test_manifest_child_dirs(self):
+        '''Tests that Manifest.childDirs() finds children sorting between a directory and its subtree'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        manifest = Manifest(os.path.join(tmp, 'manifest.db'))
+        self.addCleanup(manifest.close)
+        stat = MagicMock(st_size=1, st_mtime_ns=1, st_ino=1)
+        for directory in ['a', 'a.b', 'a/x', 'a/x/y', 'a b/z', 'ab', 'c/d/e']:
+            manifest.record(directory, 'f', stat)
+
+        manifest.flush()
+        self.assertEqual(manifest.childDirs(''), {'a', 'a.b', 'a b', 'ab', 'c'})
+        self.assertEqual(manifest.childDirs('a'), {'x'})
+        self.assertEqual(manifest.childDirs('c'), {'d'})
+
+        manifest.removeTree('a')
+        self.assertEqual(manifest.childDirs(''), {'a.b', 'a b', 'ab', 'c'})
+
+    def test_mount_backup_partition(self):
+        '''Tests that the partition is found and mounted natively, running mount if the syscall fails'''
+        data, _ = self.makeDataTree([])
+        tmp = os.path.dirname(os.path.dirname(data))
+        os.makedirs(os.path.join(tmp, 'block'))
+        with open(os.path.join(tmp, 'mountinfo'), 'w') as fp:
+            fp.write(DevicesTests.MOUNTINFO)
+
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch.multiple(devices, MOUNTINFO=os.path.join(tmp, 'mountinfo'),
+                            SYS_BLOCK=os.path.join(tmp, 'block')), \
+             patch('nextcloudBackup.NextcloudBackup.NEXTCLOUD_BACKUP_PARTITION', '/dev/sdc1'), \
+             patch('devices.umount') as mockUmount, \
+             patch('devices.mount', MagicMock(side_effect=PermissionError(errno.EPERM, 'EPERM'))), \
+             patch('nextcloudBackup.NextcloudBackup.executeCommand') as mockCommand, \
+             patch('nextcloudBackup.NextcloudBackup.probeCopyBackend'):
+            self.obj.mountBackupPartition()
+            mockUmount.assert_called_once_with('/mnt/nextcloud backup')
+            mockCommand.assert_called_once_with('mount /dev/sdc1 {}'.format(self.obj.NEXTCLOUD_DATA_BACKUP))
+
+            self.assertFalse(self.obj.partitionExists())
+            os.symlink('../../devices/sdc/sdc1', os.path.join(tmp, 'block', 'sdc1'))
+            self.assertTrue(self.obj.partitionExists())
+
+    @patch('nextcloudBackup.NextcloudBackup.openLogFile')
     @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.mountBackupPartition', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.executeCommand', MagicMock(return_value=''))
-    @patch('os.walk')
-    @patch('os.path.getmtime')
-    def test_main_verbose(self, mockGetmtime, mockWalk):
-        '''Tests if NextcloudBackup.main() verbose messages print correctly'''
-        mockWalk.return_value = [(self.NEXTCLOUD_DATA, 'dirs', self.FAKE_FILES)]
-        mockGetmtime.return_value = self.DUMMY_EPOCH_TIME
+    def test_sync_archive(self, mockOpenLogFile):
+        '''Tests if SystemExit is raised if removed files are synced in archive output mode'''
+        mockOpenLogFile.side_effect = SystemExit('Did not raise SystemExit in checkArgs()')
+        with self.assertRaises(SystemExit) as err:
+            self.obj = NextcloudBackup(Namespace(verbose=False, dry_run=False, sync=True,
+                                                 output='archive'))
 
-        # log file setup
-        mainHandler = mock_open()
-        mockLog = mock_open(read_data=self.OLD_DUMMY_DATE)
-        mockError = mock_open()
-        mockErroredFiles = mock_open()
-        mainHandler.side_effect = [
-            mockLog.return_value,
-            mockError.return_value,
-            mockErroredFiles.return_value
-        ]
-        out = StringIO()
+        self.assertEqual(err.exception.code, 'Error: removed files can\'t be synced in archive output mode')
 
-        with patch('builtins.open', mainHandler):
-            with redirect_stdout(out):
-                self.obj = NextcloudBackup(Namespace(dry_run=False, verbose=True))
+    def test_store_prune(self):
+        '''Tests that ContentStore.prune() only removes released blobs no longer linked, keeping
+        blobs of trashed links until their trash directory is emptied
+        '''
+        data, backup = self.makeDataTree(['photo.jpg', 'other.jpg'])
+        store = contentStore.ContentStore(backup)
+        digest = store.add(os.path.join(data, 'photo.jpg'))
+        other = store.add(os.path.join(data, 'other.jpg'))
+        store.link(digest, os.path.join(backup, 'photo.jpg'))
+        store.link(other, os.path.join(backup, 'other.jpg'))
+        self.assertEqual(store.prune(), 0)
+
+        # unreleased blobs aren't checked
+        os.remove(os.path.join(backup, 'other.jpg'))
+        self.assertEqual(store.prune(), 0)
+        self.assertTrue(os.path.exists(store.blobPath(other)))
+
+        # replaced link, its previous digest is read from the file
+        store.link(other, os.path.join(backup, 'photo.jpg'))
+        self.assertEqual(store.prune(), 1)
+        self.assertFalse(os.path.exists(store.blobPath(digest)))
+
+        trashRoot = os.path.join(backup, NextcloudBackup.TRASH_DIR)
+        os.makedirs(os.path.join(trashRoot, 'old'))
+        os.rename(os.path.join(backup, 'photo.jpg'), os.path.join(trashRoot, 'old', 'photo.jpg'))
+        store.release(other, 'old')
+        self.assertEqual(store.prune(trashRoot), 0)
+
+        shutil.rmtree(os.path.join(trashRoot, 'old'))
+        self.assertEqual(contentStore.ContentStore(backup).prune(trashRoot), 1)
+        self.assertFalse(os.path.exists(store.blobPath(other)))
+
+    @patch('nextcloudBackup.NextcloudBackup.openLogFile')
+    @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
+    def test_bad_output_mode(self, mockOpenLogFile):
+        '''Tests if SystemExit is raised if output mode is unknown'''
+        mockOpenLogFile.side_effect = SystemExit('Did not raise SystemExit in checkArgs()')
+        with self.assertRaises(SystemExit) as err:
+            self.obj = NextcloudBackup(Namespace(verbose=False, dry_run=False, output='tape'))
+
+        self.assertEqual(err.exception.code, ('Error: unknown output mode \'tape\', expected one '
+                                              'of {}'.format(', '.join(NextcloudBackup.OUTPUT_MODES))))
+
+    def test_main_copy_backend(self):
+        '''Tests that main() copies files with the backend chosen by probeCopyBackend()'''
+        data, backup = self.makeDataTree(['a/file1.txt'])
+        os.makedirs(backup)
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch('builtins.open', wraps=open) as mockOpen:
+            self.obj.copyBackend = self.obj.probeCopyBackend()
+
+        # the data directory is only read
+        self.assertIn(self.obj.copyBackend, fileCopy.BACKENDS)
+        self.assertEqual({x[0][1] for x in mockOpen.call_args_list if x[0][0].startswith(data)},
+                         {'rb'})
+        self.assertEqual(os.listdir(data), ['a'])
+        self.assertEqual(os.listdir(backup), [])
+
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertFalse(mockShutil.called)
+
+        with open(os.path.join(backup, 'a', 'file1.txt')) as fp:
+            self.assertEqual(fp.read(), 'a/file1.txt')
+
+        self.assertEqual(self.obj.copiedBytes, len('a/file1.txt'))
+
+    def test_main_snapshot(self):
+        '''Tests that snapshot output mode links unchanged files to the previous snapshot'''
+        data, backup = self.makeDataTree(['a/same.txt', 'a/changed.txt'])
+        root = os.path.join(backup, NextcloudBackup.SNAPSHOT_DIR)
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='snapshot'))
+        with patch('datetime.datetime', self.MockDatetime):
+            self.obj.main()
+
+        self.resetBackup()
+        with open(os.path.join(data, 'a', 'changed.txt'), 'a') as fp:
+            fp.write('changed')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='snapshot'))
+        self.obj.main()
+
+        first, second = [os.path.join(root, x) for x in sorted(os.listdir(root))]
+        self.assertTrue(os.path.samefile(os.path.join(first, 'a', 'same.txt'),
+                                         os.path.join(second, 'a', 'same.txt')))
+        with open(os.path.join(first, 'a', 'changed.txt')) as fp:
+            self.assertEqual(fp.read(), 'a/changed.txt')
+
+        with open(os.path.join(second, 'a', 'changed.txt')) as fp:
+            self.assertEqual(fp.read(), 'a/changed.txtchanged')
+
+    def test_main_snapshot_interrupted(self):
+        '''Tests that files copied into an interrupted snapshot aren't linked from an older one'''
+        data, backup = self.makeDataTree(['a/file.txt'])
+        root = os.path.join(backup, NextcloudBackup.SNAPSHOT_DIR)
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='snapshot'))
+        with patch('datetime.datetime', self.MockDatetime):
+            self.obj.main()
+
+        # same size, newer modification time
+        self.resetBackup()
+        path = os.path.join(data, 'a', 'file.txt')
+        with open(path, 'w') as fp:
+            fp.write('a/file.tx2')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='snapshot'))
+        with patch('snapshots.SnapshotSet.commit', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.obj.main()
+
+        self.resetBackup()
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='snapshot'))
+        self.obj.main()
+
+        latest = SnapshotSet(root).latest()
+        with open(os.path.join(latest, 'a', 'file.txt')) as fp:
+            self.assertEqual(fp.read(), 'a/file.tx2')
+
+    def test_snapshot_retention(self):
+        '''Tests that SnapshotSet discards partial snapshots and prunes old ones'''
+        _, backup = self.makeDataTree([])
+        snapshots = SnapshotSet(os.path.join(backup, NextcloudBackup.SNAPSHOT_DIR))
+        for year in range(2015, 2019):
+            snapshots.commit(snapshots.begin(datetime.datetime(year, 1, 1)))
+
+        partial = snapshots.begin(datetime.datetime(2019, 1, 1))
+        self.assertEqual(snapshots.latest(), os.path.join(snapshots.root, '2018-01-01_000000', ''))
+        self.assertEqual(snapshots.prune(2), ['2015-01-01_000000', '2016-01-01_000000'])
+        self.assertEqual(snapshots.list(), ['2017-01-01_000000', '2018-01-01_000000'])
+
+        snapshots.begin(datetime.datetime(2020, 1, 1))
+        self.assertFalse(os.path.exists(partial))
+
+    @patch('archive.zstandard', None)
+    @patch('archive.lz4', None)
+    def test_main_archive(self):
+        '''Tests that archive output mode writes changed files to compressed volumes'''
+        data, backup = self.makeDataTree(['a/notes.txt', 'a/photo.jpg', 'a/skip.part'])
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='archive', jobs=2))
+        self.obj.main()
+        self.assertFalse(os.path.exists(os.path.join(backup, 'a')))
+
+        volumes = os.listdir(os.path.join(backup, NextcloudBackup.ARCHIVE_DIR))
+        self.assertEqual(len(volumes), 1)
+        with tarfile.open(os.path.join(backup, NextcloudBackup.ARCHIVE_DIR, volumes[0])) as tar:
+            self.assertEqual(sorted(tar.getnames()), ['a/notes.txt.gz', 'a/photo.jpg'])
+            self.assertEqual(gzip.decompress(tar.extractfile('a/notes.txt.gz').read()), b'a/notes.txt')
+            self.assertEqual(tar.extractfile('a/photo.jpg').read(), b'a/photo.jpg')
+            self.assertAlmostEqual(tar.getmember('a/photo.jpg').mtime, self.DUMMY_EPOCH_TIME, 3)
+
+        # unchanged files aren't archived again, and mirror backups keep their own manifest
+        self.resetBackup()
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='archive'))
+        self.obj.main()
+        self.assertEqual(len(os.listdir(os.path.join(backup, NextcloudBackup.ARCHIVE_DIR))), 1)
+        self.assertEqual(self.obj.manifest.lookupDir('a').keys(), {'notes.txt', 'photo.jpg'})
+
+    def test_archive_volumes(self):
+        '''Tests that ArchiveWriter starts a new volume once the current one is full'''
+        data, backup = self.makeDataTree(['a.txt', 'b.txt', 'c.txt'])
+        writer = archive.ArchiveWriter(backup, 'test', 1)
+        for f in ['a.txt', 'b.txt', 'c.txt']:
+            path = os.path.join(data, f)
+            writer.add(path, f, os.stat(path))
+            # appended members are written out before the volume is closed
+            self.assertGreater(os.path.getsize(writer.volumes[-1]), 0)
+
+        writer.sync()
+        self.assertEqual([os.path.basename(x) for x in writer.close()],
+                         ['test.0.tar', 'test.1.tar', 'test.2.tar'])
+
+    def test_main_metrics(self):
+        '''Tests that main() records run metrics which are written by writeMetrics()'''
+        data, backup = self.makeDataTree(self.FAKE_FILES + ['a/file3.txt'])
+        prometheus = os.path.join(data, '..', 'backup.prom')
+        self.createBackup(Namespace(dry_run=False, verbose=False, prometheus=prometheus))
+        self.obj.main()
+        counters = self.obj.metrics.counters
+        self.assertEqual(counters['files_scanned'], 2)
+        self.assertEqual(counters['files_copied'], 2)
+        self.assertEqual(counters['bytes_copied'], len('file1.txt') + len('a/file3.txt'))
+        self.assertEqual(counters['dirs_scanned'], 2)
+        self.assertNotIn('errors', counters)
+
+        with patch.object(NextcloudBackup, 'NEXTCLOUD_BACKUP_METRICS', os.path.join(data, '..', 'metrics.json')):
+            self.obj.writeMetrics()
+            with open(self.obj.NEXTCLOUD_BACKUP_METRICS) as fp:
+                summary = json.load(fp)
+
+        self.assertEqual(summary['counters'], counters)
+        self.assertEqual(summary['histograms']['copy']['count'], 2)
+        self.assertIn('main', summary['spans'])
+        self.assertEqual(summary['info']['output'], 'mirror')
+        with open(prometheus) as fp:
+            self.assertIn('nextcloud_backup_files_copied 2\n', fp.read())
+
+    def test_main_resume(self):
+        '''Tests that main() resumes an interrupted run from the journal'''
+        data, backup = self.makeDataTree(['a.txt', 'b.txt', 'c.txt', 'sub/d.txt'])
+        paths = {x: os.path.join(data, x) for x in ['a.txt', 'b.txt', 'c.txt', 'sub/d.txt']}
+
+        # interrupted run scanned the top directory, backed up a.txt and queued b.txt
+        journal = RunJournal(NextcloudBackup.NEXTCLOUD_BACKUP_JOURNAL)
+        journal.open('mirror')
+        journal.queued(paths['a.txt'])
+        journal.queued(paths['b.txt'])
+        journal.done(paths['a.txt'], os.stat(paths['a.txt']))
+        journal.scanned('')
+        journal.close()
+        with open(NextcloudBackup.NEXTCLOUD_BACKUP_JOURNAL, 'a') as fp:
+            fp.write('["queued", "/cut/sho')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertEqual([x[0][0] for x in mockShutil.call_args_list],
+                             [paths['b.txt'], paths['sub/d.txt']])
+
+        self.assertEqual(set(self.obj.manifest.lookupDir('')), {'a.txt', 'b.txt'})
+        self.assertEqual(os.path.getsize(NextcloudBackup.NEXTCLOUD_BACKUP_JOURNAL), 0)
+
+    def test_resume_snapshot(self):
+        '''Tests that files backed up into an interrupted snapshot aren't replayed into the manifest'''
+        data, _ = self.makeDataTree(['a.txt'])
+        path = os.path.join(data, 'a.txt')
+        journal = RunJournal(NextcloudBackup.NEXTCLOUD_BACKUP_JOURNAL)
+        journal.open('snapshot')
+        journal.queued(path)
+        journal.done(path, os.stat(path))
+        journal.close()
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='snapshot'))
+        self.obj.manifest = Manifest(NextcloudBackup.NEXTCLOUD_BACKUP_MANIFEST)
+        self.obj.resumeJournal()
+        self.assertEqual(self.obj.manifest.lookupDir(''), {})
+        self.assertEqual(self.obj.resumed.scanned, set())
+
+    @patch('archive.zstandard', None)
+    @patch('archive.lz4', None)
+    def test_resume_archive(self):
+        '''Tests that files archived by an interrupted run are in its volume before they are
+        replayed into the manifest
+        '''
+        data, backup = self.makeDataTree(['a.jpg', 'b.jpg'])
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='archive'))
+        with patch('journal.RunJournal.complete', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
                 self.obj.main()
-                self.assertEqual(self.obj.toBackup,
-                                 [os.path.join(self.NEXTCLOUD_DATA, x) for x in self.FAKE_FILES])
-                self.assertEqual(out.getvalue(),
-                                 ('creating \'{}\'\n\'{}\' --> \'{}\'\n'
-                                  .format(self.NEXTCLOUD_DATA_BACKUP,
-                                          os.path.join(self.NEXTCLOUD_DATA, self.FAKE_FILES[0]),
-                                          os.path.join(self.NEXTCLOUD_DATA_BACKUP,
-                                                       self.FAKE_FILES[0]))))
+
+        # periodic journal sync before the run is killed
+        self.obj.journal.sync()
+        state = RunJournal(NextcloudBackup.NEXTCLOUD_BACKUP_JOURNAL).recover()
+        self.assertEqual(sorted(x[0] for x in state.done),
+                         [os.path.join(data, x) for x in ['a.jpg', 'b.jpg']])
+        volume = os.path.join(backup, NextcloudBackup.ARCHIVE_DIR,
+                              os.listdir(os.path.join(backup, NextcloudBackup.ARCHIVE_DIR))[0])
+        with tarfile.open(volume) as tar:
+            self.assertEqual(sorted(tar.getnames()), ['a.jpg', 'b.jpg'])
+
+        self.obj.archive.close()
+        self.resetBackup()
+        self.createBackup(Namespace(dry_run=False, verbose=False, output='archive'))
+        self.obj.manifest = Manifest(NextcloudBackup.NEXTCLOUD_ARCHIVE_MANIFEST)
+        self.obj.resumeJournal()
+        self.assertEqual(self.obj.manifest.lookupDir('').keys(), {'a.jpg', 'b.jpg'})
+
+    def test_main_errored_files_journaled(self):
+        '''Tests that errored files log is emptied only once its files are in the journal'''
+        data, _ = self.makeDataTree(['a.txt'])
+        _, _, mockErroredFiles = self.createBackup(Namespace(dry_run=False, verbose=False),
+                                                   erroredData=os.path.join(data, 'a.txt') + '\n')
+        self.assertFalse(mockErroredFiles.truncate.called)
+
+        with patch('shutil.copy2', MagicMock(side_effect=Exception('FAKE ERROR'))), \
+             patch('nextcloudBackup.RunJournal.complete'), redirect_stderr(StringIO()):
+            self.obj.main()
+
+        mockErroredFiles.truncate.assert_called_once_with(0)
+        self.obj.journal.close()
+        state = RunJournal(NextcloudBackup.NEXTCLOUD_BACKUP_JOURNAL).recover()
+        self.assertEqual(list(state.pending), [os.path.join(data, 'a.txt')])
+
+    def test_main_watch(self):
+        '''Tests that main() only lists directories recorded by the change tracking daemon'''
+        data, _ = self.makeDataTree(['a.txt', 'sub/b.txt', 'sub/deep/c.txt', 'other/d.txt',
+                                     'user/files/e.txt'])
+        dirty = DirtySet(NextcloudBackup.NEXTCLOUD_BACKUP_DIRTY)
+        self.addCleanup(dirty.close)
+
+        # daemon never ran, so the first run walks the whole tree
+        self.createBackup(Namespace(dry_run=False, verbose=False, changes='watch'))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertEqual(mockShutil.call_count, 5)
+
+        self.resetBackup()
+        dirty.add(['sub', 'removed'])
+        for path in ['sub/b.txt', 'sub/deep/c.txt', 'other/d.txt']:
+            with open(os.path.join(data, path), 'w') as fp:
+                fp.write('changed')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, changes='watch'))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertEqual([x[0][0] for x in mockShutil.call_args_list],
+                             [os.path.join(data, 'sub/b.txt')])
+
+        self.assertEqual(self.obj.metrics.counters.get('errors', 0), 0)
+        self.assertEqual(dirty.claim()[1:], (False, []))
+
+        # folders holding only folders are known, only new ones are descended into
+        self.resetBackup()
+        dirty.add([''])
+        os.makedirs(os.path.join(data, 'new/x'))
+        with open(os.path.join(data, 'new/x/f.txt'), 'w') as fp:
+            fp.write('new')
+
+        self.createBackup(Namespace(dry_run=False, verbose=False, changes='watch'))
+        with patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertEqual([x[0][0] for x in mockShutil.call_args_list],
+                             [os.path.join(data, 'new/x/f.txt')])
+
+        self.assertEqual(self.obj.metrics.counters['dirs_scanned'], 3)
+
+    def test_main_filecache(self):
+        '''Tests that main() lists directories changed in Nextcloud's file cache'''
+        data, _ = self.makeDataTree(['alice/files/a.txt', 'alice/files/docs/b.txt',
+                                     'bob/files/c.txt'])
+        config = os.path.join(os.path.dirname(os.path.dirname(data)), 'config.php')
+        cache = FileCacheTests.makeFileCache(config, data, [])
+
+        # first run walks the whole tree, including the database, since nothing is known about the
+        # last run
+        self.createBackup(Namespace(dry_run=False, verbose=False, changes='filecache'))
+        with patch('nextcloudBackup.NextcloudBackup.NEXTCLOUD_CONFIG', config), \
+             patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertEqual(mockShutil.call_count, 4)
+
+        self.resetBackup()
+        os.rename(os.path.join(data, 'alice/files/docs'), os.path.join(data, 'alice/files/moved'))
+        for path in ['bob/files/c.txt', 'alice/files/a.txt']:
+            with open(os.path.join(data, path), 'w') as fp:
+                fp.write('changed')
+
+        # only bob's file and alice's renamed folder are known to the file cache
+        cache.execute('INSERT INTO oc_filecache VALUES (1, \'files/c.txt\', 9999999999, 2)')
+        cache.execute('INSERT INTO oc_filecache VALUES (2, \'alice/files\', 9999999999, 1)')
+        cache.commit()
+        self.createBackup(Namespace(dry_run=False, verbose=False, changes='filecache'))
+        with patch('nextcloudBackup.NextcloudBackup.NEXTCLOUD_CONFIG', config), \
+             patch('shutil.copy2') as mockShutil:
+            self.obj.main()
+            self.assertEqual(sorted(x[0][0] for x in mockShutil.call_args_list),
+                             [os.path.join(data, x) for x in ['alice/files/a.txt',
+                                                              'alice/files/moved/b.txt',
+                                                              'bob/files/c.txt']])
+
+        self.assertFalse(self.obj.metrics.info['full_scan'])
+        self.assertEqual(self.obj.metrics.counters['dirs_scanned'], 3)
+
+        # file cache errors and overdue reconciliation both walk the whole tree
+        self.resetBackup()
+        self.createBackup(Namespace(dry_run=False, verbose=False, changes='filecache',
+                                    reconcile_days=1))
+        with patch('nextcloudBackup.NextcloudBackup.NEXTCLOUD_CONFIG', config + '.missing'), \
+             patch('shutil.copy2'), redirect_stderr(StringIO()):
+            self.obj.main()
+
+        self.assertTrue(self.obj.metrics.info['full_scan'])
+        self.assertEqual(self.obj.metrics.counters['errors'], 1)
+        self.assertEqual(self.obj.manifest.getState('full_scan'), self.obj.manifest.getState('last_run'))
+
+    @patch('nextcloudBackup.NextcloudBackup.openLogFile')
+    @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
+    def test_watch_snapshot(self, mockOpenLogFile):
+        '''Tests if SystemExit is raised if change tracking daemon is used for snapshots'''
+        mockOpenLogFile.side_effect = SystemExit('Did not raise SystemExit in checkArgs()')
+        with self.assertRaises(SystemExit) as err:
+            self.obj = NextcloudBackup(Namespace(verbose=False, dry_run=False, changes='watch',
+                                                 output='snapshot'))
+
+        self.assertEqual(err.exception.code,
+                         'Error: change source \'watch\' can\'t be used with snapshot output mode')
+
+    @patch('nextcloudBackup.NextcloudBackup.openLogFile')
+    @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
+    def test_bad_jobs(self, mockOpenLogFile):
+        '''Tests if SystemExit is raised if number of jobs is invalid'''
+        mockOpenLogFile.side_effect = SystemExit('Did not raise SystemExit in checkArgs()')
+        with self.assertRaises(SystemExit) as err:
+            self.obj = NextcloudBackup(Namespace(verbose=False, dry_run=False, jobs=0))
+
+        self.assertEqual(err.exception.code, 'Error: number of jobs must be at least 1')
+
+    @patch('shutil.copy2', MagicMock())
+    def test_main_verbose(self):
+        '''Tests if NextcloudBackup.main() verbose messages print correctly'''
+        data, backup = self.makeDataTree(self.FAKE_FILES)
+        out = StringIO()
+
+        with redirect_stdout(out):
+            self.createBackup(Namespace(dry_run=False, verbose=True))
+            self.obj.main()
+            lines = out.getvalue().splitlines(True)
+            self.assertEqual(''.join(lines[:2]),
+                             ('creating \'{}\'\n\'{}\' --> \'{}\'\n'
+                              .format(backup,
+                                      os.path.join(data, self.FAKE_FILES[0]),
+                                      os.path.join(backup, self.FAKE_FILES[0]))))
+            self.assertTrue(lines[2].startswith('copied 9 bytes in '))
+            self.assertTrue(lines[2].endswith('using \'copy2\' copy backend\n'))
 
     @patch('datetime.datetime', MockDatetime)
-    @patch('os.makedirs', MagicMock())
     @patch('shutil.copy2', MagicMock(side_effect=Exception('FAKE ERROR')))
-    @patch('os.path.exists', MagicMock(side_effect=[False, True]))
-    @patch('os.stat', MagicMock(side_effect=[MagicMock(st_size=1), MagicMock(st_size=0)]))
-    @patch('os.path.isfile', MagicMock(return_value=True))
-    @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.mountBackupPartition', MagicMock())
-    @patch('nextcloudBackup.NextcloudBackup.executeCommand', MagicMock(return_value=''))
-    @patch('os.walk')
-    @patch('os.path.getmtime')
-    def test_main_copy_errors(self, mockGetmtime, mockWalk):
+    def test_main_copy_errors(self):
         '''Tests if copy errors are reported correctly'''
-        mockWalk.return_value = [(self.NEXTCLOUD_DATA, 'dirs', self.FAKE_FILES)]
-        mockGetmtime.return_value = self.DUMMY_EPOCH_TIME
-
-        # log file setup
-        mainHandler = mock_open()
-        mockLog = mock_open(read_data=self.OLD_DUMMY_DATE)
-        mockError = mock_open()
-        mockErroredFiles = mock_open()
-        mainHandler.side_effect = [
-            mockLog.return_value,
-            mockError.return_value,
-            mockErroredFiles.return_value
-        ]
-        out = err = StringIO()
+        data, backup = self.makeDataTree(self.FAKE_FILES)
+        out = StringIO()
+        err = StringIO()
         errorMessage = ('{}: caught error \'FAKE ERROR\' while attempting to copy \'{}\'\n'
                         .format(datetime.datetime.fromtimestamp(self.DUMMY_EPOCH_TIME).strftime('%c'),
-                                os.path.join(self.NEXTCLOUD_DATA_BACKUP, self.FAKE_FILES[0])))
+                                os.path.join(backup, self.FAKE_FILES[0])))
 
-        with patch('builtins.open', mainHandler):
-            with redirect_stderr(err):
-                self.obj = NextcloudBackup(Namespace(dry_run=False, verbose=True))
-                self.obj.main()
-                self.assertEqual(self.obj.toBackup,
-                                 [os.path.join(self.NEXTCLOUD_DATA, x) for x in self.FAKE_FILES])
-                self.assertEqual(err.getvalue(), errorMessage)
-                mockError().write.assert_called_once_with(errorMessage)
-                mockErroredFiles().write.assert_called_once_with('{}\n'.format(os.path.join(self.NEXTCLOUD_DATA, self.FAKE_FILES[0])))
+        with redirect_stdout(out), redirect_stderr(err):
+            _, mockError, mockErroredFiles = self.createBackup(Namespace(dry_run=False, verbose=True))
+            self.obj.main()
+            self.assertEqual(err.getvalue(), errorMessage)
+            mockError.write.assert_called_once_with(errorMessage)
+            mockErroredFiles.write.assert_called_once_with('{}\n'.format(os.path.join(data, self.FAKE_FILES[0])))
 
     @patch('nextcloudBackup.NextcloudBackup.__init__')
     def test_singleton_behavior(self, mockInit):
@@ -316,7 +1312,9 @@ class NextcloudBackupTests(TestCase):
     @patch('nextcloudBackup.NextcloudBackup.checkDataExists', MagicMock())
     @patch('nextcloudBackup.NextcloudBackup.mountBackupPartition', MagicMock())
     @patch('nextcloudBackup.NextcloudBackup.executeCommand', MagicMock(return_value=''))
-    def test_tear_down(self):
+    @patch('devices.mounts', MagicMock(return_value=[]))
+    @patch('metrics.RunMetrics.write')
+    def test_tear_down(self, mockWrite):
         '''Tests that NextcloudBackup.tearDown() closes log files and records time in main log'''
         # log file setup
         mainHandler = mock_open()
@@ -336,6 +1334,8 @@ class NextcloudBackupTests(TestCase):
             for log in [mockLog(), mockError(), mockErroredFiles()]:
                 self.assertTrue(log.close.called)
 
+            mockWrite.assert_called_once_with(self.obj.NEXTCLOUD_BACKUP_METRICS, '')
+
     @patch('os.stat', MagicMock(side_effect=[MagicMock(st_size=1), MagicMock(st_size=0)]))
     @patch('os.path.isfile', MagicMock(return_value=True))
     @patch('builtins.open', MagicMock())
@@ -349,3 +1349,688 @@ class NextcloudBackupTests(TestCase):
             self.assertTrue(isinstance(self.obj, NextcloudBackup))
 
         self.assertTrue(mockTearDown.called)
+
+class FileCopyTests(TestCase):
+    '''Class containing tests to verify functionality of fileCopy module'''
+    def setUp(self):
+        '''Creates temporary directory before every test'''
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+
+    def tearDown(self):
+        '''Removes temporary directory after every test'''
+        shutil.rmtree(self.tmp)
+
+    def writeFile(self, path, data, mtime=None):
+        '''Writes data to path and optionally sets its modification time'''
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_delta_copy(self):
+        '''Tests that deltaCopy() only rewrites changed blocks and copies metadata'''
+        self.writeFile(self.dst, b'a' * 10 + b'b' * 10 + b'c' * 10)
+        self.writeFile(self.src, b'a' * 10 + b'x' * 10 + b'c' * 10, NextcloudBackupTests.DUMMY_EPOCH_TIME)
+
+        self.assertEqual(fileCopy.deltaCopy(self.src, self.dst, 10), 10)
+        with open(self.dst, 'rb') as fp:
+            self.assertEqual(fp.read(), b'a' * 10 + b'x' * 10 + b'c' * 10)
+
+        self.assertEqual(os.stat(self.dst).st_mtime, NextcloudBackupTests.DUMMY_EPOCH_TIME)
+
+    def test_delta_copy_resize(self):
+        '''Tests that deltaCopy() handles files that grow and shrink'''
+        self.writeFile(self.dst, b'a' * 25)
+        self.writeFile(self.src, b'a' * 10)
+        self.assertEqual(fileCopy.deltaCopy(self.src, self.dst, 4), 0)
+        self.assertEqual(os.stat(self.dst).st_size, 10)
+
+        self.writeFile(self.src, b'a' * 10 + b'b' * 5)
+        self.assertEqual(fileCopy.deltaCopy(self.src, self.dst, 4), 7)
+        with open(self.dst, 'rb') as fp:
+            self.assertEqual(fp.read(), b'a' * 10 + b'b' * 5)
+
+    def test_copy_backends(self):
+        '''Tests that every copy backend supported here copies data and metadata'''
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        self.writeFile(self.src, data, NextcloudBackupTests.DUMMY_EPOCH_TIME)
+        for backend in fileCopy.BACKENDS:
+            try:
+                copied = fileCopy.copyFile(self.src, self.dst, backend)
+            except (OSError, AttributeError):
+                # e.g. reflink on filesystems without shared extents
+                continue
+
+            self.assertEqual(copied, len(data))
+            with open(self.dst, 'rb') as fp:
+                self.assertEqual(fp.read(), data)
+
+            self.assertEqual(os.stat(self.dst).st_mtime, NextcloudBackupTests.DUMMY_EPOCH_TIME)
+            os.remove(self.dst)
+
+    def test_probe_backend(self):
+        '''Tests that probeBackend() skips backends which fail'''
+        self.writeFile(self.src, b'probe')
+        with patch('fcntl.ioctl', MagicMock(side_effect=OSError('not supported'))), \
+             patch('os.copy_file_range', MagicMock(side_effect=OSError('not supported')), create=True):
+            self.assertEqual(fileCopy.probeBackend(self.src, self.dst), 'sendfile')
+
+        with patch('fcntl.ioctl', MagicMock(side_effect=OSError('not supported'))), \
+             patch('os.copy_file_range', MagicMock(side_effect=OSError('not supported')), create=True), \
+             patch('os.sendfile', MagicMock(side_effect=OSError('not supported'))):
+            self.assertEqual(fileCopy.probeBackend(self.src, self.dst), 'buffered')
+
+    def test_delta_copy_missing_dst(self):
+        '''Tests that deltaCopy() raises FileNotFoundError if dst does not exist'''
+        self.writeFile(self.src, b'a')
+        with self.assertRaises(FileNotFoundError):
+            fileCopy.deltaCopy(self.src, self.dst)
+
+    def test_fan_out_copy(self):
+        '''Tests that fanOutCopy() writes every destination, finishing the others if one fails'''
+        data = os.urandom(10 * 1024 + 3)
+        self.writeFile(self.src, data, NextcloudBackupTests.DUMMY_EPOCH_TIME)
+        dsts = [self.dst, os.path.join(self.tmp, 'dst2'), os.path.join(self.tmp, 'dst3')]
+        for chunkSize in [1024, len(data) + 1]:
+            self.assertEqual(fileCopy.fanOutCopy(self.src, dsts, chunkSize, 2), len(data))
+            for dst in dsts:
+                with open(dst, 'rb') as fp:
+                    self.assertEqual(fp.read(), data)
+
+                self.assertEqual(os.stat(dst).st_mtime, NextcloudBackupTests.DUMMY_EPOCH_TIME)
+
+        missing = os.path.join(self.tmp, 'missing', 'dst')
+        os.remove(self.dst)
+        with self.assertRaises(FileNotFoundError):
+            fileCopy.fanOutCopy(self.src, [missing, self.dst], 1024, 2)
+
+        with open(self.dst, 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+
+    def test_copy_digest(self):
+        '''Tests that every copy function hashes the data it copies in the same pass'''
+        data = os.urandom(3 * 1024 + 5)
+        self.writeFile(self.src, data)
+        expected = contentStore.HASH(data).hexdigest()
+        for copy in [lambda x: fileCopy.copyFile(self.src, self.dst, 'sendfile', x),
+                     lambda x: fileCopy.fanOutCopy(self.src, [self.dst], 1024, 2, x),
+                     lambda x: fileCopy.deltaCopy(self.src, self.dst, 1024, x)]:
+            digest = contentStore.HASH()
+            copy(digest)
+            self.assertEqual(digest.hexdigest(), expected)
+            with open(self.dst, 'rb') as fp:
+                self.assertEqual(fp.read(), data)
+
+    def test_physical_offset(self):
+        '''Tests that diskOrder() sorts files by the offset of their first extent'''
+        self.writeFile(self.src, b'a')
+        self.writeFile(self.dst, b'b')
+        offsets = {self.src: 8192, self.dst: 4096}
+        with patch('scrub.physicalOffset', side_effect=offsets.get):
+            self.assertEqual(scrub.diskOrder([self.src, self.dst, 'missing']), [2, 1, 0])
+
+        self.assertIsNone(scrub.physicalOffset(os.path.join(self.tmp, 'missing')))
+
+class BenchmarkTests(TestCase):
+    '''Class containing tests to verify functionality of benchmark module'''
+    def test_benchmark(self):
+        '''Tests that benchmark() backs up synthetic tree and reports every phase'''
+        args = Namespace(tiny_files=250, huge_files=1, huge_size=2, depth=5, part_files=3, seed=1,
+                         jobs=2, output='mirror', tmp=None, label='test')
+        results = benchmark.benchmark(args)
+        self.assertEqual(results['label'], 'test')
+        self.assertEqual(results['results']['generate']['files'], 256)
+        self.assertEqual(results['results']['scan']['files'], 259)
+        self.assertEqual(results['results']['full_backup']['bytes'],
+                         results['results']['generate']['bytes'])
+        self.assertEqual(set(results['results']),
+                         {'generate', 'scan', 'full_backup', 'incremental_no_change'})
+
+    def test_host_state_ignored(self):
+        '''Tests that runBackup() doesn't use the filters and state files of the host's backups'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        data = os.path.join(tmp, 'data', '')
+        backup = os.path.join(tmp, 'backup', '')
+        os.makedirs(os.path.join(data, 'appdata_x'))
+        open(os.path.join(data, 'appdata_x', 'a.png'), 'w').close()
+        with open(os.path.join(tmp, 'host_filters'), 'w') as fp:
+            fp.write('appdata_*/\n')
+
+        workdir = os.path.join(tmp, 'work')
+        os.makedirs(workdir)
+        args = Namespace(jobs=1, output='mirror')
+        with patch('nextcloudBackup.NextcloudBackup.NEXTCLOUD_BACKUP_FILTERS',
+                   os.path.join(tmp, 'host_filters')):
+            # the scan records the first run in the backup log, as in benchmark()
+            benchmark.runBackup(workdir, data, backup, args, scanOnly=True)
+            benchmark.runBackup(workdir, data, backup, args)
+
+        self.assertTrue(os.path.isfile(os.path.join(backup, 'appdata_x', 'a.png')))
+        for name in ['NEXTCLOUD_BACKUP_METRICS', 'NEXTCLOUD_BACKUP_DIRTY', 'NEXTCLOUD_BACKUP_SCRUB']:
+            self.assertTrue(getattr(benchmark.BenchmarkBackup, name).startswith(workdir))
+
+    def test_generate_tree_reproducible(self):
+        '''Tests that generateTree() creates the same tree for the same seed'''
+        args = Namespace(tiny_files=50, huge_files=0, huge_size=1, depth=3, part_files=1, seed=7)
+        trees = []
+        for _ in range(2):
+            tmp = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, tmp)
+            self.assertEqual(benchmark.generateTree(tmp, args)[0], 53)
+            trees.append(sorted((os.path.relpath(os.path.join(d, f), tmp), os.path.getsize(os.path.join(d, f)))
+                                for d, _, files in os.walk(tmp) for f in files))
+
+        self.assertEqual(trees[0], trees[1])
+
+class RunMetricsTests(TestCase):
+    '''Class containing tests to verify functionality of RunMetrics class'''
+    def test_histogram(self):
+        '''Tests that histogram buckets are cumulative in summary and Prometheus output'''
+        metrics = RunMetrics()
+        for value in [0.00005, 0.002, 0.002, 100]:
+            metrics.observe('copy', value)
+
+        buckets = dict((str(x), y) for x, y in metrics.summary()['histograms']['copy']['buckets'])
+        self.assertEqual(buckets['0.0001'], 1)
+        self.assertEqual(buckets['0.005'], 3)
+        self.assertEqual(buckets['60'], 3)
+        self.assertEqual(buckets['+Inf'], 4)
+
+        text = metrics.prometheus()
+        self.assertIn('nextcloud_backup_copy_seconds_bucket{le="0.005"} 3\n', text)
+        self.assertIn('nextcloud_backup_copy_seconds_count 4\n', text)
+
+    def test_span(self):
+        '''Tests that spans accumulate time and are recorded if an exception is raised'''
+        metrics = RunMetrics()
+        with patch('time.monotonic', MagicMock(side_effect=[1, 3, 10, 11])):
+            with metrics.span('mount'):
+                pass
+
+            with self.assertRaises(ValueError):
+                with metrics.span('mount'):
+                    raise ValueError()
+
+        self.assertEqual(metrics.spans['mount'], 3)
+
+
+class FileCacheTests(TestCase):
+    '''Class containing tests to verify functionality of FileCache class'''
+    @staticmethod
+    def makeFileCache(config, data, rows):
+        '''Writes config.php pointing at an SQLite Nextcloud database holding file cache rows
+
+        rows are (storage, path, mtime, mimetype) tuples, storage 1 is bob's home, 2 is the
+        data directory itself and 3 is an external storage.
+        Returns open connection to the database
+        '''
+        with open(config, 'w') as fp:
+            fp.write('<?php\n$CONFIG = array (\n  \'dbtype\' => \'sqlite3\',\n'
+                     '  \'datadirectory\' => \'{}\',\n  \'dbname\' => \'nextcloud\',\n'
+                     '  \'installed\' => true,\n  \'maintenance\' => false,\n'
+                     '  \'dbtableprefix\' => \'oc_\',\n);\n'.format(os.path.dirname(data)))
+
+        db = sqlite3.connect(os.path.join(data, 'nextcloud.db'))
+        db.execute('CREATE TABLE oc_storages (numeric_id INTEGER PRIMARY KEY, id TEXT)')
+        db.execute('CREATE TABLE oc_mimetypes (id INTEGER PRIMARY KEY, mimetype TEXT)')
+        db.execute('CREATE TABLE oc_filecache (storage INTEGER, path TEXT, mtime INTEGER, mimetype INTEGER)')
+        db.executemany('INSERT INTO oc_storages VALUES (?, ?)',
+                       [(1, 'home::bob'), (2, 'local::{}/'.format(os.path.dirname(data))),
+                        (3, 'local::/mnt/external/')])
+        db.executemany('INSERT INTO oc_mimetypes VALUES (?, ?)',
+                       [(1, fileCache.FOLDER_MIMETYPE), (2, 'text/plain')])
+        db.executemany('INSERT INTO oc_filecache VALUES (?, ?, ?, ?)', rows)
+        db.commit()
+        return db
+
+    def test_read_config(self):
+        '''Tests that string, number and boolean entries are read from config.php'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        with open(os.path.join(tmp, 'config.php'), 'w') as fp:
+            fp.write('<?php\n$CONFIG = array (\n  \'dbpassword\' => \'it\\\'s\',\n'
+                     '  \'dbport\' => 5432,\n  \'installed\' => true,\n'
+                     '  \'trusted_domains\' => array (0 => \'example.com\'),\n);\n')
+
+        self.assertEqual(fileCache.readConfig(os.path.join(tmp, 'config.php')),
+                         {'dbpassword': 'it\'s', 'dbport': 5432, 'installed': True})
+
+    def test_changed_dirs(self):
+        '''Tests that changed entries are mapped to their directories under the data directory'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        data = os.path.join(tmp, 'data', '')
+        os.makedirs(data)
+        db = self.makeFileCache(os.path.join(tmp, 'config.php'), data,
+                                [(1, 'files/old.txt', 100, 2),
+                                 (1, 'files/new.txt', 200, 2),
+                                 (1, 'files/Photos', 200, 1),
+                                 (1, 'files', 200, 1),
+                                 (2, 'alice/files/a.txt', 300, 2),
+                                 (2, 'appdata_x/preview/1/2.png', 300, 2),
+                                 (3, 'external.txt', 300, 2)])
+        db.close()
+
+        cache = fileCache.openFileCache(fileCache.readConfig(os.path.join(tmp, 'config.php')), data)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.changedDirs(200), ['alice/files', 'appdata_x/preview/1',
+                                                  'bob/files', 'bob/files/Photos'])
+
+    def test_unsupported_database(self):
+        '''Tests that ValueError is raised for unsupported database types'''
+        with self.assertRaises(ValueError):
+            fileCache.openFileCache({'dbtype': 'oci'}, '/tmp')
+
+    def test_database_port(self):
+        '''Tests that the port is read from dbport unless dbhost contains one'''
+        pymysql = MagicMock()
+        psycopg2 = MagicMock()
+        with patch.dict('sys.modules', pymysql=pymysql, psycopg2=psycopg2):
+            fileCache.openFileCache({'dbtype': 'mysql', 'dbhost': 'db', 'dbport': 3307}, '/tmp')
+            fileCache.openFileCache({'dbtype': 'mysql', 'dbhost': 'db:/run/mysqld.sock',
+                                     'dbport': ''}, '/tmp')
+            fileCache.openFileCache({'dbtype': 'pgsql', 'dbhost': 'db', 'dbport': '5433'}, '/tmp')
+
+        self.assertEqual([x[1].get('port') for x in pymysql.connect.call_args_list], [3307, None])
+        self.assertEqual(pymysql.connect.call_args[1]['unix_socket'], '/run/mysqld.sock')
+        self.assertEqual(psycopg2.connect.call_args[1]['port'], '5433')
+
+class ChangeWatcherTests(TestCase):
+    '''Class containing tests to verify functionality of DirtySet and ChangeWatcher classes'''
+    def setUp(self):
+        '''Creates temporary data directory and dirty set'''
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.data = os.path.join(self.tmp, 'data')
+        os.makedirs(os.path.join(self.data, 'user', 'files'))
+        self.dirty = DirtySet(os.path.join(self.tmp, 'dirty.db'))
+        self.addCleanup(self.dirty.close)
+
+    def test_dirty_set_claim(self):
+        '''Tests that releasing a claim keeps directories dirtied after it was made'''
+        self.assertEqual(self.dirty.claim(), (0, True, []))
+        self.dirty.requestFullScan()
+        self.dirty.add(['b', 'a'])
+        token, fullScan, directories = self.dirty.claim()
+        self.assertTrue(fullScan)
+        self.assertEqual(directories, ['a', 'b'])
+
+        self.dirty.add(['b', 'c'])
+        self.dirty.release(token)
+        self.assertEqual(self.dirty.claim()[1:], (False, ['b', 'c']))
+
+    def test_watcher(self):
+        '''Tests that watcher records changed directories, including renamed and new ones'''
+        try:
+            watcher = changeWatcher.ChangeWatcher(self.data, self.dirty, ['part'])
+        except OSError:
+            self.skipTest('inotify is not available')
+
+        self.addCleanup(watcher.inotify.close)
+        watcher.start()
+        self.dirty.release(self.dirty.claim()[0])
+
+        with open(os.path.join(self.data, 'user', 'files', 'a.txt'), 'w') as fp:
+            fp.write('a')
+
+        open(os.path.join(self.data, 'upload.part'), 'w').close()
+        os.rename(os.path.join(self.data, 'user'), os.path.join(self.data, 'renamed'))
+        os.makedirs(os.path.join(self.data, 'new', 'nested'))
+        watcher.poll(0)
+        watcher.flush()
+
+        self.assertEqual(self.dirty.claim()[1:],
+                         (False, ['', 'new', 'new/nested', 'renamed', 'renamed/files']))
+        self.assertEqual(watcher.path(max(watcher.dirs)), 'new/nested')
+
+        self.dirty.release(self.dirty.claim()[0])
+        with open(os.path.join(self.data, 'renamed', 'files', 'b.txt'), 'w') as fp:
+            fp.write('b')
+
+        watcher.poll(0)
+        watcher.flush()
+        self.assertEqual(self.dirty.claim()[1:], (False, ['renamed/files']))
+
+    def test_watcher_overflow(self):
+        '''Tests that a full scan is requested if the inotify event queue overflows'''
+        try:
+            watcher = changeWatcher.ChangeWatcher(self.data, self.dirty)
+        except OSError:
+            self.skipTest('inotify is not available')
+
+        self.addCleanup(watcher.inotify.close)
+        watcher.start()
+        self.dirty.release(self.dirty.claim()[0])
+        watcher.handle([(-1, changeWatcher.IN_Q_OVERFLOW, 0, '')])
+        self.assertTrue(self.dirty.claim()[1])
+
+class DevicesTests(TestCase):
+    '''Class containing tests to verify functionality of devices module against fixture files'''
+    MOUNTINFO = ('22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+                 '40 22 8:33 / /mnt/nextcloud\\040backup rw,noatime shared:20 master:3 - ext4 /dev/sdc1 rw\n'
+                 '41 22 8:42 / /mnt/other rw - xfs /dev/sdc10 rw\n'
+                 '42 22 0:40 / /tmp rw - tmpfs tmpfs rw\n')
+
+    def setUp(self):
+        '''Creates fixture mountinfo, filesystems and sysfs block directory'''
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.sysBlock = os.path.join(self.tmp, 'block')
+        os.makedirs(self.sysBlock)
+        os.symlink('../../devices/sdc/sdc10', os.path.join(self.sysBlock, 'sdc10'))
+        with open(os.path.join(self.tmp, 'mountinfo'), 'w') as fp:
+            fp.write(self.MOUNTINFO)
+
+        with open(os.path.join(self.tmp, 'filesystems'), 'w') as fp:
+            fp.write('nodev\tsysfs\nnodev\ttmpfs\n\text4\n\txfs\n')
+
+        patcher = patch.multiple(devices, MOUNTINFO=os.path.join(self.tmp, 'mountinfo'),
+                                 PROC_FILESYSTEMS=os.path.join(self.tmp, 'filesystems'),
+                                 SYS_BLOCK=self.sysBlock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_mounts(self):
+        '''Tests that mountinfo is parsed and devices are matched exactly'''
+        self.assertEqual(devices.mounts()[1],
+                         devices.Mount('/dev/sdc1', '/mnt/nextcloud backup', 'ext4', 'rw,noatime'))
+        self.assertEqual(devices.mountPoints('/dev/sdc1'), ['/mnt/nextcloud backup'])
+        self.assertEqual(devices.mountPoints('/dev/sdc2'), [])
+        self.assertEqual(devices.fileSystems(), ['ext4', 'xfs'])
+
+    def test_block_device_exists(self):
+        '''Tests that partitions are looked up by exact name in sysfs'''
+        self.assertFalse(devices.blockDeviceExists('/dev/sdc1'))
+        self.assertTrue(devices.blockDeviceExists('/dev/sdc10'))
+        with self.assertRaises(OSError):
+            devices.blockDeviceExists('/dev/sdc1', os.path.join(self.tmp, 'missing'))
+
+    def test_mount_fs_type(self):
+        '''Tests that mount tries each supported filesystem type until one is accepted'''
+        calls = []
+        def fakeMount(device, target, fsType, flags, data):
+            '''Accepts xfs only'''
+            calls.append(fsType)
+            ctypes.set_errno(errno.EINVAL)
+            return 0 if fsType == b'xfs' else -1
+
+        with patch('devices.libc', MagicMock(return_value=MagicMock(mount=fakeMount))):
+            self.assertEqual(devices.mount('/dev/sdc1', '/mnt'), 'xfs')
+
+        self.assertEqual(calls, [b'ext4', b'xfs'])
+
+class ThrottleTests(TestCase):
+    '''Class containing tests to verify functionality of throttle module'''
+    # reads completed, ms reading, writes completed and ms writing of 8:16 are fields 4, 7, 8 and 11
+    DISKSTATS = ('   8       0 sda 100 0 800 50 10 0 80 5 0 60 55 0 0 0 0\n'
+                 '   8      16 sdb {} 0 800 {} {} 0 80 {} 0 60 55 0 0 0 0\n')
+
+    def test_token_bucket(self):
+        '''Tests that TokenBucket allows bursts of rate tokens, then makes callers wait'''
+        clock = MagicMock(return_value=0.0)
+        bucket = throttle.TokenBucket(100, clock)
+        self.assertEqual(bucket.reserve(60), 0.0)
+        self.assertEqual(bucket.reserve(60), 0.2)
+        clock.return_value = 1.0
+        self.assertEqual(bucket.reserve(90), 0.1)
+        self.assertEqual(throttle.TokenBucket(0, clock).reserve(10 ** 9), 0.0)
+
+    def test_backoff(self):
+        '''Tests that Throttle backs off while disk latency is above threshold, then recovers'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'diskstats')
+        with open(path, 'w') as fp:
+            fp.write(self.DISKSTATS.format(100, 100, 0, 0))
+
+        latency = throttle.DiskLatency(os.makedev(8, 16), path)
+        self.assertEqual(latency.last, (100, 100))
+        clock = MagicMock(return_value=0.0)
+        sleep = MagicMock()
+        obj = throttle.Throttle(latency=latency, maxLatency=20, clock=clock, sleep=sleep)
+
+        # slow reads for two samples, then fast reads, then no reads
+        delays = []
+        for completed, ms in [(150, 2100), (200, 5100), (300, 5600), (300, 5600), (300, 5600)]:
+            with open(path, 'w') as fp:
+                fp.write(self.DISKSTATS.format(completed, ms, 0, 0))
+
+            clock.return_value += throttle.Throttle.SAMPLE_INTERVAL
+            delays.append(obj.wait(0))
+
+        self.assertEqual(delays, [0.01, 0.02, 0.01, 0.0, 0.0])
+        self.assertEqual(sleep.call_count, 3)
+
+class ShardScanTests(TestCase):
+    '''Class containing tests to verify functionality of shardScan module'''
+    def test_scan(self):
+        '''Tests that every directory of every shard is listed once, and early stops join workers'''
+        tree = {'a': ['a/1', 'a/2'], 'a/1': ['a/1/x'], 'b': [], 'c': ['c/1']}
+
+        def listDirectory(directory):
+            '''Lists directory of tree'''
+            return directory, tree.get(directory, []), 1
+
+        shards = [(1, 'a'), (1, 'b'), (2, 'c')]
+        self.assertEqual(sorted(shardScan.scan(shards, listDirectory, 3, 2)),
+                         ['a', 'a/1', 'a/1/x', 'a/2', 'b', 'c', 'c/1'])
+
+        results = shardScan.scan(shards, listDirectory, 2, 1)
+        next(results)
+        results.close()
+
+    def test_adaptive_limit(self):
+        '''Tests that the limit grows while latency stays low and is halved when it climbs'''
+        obj = shardScan.DeviceScan([], 8)
+        self.assertEqual(obj.limit, shardScan.INITIAL_JOBS)
+        for latency in [0.001] * 3 + [0.01] + [0.0011]:
+            for _ in range(shardScan.ADJUST_WINDOW):
+                obj.observe(latency)
+
+        self.assertEqual(obj.limit, 3)
+        self.assertLessEqual(obj.baseline, 0.0011)
+
+class FreezeTests(TestCase):
+    '''Class containing tests to verify functionality of freeze module'''
+    MOUNTINFO = ('22 1 8:1 / / rw - ext4 /dev/sda1 rw\n'
+                 '40 22 253:0 / /srv rw - xfs /dev/mapper/vg-data rw\n'
+                 '41 40 0:44 / /srv/tmp rw - tmpfs tmpfs rw\n')
+
+    def test_lvm(self):
+        '''Tests that an LVM snapshot of the volume holding a directory is created, mounted
+        read-only and removed
+        '''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'mountinfo')
+        with open(path, 'w') as fp:
+            fp.write(self.MOUNTINFO)
+
+        self.assertEqual(freeze.findMount('/srv/tmp/x', path).fsType, 'tmpfs')
+        self.assertEqual(freeze.findMount('/srv/tmpx', path).fsType, 'xfs')
+        with self.assertRaises(OSError):
+            freeze.Freeze('zfs', '/srv/nextcloud/data', MagicMock(), tmp, path)
+
+        run = MagicMock(side_effect=lambda x: '  vg\n' if x.startswith('lvs') else '')
+        mountPoint = os.path.join(tmp, 'snapshot')
+        obj = freeze.Freeze('lvm', '/srv/nextcloud/data', run, mountPoint, path)
+        with patch('devices.mount') as mockMount, patch('devices.umount') as mockUmount:
+            self.assertEqual(obj.create(), os.path.join(mountPoint, 'nextcloud/data/'))
+            mockMount.assert_called_once_with('/dev/vg/nextcloud_backup', mountPoint, 'xfs',
+                                              freeze.MS_RDONLY, 'nouuid')
+            obj.release()
+            mockUmount.assert_called_once_with(mountPoint)
+
+        self.assertEqual([x[0][0].split()[0] for x in run.call_args_list],
+                         ['lvs', 'lvcreate', 'lvremove'])
+        self.assertIsNotNone(obj.time)
+
+    def test_btrfs_view(self):
+        '''Tests that btrfs snapshots go to the snapshot mount point if it is on the same
+        filesystem, and are never created inside the directory
+        '''
+        tmp = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tmp)
+        os.makedirs(os.path.join(tmp, 'srv/data/nextcloud'))
+        os.makedirs(os.path.join(tmp, 'snap'))
+        path = os.path.join(tmp, 'mountinfo')
+        with open(path, 'w') as fp:
+            fp.write('22 1 8:1 / / rw - ext4 /dev/sda1 rw\n'
+                     '40 22 0:50 /data {}/srv/data rw - btrfs /dev/sdb1 rw\n'.format(tmp))
+
+        snap = os.path.join(tmp, 'snap')
+        with patch('freeze.BTRFS_SUBVOLUME_INO', -1):
+            self.assertEqual(freeze.Freeze('btrfs', os.path.join(tmp, 'srv/data/nextcloud'),
+                                           MagicMock(), snap, path).view(),
+                             os.path.join(tmp, 'srv/data/.nextcloud_backup'))
+            with self.assertRaises(OSError):
+                freeze.Freeze('btrfs', os.path.join(tmp, 'srv/data'), MagicMock(), snap, path)
+
+            with open(path, 'a') as fp:
+                fp.write('41 22 0:51 / {} rw - btrfs /dev/sdb1 rw\n'.format(snap))
+
+            obj = freeze.Freeze('btrfs', os.path.join(tmp, 'srv/data'), MagicMock(), snap, path)
+            self.assertEqual(obj.path(), os.path.join(snap, 'nextcloud_backup', ''))
+
+    def test_btrfs_nested_subvolume(self):
+        '''Tests that the nested btrfs subvolume holding a directory is snapshotted instead of
+        the mounted one, which doesn't include it
+        '''
+        tmp = os.path.realpath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, tmp)
+        data = os.path.join(tmp, 'srv/nextcloud')
+        os.makedirs(os.path.join(data, 'data'))
+        path = os.path.join(tmp, 'mountinfo')
+        with open(path, 'w') as fp:
+            fp.write('22 1 8:1 / / rw - ext4 /dev/sda1 rw\n'
+                     '40 22 0:50 / {} rw - btrfs /dev/sdb1 rw\n'.format(tmp))
+
+        run = MagicMock(return_value='')
+        with patch('freeze.BTRFS_SUBVOLUME_INO', os.stat(data).st_ino):
+            obj = freeze.Freeze('btrfs', os.path.join(data, 'data'), run, '/mnt/snap', path)
+
+        view = os.path.join(tmp, '.nextcloud_backup')
+        self.assertEqual(obj.create(), os.path.join(view, 'data', ''))
+        run.assert_called_once_with('btrfs subvolume snapshot -r {} {}'.format(data, view))
+
+class BundleStoreTests(TestCase):
+    '''Class containing tests to verify functionality of bundles module'''
+    def test_bundle_store(self):
+        '''Tests that BundleStore rolls over full bundles, appends to the newest one and reads entries back'''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        stat = MagicMock(st_mtime_ns=10 ** 18, st_mode=0o100600)
+        with patch.object(BundleStore, 'BUNDLE_SIZE', 10):
+            store = BundleStore(tmp)
+            for directory, name in [('a', 'x'), ('a/b', 'y'), ('ab', 'z')]:
+                store.add(directory, name, (directory + name).encode() * 2, stat)
+
+            store.close()
+            store = BundleStore(tmp)
+            store.add('a', 'x', b'new', stat)
+
+        self.assertEqual(store.lookup('a', 'x'), (3, 6, 3, 10 ** 18, 0o600))
+        self.assertEqual([(x, y, store.read(z)) for x, y, z in store.entries('a')],
+                         [('a', 'x', b'new'), ('a/b', 'y', b'a/bya/by')])
+        self.assertEqual(len(store.entries()), 3)
+
+        dst = os.path.join(tmp, 'restored')
+        store.extract(store.lookup('ab', 'z'), dst)
+        with open(dst, 'rb') as fp:
+            self.assertEqual(fp.read(), b'abzabz')
+
+        self.assertEqual(os.stat(dst).st_mtime_ns, 10 ** 18)
+        store.removeTree('a')
+        self.assertEqual([x[:2] for x in store.entries()], [('ab', 'z')])
+        store.close()
+
+    def test_batched_index(self):
+        '''Tests that index writes are batched, written before the manifest, and that removing
+        files of directories without packed files doesn't touch the index
+        '''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        stat = MagicMock(st_size=1, st_mtime_ns=1, st_ino=1, st_mode=0o100600)
+        store = BundleStore(tmp)
+        self.addCleanup(store.close)
+        manifest = Manifest(os.path.join(tmp, 'manifest.db'))
+        self.addCleanup(manifest.close)
+        manifest.flushFirst.append(store.flush)
+
+        index = sqlite3.connect(os.path.join(tmp, BundleStore.BUNDLE_DIR, BundleStore.INDEX_NAME))
+        self.addCleanup(index.close)
+        count = 'SELECT COUNT(*) FROM entries'
+        store.add('a', 'x', b'x', stat)
+        store.remove('other', 'y')
+        self.assertEqual(index.execute(count).fetchone(), (0,))
+        self.assertEqual(store.pendingRemovals, [])
+
+        manifest.record('a', 'x', stat)
+        manifest.flush()
+        self.assertEqual(index.execute(count).fetchone(), (1,))
+
+        store.remove('a', 'x')
+        self.assertIsNone(store.lookup('a', 'x'))
+
+class FiltersTests(TestCase):
+    '''Class containing tests to verify functionality of filters module'''
+    def test_patterns(self):
+        '''Tests that patterns follow gitignore rules, the last matching one winning'''
+        rules = Filters(['*.part', 'cache/', '/top', 'a/**/z', 'x[0-9]', 'docs/*', '!docs/keep'])
+        self.assertTrue(rules.excludesFile('a/b/upload.part'))
+        self.assertTrue(rules.excludesDir('u/cache'))
+        self.assertFalse(rules.excludesFile('u/cache'))
+        self.assertTrue(rules.excludesDir('top'))
+        self.assertFalse(rules.excludesDir('u/top'))
+        self.assertTrue(rules.excludesFile('a/z'))
+        self.assertTrue(rules.excludesFile('a/b/c/z'))
+        self.assertTrue(rules.excludesFile('x1'))
+        self.assertFalse(rules.excludesFile('xa'))
+        self.assertTrue(rules.excludesFile('docs/a.txt'))
+        self.assertFalse(rules.excludesFile('docs/sub/a.txt'))
+        self.assertFalse(rules.excludesFile('docs/keep'))
+        self.assertTrue(rules.excludesTree('u/cache/v/w'))
+        self.assertFalse(rules.excludesTree('u/v'))
+
+    def test_limits(self):
+        '''Tests that size and age limits apply to files matching their pattern'''
+        rules = Filters(['max-size 1M *.iso', 'min-size 1', 'min-age 10m'])
+        stat = MagicMock(st_size=2 * 1024 * 1024, st_mtime=1000)
+        self.assertTrue(rules.exceedsLimits('a.iso', stat, 2000))
+        self.assertFalse(rules.exceedsLimits('a.bin', stat, 2000))
+        self.assertTrue(rules.exceedsLimits('a.bin', stat, 1100))
+        stat.st_size = 0
+        self.assertTrue(rules.exceedsLimits('a.bin', stat, 2000))
+
+        with self.assertRaises(ValueError):
+            Filters(['max-size lots'])
+
+class RestoreTests(TestCase):
+    '''Class containing tests to verify functionality of restore module'''
+    def test_patterns(self):
+        '''Tests that walkRoots() only walks literal prefixes and matches() checks parent directories'''
+        self.assertEqual(restore.walkRoots(['alice/files/*.pdf', 'alice', 'bob/files/Photos',
+                                            'bob/files/Photos/2020']), ['alice', 'bob/files/Photos'])
+        self.assertEqual(restore.walkRoots(['*/files/x', 'alice']), [''])
+
+        patterns = ['alice/files/Photos?', 'bob', 'carol/*.pdf']
+        self.assertTrue(restore.matches('alice/files/Photos1/x.jpg', patterns))
+        self.assertFalse(restore.matches('alice/files/Photos/x.jpg', patterns))
+        self.assertTrue(restore.matches('bob/files/x.txt', patterns))
+        self.assertFalse(restore.matches('bobby/files/x.txt', patterns))
+        self.assertTrue(restore.matches('carol/files/a/x.pdf', patterns))
+        self.assertTrue(restore.matches('anything', ['/']))
+
+    def test_progress(self):
+        '''Tests that Progress reports transfer rate and time remaining'''
+        clock = MagicMock(return_value=0.0)
+        progress = restore.Progress(3, 30 * 10 ** 6, clock)
+        self.assertIn('unknown remaining', progress.report())
+        clock.return_value = 10.0
+        progress.add(10 ** 7)
+        self.assertEqual(progress.report(), ('restored 1/3 files, 10.0/30.0 MB in 0:00:10 '
+                                             '(1.00 MB/s), 0:00:20 remaining'))
@@ -0,0 +1,166 @@
+'''Contains Throttle class to rate limit the copy phase so backups don't starve Nextcloud
+
+Copies are limited to a number of bytes and files per second through token buckets, and can
+also back off automatically: the average latency of requests completed by the source disk is
+read from /proc/diskstats, and while it stays above a threshold each file waits for a delay that
+doubles on every check, then halves again once the disk recovers. The I/O scheduling class of
+the backup can be lowered through ioprio_set(2), like ionice does, and pages read and written
+by the backup can be dropped from the page cache with posix_fadvise(2), so Nextcloud's hot files
+aren't evicted by files only read once.
+'''
+
+import ctypes
+import errno
+import os
+import platform
+import threading
+import time
+
+DISKSTATS = '/proc/diskstats'
+# ioprio_set(2) system call numbers, ioprio_set is reached through syscall(2)
+IOPRIO_SET_SYSCALLS = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IO_CLASSES = {'best-effort': 2, 'idle': 3}
+
+def setIoPriority(ioClass, level=7):
+    '''Sets I/O scheduling class ('best-effort' or 'idle') and level (0-7) of calling thread
+
+    Threads started afterwards inherit it. Raises OSError if the system call isn't available
+    '''
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, 'ioprio_set is not supported on this system')
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    value = IO_CLASSES[ioClass] << IOPRIO_CLASS_SHIFT | (level if ioClass == 'best-effort' else 0)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+def dropCache(path, writeBack=False):
+    '''Asks the kernel to drop cached pages of file at path
+
+    Dirty pages and pages under writeback are kept, so a file just written needs writeBack to
+    write its data to disk first. Errors are ignored since the advice is only a hint
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        if writeBack:
+            os.fdatasync(fd)
+
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class TokenBucket:
+    '''Thread safe token bucket allowing rate tokens per second, with bursts of up to rate'''
+    def __init__(self, rate, clock=time.monotonic):
+        '''Creates full bucket, a rate of 0 never waits'''
+        self.rate = rate
+        self.clock = clock
+        self.tokens = rate
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        '''Takes amount tokens, going into debt if needed, and returns seconds to wait before
+        using them
+        '''
+        if not self.rate:
+            return 0.0
+
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - amount
+            self.last = now
+            return max(0.0, -self.tokens / self.rate)
+
+class DiskLatency:
+    '''Average latency of requests completed by a block device, read from /proc/diskstats'''
+    def __init__(self, device, path=None):
+        '''Watches block device with given st_dev number'''
+        self.major = os.major(device)
+        self.minor = os.minor(device)
+        self.path = path or DISKSTATS
+        self.last = self.read()
+
+    def read(self):
+        '''Returns (requests completed, milliseconds spent on them) of device, or None if it
+        isn't listed
+        '''
+        with open(self.path) as fp:
+            for line in fp:
+                fields = line.split()
+                if int(fields[0]) == self.major and int(fields[1]) == self.minor:
+                    # reads completed, time reading, writes completed, time writing
+                    return (int(fields[3]) + int(fields[7]), int(fields[6]) + int(fields[10]))
+
+        return None
+
+    def sample(self):
+        '''Returns average latency in milliseconds of requests completed since last sample, or
+        None if no request completed
+        '''
+        current = self.read()
+        previous, self.last = self.last, current
+        if current is None or previous is None or current[0] <= previous[0]:
+            return None
+
+        return (current[1] - previous[1]) / (current[0] - previous[0])
+
+class Throttle:
+    '''Limits rate of copied bytes and files, backing off while the source disk is slow'''
+    # seconds between latency samples, and bounds of the delay added to each file
+    SAMPLE_INTERVAL = 1.0
+    MIN_DELAY = 0.01
+    MAX_DELAY = 2.0
+
+    def __init__(self, bytesPerSec=0, filesPerSec=0, latency=None, maxLatency=0,
+                 clock=time.monotonic, sleep=time.sleep):
+        '''Creates throttle, rates of 0 are unlimited and latency is a DiskLatency or None'''
+        self.bytes = TokenBucket(bytesPerSec, clock)
+        self.files = TokenBucket(filesPerSec, clock)
+        self.latency = latency
+        self.maxLatency = maxLatency
+        self.clock = clock
+        self.sleep = sleep
+        self.delay = 0.0
+        self.lastSample = clock()
+        self.lock = threading.Lock()
+
+    def backoff(self):
+        '''Returns delay to add to each file, updated from disk latency once per SAMPLE_INTERVAL'''
+        if self.latency is None:
+            return 0.0
+
+        with self.lock:
+            now = self.clock()
+            if now - self.lastSample >= self.SAMPLE_INTERVAL:
+                self.lastSample = now
+                latency = self.latency.sample()
+                if latency is not None and latency > self.maxLatency:
+                    self.delay = min(max(self.delay * 2, self.MIN_DELAY), self.MAX_DELAY)
+                elif self.delay > self.MIN_DELAY:
+                    self.delay /= 2
+                else:
+                    self.delay = 0.0
+
+            return self.delay
+
+    def wait(self, size):
+        '''Waits until a file of size bytes may be copied, returns seconds waited'''
+        seconds = max(self.files.reserve(1), self.bytes.reserve(size)) + self.backoff()
+        if seconds:
+            self.sleep(seconds)
+
+        return seconds
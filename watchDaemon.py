@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+'''Contains main function to run the daemon tracking changed directories for --changes watch'''
+
+import argparse
+import os
+import signal
+import sys
+from nextcloudBackup import NextcloudBackup
+from dirtySet import DirtySet
+from changeWatcher import ChangeWatcher
+
+def main():
+    '''Sets up argument parser and watches NEXTCLOUD_DATA until SIGTERM or SIGINT is received'''
+    parser = argparse.ArgumentParser(description='daemon recording directories changed under the Nextcloud data directory')
+    parser.add_argument('--verbose', default=False, help='increases verbosity', action='store_true')
+    args = parser.parse_args()
+
+    if not os.path.exists(NextcloudBackup.NEXTCLOUD_DATA):
+        sys.exit(('Error: Nextcloud data directory \'{}\' '
+                  'does not exist'.format(NextcloudBackup.NEXTCLOUD_DATA)))
+
+    try:
+        watcher = ChangeWatcher(NextcloudBackup.NEXTCLOUD_DATA,
+                                DirtySet(NextcloudBackup.NEXTCLOUD_BACKUP_DIRTY),
+                                NextcloudBackup.IGNORED_FILE_TYPES, args.verbose)
+    except OSError as e:
+        sys.exit('Error: unable to watch \'{}\': {}'.format(NextcloudBackup.NEXTCLOUD_DATA, e))
+
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda *_: watcher.stop())
+
+    try:
+        watcher.run()
+    finally:
+        watcher.close()
+
+if __name__ == '__main__':
+    main()